@@ -0,0 +1,232 @@
+"""
+Migrate the denormalized `movies` table (one row per user and movie, with the movie details copied
+into every row) to the normalized `movies`, `users`, `ratings` and `movie_rating_aggregates` tables.
+
+The legacy table is renamed to `movies_denormalized` and streamed in primary key order, one batch per
+transaction, so the table never has to fit in memory and an interrupted run can be resumed with
+`--after-id`.
+
+Usage:
+    python -m app.commands.normalize_movies [--batch-size 5000] [--after-id 0]
+"""
+
+import argparse
+from typing import Iterator, Optional
+
+from sqlalchemy import Connection, Engine, MetaData, Table, inspect, select, text
+from sqlalchemy.orm import Session
+
+from app.methods.aggregates import rebuild_rating_aggregates
+from app.methods.upsert import upsert_insert
+from app.models.movie import (
+    CATALOG_VERSION_DROP_TRIGGERS,
+    Base,
+    CatalogVersion,
+    Movie,
+    MovieRatingAggregate,
+    Rating,
+    User,
+)
+
+LEGACY_TABLE = "movies_denormalized"
+NORMALIZED_TABLES = (
+    MovieRatingAggregate.__table__,
+    Rating.__table__,
+    User.__table__,
+)
+DEFAULT_BATCH_SIZE = 5000
+
+
+def has_legacy_movies_table(connection: Connection) -> bool:
+    """
+    Check if the `movies` table still has the denormalized layout
+
+    :param connection: database connection
+    :return: True if `movies` holds one row per user rating
+    """
+    inspector = inspect(connection)
+    if not inspector.has_table(Movie.__tablename__):
+        return False
+    columns = {column["name"] for column in inspector.get_columns(Movie.__tablename__)}
+    return "user_id" in columns
+
+
+def rename_legacy_movies_table(connection: Connection) -> None:
+    """
+    Rename the denormalized `movies` table to `movies_denormalized`, together with the indexes and
+    sequence that would otherwise clash with the ones of the normalized `movies` table
+
+    :param connection: database connection
+    """
+    inspector = inspect(connection)
+    for table in NORMALIZED_TABLES:
+        # Tables created by `create_all` next to the legacy table reference the wrong `movies`
+        if inspector.has_table(table.name):
+            if connection.execute(select(table).limit(1)).first() is not None:
+                raise RuntimeError(
+                    f"Table {table.name} already holds data, refusing to migrate"
+                )
+            table.drop(connection)
+
+    # The catalog version only counts changes, recreate it with its triggers on the new `movies`
+    for ddl in CATALOG_VERSION_DROP_TRIGGERS.get(connection.dialect.name, ()):
+        connection.execute(text(ddl))
+    CatalogVersion.__table__.drop(connection, checkfirst=True)
+
+    for index in inspector.get_indexes(Movie.__tablename__):
+        connection.execute(text(f'DROP INDEX IF EXISTS "{index["name"]}"'))
+
+    connection.execute(text(f'ALTER TABLE movies RENAME TO "{LEGACY_TABLE}"'))
+    if connection.dialect.name == "postgresql":
+        connection.execute(
+            text(f'ALTER INDEX IF EXISTS movies_pkey RENAME TO "{LEGACY_TABLE}_pkey"')
+        )
+        connection.execute(
+            text(
+                f'ALTER SEQUENCE IF EXISTS movies_id_seq RENAME TO "{LEGACY_TABLE}_id_seq"'
+            )
+        )
+
+
+def migrate_schema(engine: Engine) -> bool:
+    """
+    Move the legacy table out of the way (if present) and create the normalized tables
+
+    :param engine: database engine
+    :return: True if a legacy table is waiting to be backfilled
+    """
+    with engine.begin() as connection:
+        if has_legacy_movies_table(connection):
+            rename_legacy_movies_table(connection)
+        Base.metadata.create_all(connection)
+        return inspect(connection).has_table(LEGACY_TABLE)
+
+
+def iter_legacy_batches(
+    connection: Connection, legacy: Table, batch_size: int, after_id: int
+) -> Iterator[list]:
+    """
+    Stream the legacy table in primary key order with keyset pagination
+
+    :param connection: database connection
+    :param legacy: reflected legacy table
+    :param batch_size: number of rows per batch
+    :param after_id: only rows with a greater id are returned
+    :return: iterator of row batches
+    """
+    while True:
+        batch = connection.execute(
+            select(legacy)
+            .where(legacy.c.id > after_id)
+            .order_by(legacy.c.id)
+            .limit(batch_size)
+        ).all()
+        # Don't hold the read transaction open while the batch is written
+        connection.rollback()
+        if not batch:
+            return
+        yield batch
+        after_id = batch[-1].id
+
+
+def backfill_batch(db: Session, batch: list) -> None:
+    """
+    Write one batch of legacy rows into the normalized tables. A movie keeps the id of the first
+    legacy row it appears in, later rows with the same title rate that movie. If a user rated the
+    same movie more than once, the most recent row wins.
+
+    :param db: database session
+    :param batch: legacy rows ordered by id
+    """
+    titles = {row.title for row in batch}
+    movie_ids = dict(
+        db.execute(select(Movie.title, Movie.id).where(Movie.title.in_(titles))).all()
+    )
+    new_movies = []
+    for row in batch:
+        if row.title not in movie_ids:
+            movie_ids[row.title] = row.id
+            new_movies.append(
+                {
+                    "id": row.id,
+                    "title": row.title,
+                    "genre": row.genre,
+                    "year": row.year,
+                    "runtime": row.runtime,
+                }
+            )
+    if new_movies:
+        db.execute(Movie.__table__.insert(), new_movies)
+
+    user_ids = [{"id": user_id} for user_id in {row.user_id for row in batch}]
+    db.execute(upsert_insert(db, User).on_conflict_do_nothing(), user_ids)
+
+    ratings = {
+        (row.user_id, movie_ids[row.title]): row.rating
+        for row in batch
+        if row.rating is not None
+    }
+    if ratings:
+        insert_ratings = upsert_insert(db, Rating)
+        db.execute(
+            insert_ratings.on_conflict_do_update(
+                index_elements=[Rating.user_id, Rating.movie_id],
+                set_={"rating": insert_ratings.excluded.rating},
+            ),
+            [
+                {"user_id": user_id, "movie_id": movie_id, "rating": rating}
+                for (user_id, movie_id), rating in ratings.items()
+            ],
+        )
+
+
+def backfill(
+    engine: Engine, batch_size: int = DEFAULT_BATCH_SIZE, after_id: int = 0
+) -> int:
+    """
+    Copy the legacy table into the normalized tables, committing after every batch, then rebuild
+    the rating aggregates
+
+    :param engine: database engine
+    :param batch_size: number of legacy rows per batch
+    :param after_id: resume after this legacy row id
+    :return: number of legacy rows processed
+    """
+    processed = 0
+    with engine.connect() as reader:
+        legacy = Table(LEGACY_TABLE, MetaData(), autoload_with=reader)
+        for batch in iter_legacy_batches(reader, legacy, batch_size, after_id):
+            with Session(engine) as db, db.begin():
+                backfill_batch(db, batch)
+            processed += len(batch)
+            print(f"Backfilled {processed} rows (last id {batch[-1].id})")
+
+    with Session(engine) as db, db.begin():
+        rebuild_rating_aggregates(db)
+        if db.get_bind().dialect.name == "postgresql":
+            db.execute(
+                text(
+                    "SELECT setval('movies_id_seq', (SELECT coalesce(max(id), 0) + 1 FROM movies), false)"
+                )
+            )
+    return processed
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--after-id", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    from app.database import Database
+    from app.settings import Settings
+
+    engine = Database(Settings.from_env()).engine
+    if migrate_schema(engine):
+        backfill(engine, args.batch_size, args.after_id)
+    else:
+        print("No denormalized movies table found, schema is up to date")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Check the per-movie rating aggregates against the ratings table, and rebuild them if needed.
+
+Usage:
+    python -m app.commands.rating_aggregates check
+    python -m app.commands.rating_aggregates rebuild
+"""
+
+import argparse
+import sys
+from typing import Optional
+
+from sqlalchemy.orm import Session
+
+from app.methods.aggregates import check_rating_aggregates, rebuild_rating_aggregates
+
+
+def check(db: Session) -> int:
+    """
+    Print every movie whose stored aggregate doesn't match its ratings
+
+    :param db: database session
+    :return: number of inconsistent aggregates
+    """
+    mismatches = check_rating_aggregates(db)
+    for movie_id, stored_sum, stored_count, actual_sum, actual_count in mismatches:
+        print(
+            f"MOVIE-ID: {movie_id} stored sum/count {stored_sum}/{stored_count}, "
+            f"actual {actual_sum}/{actual_count}"
+        )
+    print(f"{len(mismatches)} inconsistent rating aggregates")
+    return len(mismatches)
+
+
+def rebuild(db: Session) -> int:
+    """
+    Rebuild every aggregate from the ratings table in one transaction
+
+    :param db: database session
+    :return: number of aggregates written
+    """
+    with db.begin():
+        written = rebuild_rating_aggregates(db)
+    print(f"Rebuilt {written} rating aggregates")
+    return written
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("action", choices=["check", "rebuild"])
+    args = parser.parse_args(argv)
+
+    from app.database import Database
+    from app.settings import Settings
+
+    with Database(Settings.from_env()).SessionLocal() as db:
+        if args.action == "check":
+            sys.exit(1 if check(db) else 0)
+        rebuild(db)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,519 @@
+"""
+Build the neighbor index of the similar movies and recommendations endpoints: the cosine similarity
+of the rating vectors of every pair of movies, keeping the most similar movies of each one.
+
+The ratings are loaded into the compressed sparse rows of the columnar engine, and similarities
+are computed by blocks of movies whose dense rows fit in memory, spread over a process pool. A
+block is the sparse product of its movies' ratings with the ratings of every user who rated them.
+
+Every movie's ratings are fingerprinted in the index, so later runs only recompute the movies
+whose ratings changed (and the movies whose neighbors they were) and rewrite the index once.
+
+Usage:
+    python -m app.commands.similarity [--full] [--neighbors 50] [--workers 4] [--interval 0]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from app.methods.columnar import RatingsMatrix, load_matrix
+from app.methods.similarity import (
+    INDEX_HEADER,
+    INDEX_MAGIC,
+    INDEX_VERSION,
+    index_sections,
+)
+from app.settings import Settings
+
+# Largest block of dense similarities computed at once by a worker, in values (64 MB as float64)
+BLOCK_VALUES = 8_000_000
+
+# Largest number of rating products expanded at once while computing a block
+PAIR_BATCH = 4_000_000
+
+# Share of changed movies above which an incremental run recomputes every movie instead
+FULL_BUILD_SHARE = 0.25
+
+# Matrix and previous neighbors shared by the block functions, set in every worker process
+worker_state: dict = {}
+
+
+def init_worker(state: dict) -> None:
+    """
+    Share the state of a run with the block functions of a worker process
+
+    :param state: matrix, norms, number of neighbors and previous neighbors of the run
+    """
+    worker_state.clear()
+    worker_state.update(state)
+
+
+def segments(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """
+    :param starts: start of every segment
+    :param lengths: length of every segment
+    :return: positions of every segment, concatenated
+    """
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+
+def rating_checksums(matrix: RatingsMatrix) -> np.ndarray:
+    """
+    Fingerprint the ratings of every movie, a wrapping sum of a hash of every (user, rating)
+
+    :param matrix: ratings matrix
+    :return: uint64 checksum by movie index
+    """
+    users = matrix.user_ids[matrix.movie_users].astype(np.uint64)
+    hashes = users * np.uint64(0x9E3779B97F4A7C15) ^ matrix.movie_ratings.astype(
+        np.uint64
+    ) * np.uint64(0xC2B2AE3D27D4EB4F)
+    hashes ^= hashes >> np.uint64(31)
+    hashes *= np.uint64(0xBF58476D1CE4E5B9)
+    sums = np.concatenate((np.zeros(1, np.uint64), np.cumsum(hashes, dtype=np.uint64)))
+    return sums[matrix.movie_indptr[1:]] - sums[matrix.movie_indptr[:-1]]
+
+
+def rating_norms(matrix: RatingsMatrix) -> np.ndarray:
+    """
+    :param matrix: ratings matrix
+    :return: euclidean norm of the rating vector of every movie
+    """
+    movies = len(matrix.movie_ids)
+    movie_index = np.repeat(np.arange(movies), np.diff(matrix.movie_indptr))
+    squares = matrix.movie_ratings.astype(np.float64) ** 2
+    return np.sqrt(np.bincount(movie_index, weights=squares, minlength=movies))
+
+
+def similarity_block(rows: np.ndarray) -> np.ndarray:
+    """
+    Compute the cosine similarity of some movies with every movie. The dot products are the
+    sparse product of the rows' ratings with the ratings of the users who rated them: every
+    rating of a row movie is multiplied with every rating of its user and summed by movie pair.
+
+    :param rows: ascending movie indexes
+    :return: float32 similarities, one row per movie and one column per movie index, 0 between
+        a movie and itself
+    """
+    matrix, norms = worker_state["matrix"], worker_state["norms"]
+    movies = len(matrix.movie_ids)
+    starts = matrix.movie_indptr[rows]
+    lengths = matrix.movie_indptr[rows + 1] - starts
+    positions = segments(starts, lengths)
+    local = np.repeat(np.arange(len(rows)), lengths)
+    users = matrix.movie_users[positions]
+    values = matrix.movie_ratings[positions].astype(np.float64)
+    row_lengths = matrix.user_indptr[users + 1] - matrix.user_indptr[users]
+
+    dots = np.zeros(len(rows) * movies)
+    # Rating values are small integers, so the sums are exact whatever the batches
+    ends = np.cumsum(row_lengths)
+    total = ends[-1] if len(ends) else 0
+    edges = np.searchsorted(ends, np.arange(PAIR_BATCH, total, PAIR_BATCH))
+    for batch in np.split(np.arange(len(users)), edges):
+        if not len(batch):
+            continue
+        products = segments(matrix.user_indptr[users[batch]], row_lengths[batch])
+        dots += np.bincount(
+            np.repeat(local[batch] * movies, row_lengths[batch])
+            + matrix.user_movies[products],
+            weights=np.repeat(values[batch], row_lengths[batch])
+            * matrix.user_ratings[products],
+            minlength=len(dots),
+        )
+    dots = dots.reshape(len(rows), movies)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        similarities = np.nan_to_num(dots / np.outer(norms[rows], norms))
+    similarities[np.arange(len(rows)), rows] = 0
+    return similarities.astype(np.float32)
+
+
+def top_neighbors(scores: np.ndarray, neighbors: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Select the highest positive scores of every row, ties broken by the lowest column, in
+    linear time per row
+
+    :param scores: float32 scores, one column per candidate
+    :param neighbors: number of scores to keep per row
+    :return: columns (-1 as padding) and scores (0 as padding) of the kept scores, highest first
+    """
+    rows, candidates = scores.shape
+    kept = min(neighbors, candidates)
+    if kept < candidates:
+        kth = np.partition(scores, candidates - kept, axis=1)[:, candidates - kept]
+        above = scores > kth[:, None]
+        tied = scores == kth[:, None]
+        room = kept - above.sum(axis=1)
+        selected = above | (tied & (np.cumsum(tied, axis=1) <= room[:, None]))
+        columns = np.nonzero(selected)[1].reshape(rows, kept)
+    else:
+        columns = np.broadcast_to(np.arange(candidates), (rows, candidates))
+    return merge_neighbors(columns, np.take_along_axis(scores, columns, 1), neighbors)
+
+
+def merge_neighbors(
+    ids: np.ndarray, scores: np.ndarray, neighbors: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Keep the highest positive scores of candidate lists, ties broken by the lowest id
+
+    :param ids: candidate ids of every row, -1 for no candidate, distinct within a row
+    :param scores: float32 candidate scores
+    :param neighbors: number of candidates to keep per row
+    :return: ids (-1 as padding) and scores (0 as padding) of the kept candidates, highest first
+    """
+    scores = np.where(ids >= 0, scores, 0).astype(np.float32)
+    order = np.lexsort((ids, -scores), axis=1)[:, :neighbors]
+    ids = np.take_along_axis(ids, order, 1)
+    scores = np.take_along_axis(scores, order, 1)
+    missing = scores <= 0
+    ids = np.where(missing, -1, ids)
+    scores = np.where(missing, 0, scores).astype(np.float32)
+    padding = neighbors - ids.shape[1]
+    if padding > 0:
+        ids = np.pad(ids, ((0, 0), (0, padding)), constant_values=-1)
+        scores = np.pad(scores, ((0, 0), (0, padding)))
+    return ids, scores
+
+
+def neighbors_block(rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    :param rows: ascending movie indexes
+    :return: neighbor indexes and scores of the movies
+    """
+    return top_neighbors(similarity_block(rows), worker_state["neighbors"])
+
+
+def changed_block(rows: np.ndarray) -> tuple:
+    """
+    Recompute the neighbors of changed movies, and find what their changes do to the neighbors
+    of every other movie
+
+    :param rows: ascending indexes of changed movies
+    :return: neighbor indexes and scores of the movies; the best of them as neighbors of every
+        movie (indexes and scores); and whether the stored neighbors of every movie may be
+        wrong now, because one of the movies left them or tied with their last one
+    """
+    neighbors = worker_state["neighbors"]
+    previous, last, full = (
+        worker_state["previous"],
+        worker_state["last"],
+        worker_state["full"],
+    )
+    similarities = similarity_block(rows)
+    row_ids, row_scores = top_neighbors(similarities, neighbors)
+    column_ids, column_scores = top_neighbors(similarities.T, neighbors)
+    column_ids = np.where(column_ids >= 0, rows[column_ids], -1)
+
+    local = np.full(len(last), -1)
+    local[rows] = np.arange(len(rows))
+    previous_local = np.where(previous >= 0, local[np.maximum(previous, 0)], -1)
+    movies, slots = np.nonzero(previous_local >= 0)
+    scores = similarities[previous_local[movies, slots], movies]
+    stale = np.zeros(len(last), dtype=bool)
+    stale[movies[scores <= last[movies]]] = True
+    stale |= (similarities == last[None, :]).any(axis=0)
+    return row_ids, row_scores, column_ids, column_scores, stale & full
+
+
+def run_blocks(function: Callable, rows: np.ndarray, state: dict, workers: int) -> list:
+    """
+    Run a block function over movies, by blocks whose dense similarities fit in BLOCK_VALUES
+
+    :param function: block function
+    :param rows: ascending movie indexes
+    :param state: worker state of the run
+    :param workers: number of processes, the blocks run in this process when 1
+    :return: result of every block, in order
+    """
+    size = max(1, BLOCK_VALUES // max(len(state["matrix"].movie_ids), 1))
+    blocks = [rows[start : start + size] for start in range(0, len(rows), size)]
+    if workers <= 1 or len(blocks) <= 1:
+        init_worker(state)
+        return [function(block) for block in blocks]
+    with ProcessPoolExecutor(
+        min(workers, len(blocks)), initializer=init_worker, initargs=(state,)
+    ) as pool:
+        return list(pool.map(function, blocks))
+
+
+def read_index(path: str) -> Optional[dict[str, np.ndarray]]:
+    """
+    Read the arrays of an index file
+
+    :param path: path of the index
+    :return: checksums, movie ids, neighbor ids and scores (one row per movie), None if there is
+        no index this version can read
+    """
+    try:
+        data = np.fromfile(path, dtype=np.uint8)
+    except FileNotFoundError:
+        return None
+    if len(data) < INDEX_HEADER.size:
+        return None
+    magic, version, movies, neighbors = INDEX_HEADER.unpack_from(data)
+    sections = index_sections(movies, neighbors)
+    if (magic, version) != (INDEX_MAGIC, INDEX_VERSION) or len(data) != sum(
+        sections["scores"]
+    ):
+        return None
+    dtypes = {
+        "checksums": "<u8",
+        "movie_ids": "<i4",
+        "neighbor_ids": "<i4",
+        "scores": "<f4",
+    }
+    arrays = {
+        name: np.frombuffer(
+            data, dtypes[name], size // np.dtype(dtypes[name]).itemsize, offset
+        )
+        for name, (offset, size) in sections.items()
+    }
+    arrays["neighbor_ids"] = arrays["neighbor_ids"].reshape(movies, neighbors)
+    arrays["scores"] = arrays["scores"].reshape(movies, neighbors)
+    return arrays
+
+
+def write_index(
+    path: str,
+    checksums: np.ndarray,
+    movie_ids: np.ndarray,
+    neighbor_ids: np.ndarray,
+    scores: np.ndarray,
+) -> None:
+    """
+    Write an index file next to the current one and swap it in, so readers see either of them
+
+    :param path: path of the index
+    :param checksums: checksum of the ratings of every movie
+    :param movie_ids: ascending movie ids
+    :param neighbor_ids: neighbor movie ids, one row per movie
+    :param scores: neighbor scores, one row per movie
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    file = tempfile.NamedTemporaryFile(
+        dir=directory, prefix=".similarity-", delete=False
+    )
+    try:
+        with file:
+            file.write(
+                INDEX_HEADER.pack(
+                    INDEX_MAGIC, INDEX_VERSION, len(movie_ids), neighbor_ids.shape[1]
+                )
+            )
+            for array, dtype in (
+                (checksums, "<u8"),
+                (movie_ids, "<i4"),
+                (neighbor_ids, "<i4"),
+                (scores, "<f4"),
+            ):
+                file.write(np.ascontiguousarray(array, dtype=dtype).tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(file.name, path)
+    except BaseException:
+        os.unlink(file.name)
+        raise
+
+
+def full_neighbors(state: dict, workers: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the neighbors of every movie
+
+    :param state: worker state of the run
+    :param workers: number of processes
+    :return: neighbor indexes and scores, one row per movie
+    """
+    movies, neighbors = len(state["matrix"].movie_ids), state["neighbors"]
+    results = run_blocks(neighbors_block, np.arange(movies), state, workers)
+    if not results:
+        return np.empty((0, neighbors), np.int64), np.empty((0, neighbors), np.float32)
+    return (
+        np.concatenate([ids for ids, _ in results]),
+        np.concatenate([scores for _, scores in results]),
+    )
+
+
+def compare_index(
+    index: dict[str, np.ndarray], movie_ids: np.ndarray, checksums: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Find the movies whose ratings changed since a previous index was built
+
+    :param index: arrays of the previous index, holding at least one movie
+    :param movie_ids: ascending ids of the movies
+    :param checksums: checksum of the ratings of every movie
+    :return: row of every movie in the previous index, whether it is in the previous index, and
+        whether it is new or its ratings changed
+    """
+    old_ids = index["movie_ids"]
+    rows = np.minimum(np.searchsorted(old_ids, movie_ids), len(old_ids) - 1)
+    present = old_ids[rows] == movie_ids
+    return rows, present, ~present | (index["checksums"][rows] != checksums)
+
+
+def incremental_neighbors(
+    state: dict,
+    workers: int,
+    index: dict[str, np.ndarray],
+    rows: np.ndarray,
+    present: np.ndarray,
+    changed: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, int]:
+    """
+    Update the neighbors of a previous index for the movies whose ratings changed.
+
+    A changed movie gets its neighbors recomputed, and its new similarities are merged into the
+    neighbors of every other movie. The merge is exact unless a changed movie was one of the
+    neighbors of a movie whose list is full and now scores no more than its last neighbor: a movie
+    that was not stored could then take its place, so that movie is recomputed too.
+
+    :param state: worker state of the run
+    :param workers: number of processes
+    :param index: arrays of the previous index, with as many neighbors per movie as the run
+    :param rows: row of every movie in the previous index, see compare_index
+    :param present: whether every movie is in the previous index
+    :param changed: whether every movie is new or its ratings changed
+    :return: neighbor indexes and scores, one row per movie, and the number of movies
+        recomputed
+    """
+    movie_ids, neighbors = state["matrix"].movie_ids, state["neighbors"]
+    movies = len(movie_ids)
+
+    # Previous neighbors as indexes of the new matrix, without the movies that were deleted
+    old_neighbors, old_scores = index["neighbor_ids"][rows], index["scores"][rows]
+    positions = np.minimum(np.searchsorted(movie_ids, old_neighbors), movies - 1)
+    kept = (old_neighbors >= 0) & (movie_ids[positions] == old_neighbors)
+    previous = np.where(kept & present[:, None], positions, -1)
+    full = present & (old_neighbors[:, -1] >= 0)
+    state["previous"] = previous
+    state["last"] = np.where(full, old_scores[:, -1], 0).astype(np.float32)
+    state["full"] = full
+    stale = full & ((old_neighbors >= 0) & ~kept).any(axis=1)
+
+    changed_rows = np.nonzero(changed)[0]
+    unchanged = (previous >= 0) & ~changed[np.maximum(previous, 0)]
+    neighbor_ids = np.where(unchanged, previous, -1)
+    scores = np.where(unchanged, old_scores, 0).astype(np.float32)
+    new_rows = [(np.empty((0, neighbors), np.int64), np.empty((0, neighbors)))]
+    for row_ids, row_scores, column_ids, column_scores, block_stale in run_blocks(
+        changed_block, changed_rows, state, workers
+    ):
+        neighbor_ids, scores = merge_neighbors(
+            np.concatenate((neighbor_ids, column_ids), axis=1),
+            np.concatenate((scores, column_scores), axis=1),
+            neighbors,
+        )
+        new_rows.append((row_ids, row_scores))
+        stale |= block_stale
+    neighbor_ids[changed_rows] = np.concatenate([ids for ids, _ in new_rows])
+    scores[changed_rows] = np.concatenate([block for _, block in new_rows])
+
+    stale_rows = np.nonzero(stale & ~changed)[0]
+    if len(stale_rows):
+        results = run_blocks(neighbors_block, stale_rows, state, workers)
+        neighbor_ids[stale_rows] = np.concatenate([ids for ids, _ in results])
+        scores[stale_rows] = np.concatenate([block for _, block in results])
+    return neighbor_ids, scores, len(changed_rows) + len(stale_rows)
+
+
+def build_similarity_index(
+    db: Session,
+    path: str = Settings.similarity_index_path,
+    neighbors: int = Settings.similarity_neighbors,
+    workers: int = 1,
+    full: bool = False,
+) -> dict:
+    """
+    Build the neighbor index, incrementally from the current index unless told otherwise
+
+    :param db: database session
+    :param path: path of the index
+    :param neighbors: number of neighbors per movie
+    :param workers: number of processes computing the similarities
+    :param full: whether to recompute every movie even if an index exists
+    :return: summary of the run: mode (full, incremental or unchanged), number of movies and
+        number of movies recomputed
+    """
+    matrix = load_matrix(db)
+    movies = len(matrix.movie_ids)
+    checksums = rating_checksums(matrix)
+    state = {"matrix": matrix, "norms": rating_norms(matrix), "neighbors": neighbors}
+
+    index = None if full else read_index(path)
+    mode = "full"
+    if (
+        index is not None
+        and len(index["movie_ids"])
+        and movies
+        and index["neighbor_ids"].shape[1] == neighbors
+    ):
+        rows, present, changed = compare_index(index, matrix.movie_ids, checksums)
+        if not changed.any() and present.sum() == len(index["movie_ids"]):
+            return {"mode": "unchanged", "movies": movies, "recomputed": 0}
+        if changed.sum() <= FULL_BUILD_SHARE * movies:
+            mode = "incremental"
+    if mode == "incremental":
+        neighbor_ids, scores, recomputed = incremental_neighbors(
+            state, workers, index, rows, present, changed
+        )
+    else:
+        neighbor_ids, scores = full_neighbors(state, workers)
+        recomputed = movies
+
+    write_index(
+        path,
+        checksums,
+        matrix.movie_ids,
+        np.where(neighbor_ids >= 0, matrix.movie_ids[np.maximum(neighbor_ids, 0)], -1),
+        scores,
+    )
+    return {"mode": mode, "movies": movies, "recomputed": recomputed}
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    settings = Settings.from_env()
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--path", default=settings.similarity_index_path)
+    parser.add_argument("--neighbors", type=int, default=settings.similarity_neighbors)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--full", action="store_true", help="recompute every movie")
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=0,
+        help="keep refreshing the index every INTERVAL seconds",
+    )
+    args = parser.parse_args(argv)
+
+    from app.database import Database
+
+    database = Database(settings)
+    full = args.full
+    while True:
+        start = time.perf_counter()
+        with database.SessionLocal() as db:
+            summary = build_similarity_index(
+                db, args.path, args.neighbors, args.workers, full
+            )
+        print(
+            f"{summary['mode'].capitalize()} build of {args.path}: "
+            f"{summary['recomputed']} of {summary['movies']} movies recomputed in "
+            f"{time.perf_counter() - start:.1f}s"
+        )
+        if not args.interval:
+            break
+        full = False
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from fastapi import FastAPI
+
+from app.database import Database
+from app.instrumentation import MetricsMiddleware
+from app.methods.cache import create_query_cache
+from app.methods.leaderboard import LeaderboardRefresher
+from app.methods.similarity import SimilarityIndex
+from app.routes.cache import router as cache_router
+from app.routes.metrics import exposition_router
+from app.routes.metrics import router as metrics_router
+from app.routes.movie import router as movie_router
+from app.routes.ratings import router as rating_router
+from app.settings import Settings
+
+
+def create_app(settings: Optional[Settings] = None) -> FastAPI:
+    """
+    Create the application. Importing and creating it never connects to the database: engines and
+    the query cache are created by the lifespan, and engines connect on the first request, which
+    also prepares the schema. The lifespan also runs the replica health checks, and the
+    leaderboard refresher, the columnar engine and the rating write buffer when enabled, in the
+    background.
+
+    :param settings: Optional settings, read from the environment by default
+    :return: application
+    """
+    settings = settings or Settings.from_env()
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+        app.state.query_cache = create_query_cache(settings)
+        app.state.database = Database(settings)
+        app.state.database.replica_router.start()
+        if settings.leaderboard:
+            app.state.leaderboard = LeaderboardRefresher(
+                settings.leaderboard_refresh_interval,
+                settings.leaderboard_refresh_writes,
+                app.state.query_cache,
+                settings.leaderboard_size,
+                settings.leaderboard_min_votes,
+            )
+            app.state.leaderboard.start(app.state.database)
+        if settings.columnar_engine:
+            from app.methods.columnar import ColumnarEngine
+
+            app.state.columnar = ColumnarEngine(
+                settings.columnar_reload_interval, settings.columnar_merge_threshold
+            )
+            app.state.columnar.start(app.state.database)
+        if settings.rating_write_behind:
+            from app.methods.write_behind import RatingWriteBuffer
+
+            app.state.write_buffer = RatingWriteBuffer(
+                settings.write_behind_log_dir,
+                settings.write_behind_flush_interval,
+                settings.write_behind_max_batch,
+                settings.write_behind_max_pending,
+                settings.write_behind_enqueue_timeout,
+                settings.write_behind_log_max_bytes,
+            )
+            app.state.write_buffer.start(
+                app.state.database,
+                getattr(app.state, "columnar", None),
+                getattr(app.state, "leaderboard", None),
+                app.state.query_cache,
+            )
+        yield
+        if settings.rating_write_behind:
+            await app.state.write_buffer.stop()
+        if settings.columnar_engine:
+            await app.state.columnar.stop()
+        if settings.leaderboard:
+            await app.state.leaderboard.stop()
+        await app.state.database.replica_router.stop()
+        await app.state.database.dispose()
+        app.state.query_cache.close()
+
+    app = FastAPI(lifespan=lifespan)
+    app.state.settings = settings
+    # Mapped on the first lookup, the index file is written by app.commands.similarity
+    app.state.similarity = SimilarityIndex(
+        settings.similarity_index_path,
+        settings.similarity_reload_interval,
+        settings.recommendation_min_rating,
+    )
+    app.add_middleware(
+        MetricsMiddleware,
+        slow_request_seconds=settings.slow_request_seconds,
+        slow_request_max_statements=settings.slow_request_max_statements,
+    )
+    app.include_router(movie_router, prefix="/api/v1")
+    app.include_router(rating_router, prefix="/api/v1")
+    app.include_router(cache_router, prefix="/api/v1")
+    app.include_router(metrics_router, prefix="/api/v1")
+    app.include_router(exposition_router)
+    return app
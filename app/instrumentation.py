@@ -0,0 +1,356 @@
+import logging
+from bisect import bisect_left
+from collections import Counter
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+from typing import Any, Callable, Iterable, Optional
+from weakref import WeakSet
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# Upper bounds of the buckets of the number of queries per request
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+# Upper bounds of the buckets of the number of ratings per write-behind batch
+BATCH_SIZE_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets, one series per combination of label values
+    """
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...], buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.series: dict[tuple, list] = {}
+        self.lock = Lock()
+
+    def observe(self, value: float, *label_values: str) -> None:
+        """
+        :param value: observed value
+        :param label_values: values of the labels, in the order of the labels
+        """
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                # Count per bucket, the +Inf bucket, then the sum of the values
+                series = self.series[label_values] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def render(self) -> list[str]:
+        """
+        :return: lines of the histogram in the Prometheus text format
+        """
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {labels: list(values) for labels, values in self.series.items()}
+        for label_values, values in sorted(series.items()):
+            labels = ",".join(
+                f'{name}="{escape(value)}"'
+                for name, value in zip(self.labels, label_values)
+            )
+            prefix = f"{labels}," if labels else ""
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            labels = f"{{{labels}}}" if labels else ""
+            lines.append(f"{self.name}_sum{labels} {values[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+    def clear(self) -> None:
+        with self.lock:
+            self.series.clear()
+
+
+def escape(value: str) -> str:
+    """
+    Escape a label value for the Prometheus text format
+    """
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time to answer a request, by route",
+    ("method", "route", "status"),
+    LATENCY_BUCKETS,
+)
+REQUEST_QUERIES = Histogram(
+    "http_request_db_queries",
+    "Number of SQL statements run by a request, by route",
+    ("method", "route"),
+    QUERY_COUNT_BUCKETS,
+)
+REQUEST_DB_SECONDS = Histogram(
+    "http_request_db_seconds",
+    "Time a request spent running SQL statements, by route",
+    ("method", "route"),
+    LATENCY_BUCKETS,
+)
+REQUEST_SERIALIZATION_SECONDS = Histogram(
+    "http_request_serialization_seconds",
+    "Time a request spent building and encoding its response body, by route",
+    ("method", "route"),
+    LATENCY_BUCKETS,
+)
+QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds",
+    "Time to run one SQL statement, by engine",
+    ("engine",),
+    LATENCY_BUCKETS,
+)
+
+LEADERBOARD_REFRESH_SECONDS = Histogram(
+    "leaderboard_refresh_duration_seconds",
+    "Time to refresh the materialized leaderboard, by kind of refresh and outcome",
+    ("kind", "status"),
+    LATENCY_BUCKETS,
+)
+
+WRITE_BEHIND_FLUSH_SECONDS = Histogram(
+    "write_behind_flush_duration_seconds",
+    "Time to commit one batch of buffered rating writes, by outcome",
+    ("status",),
+    LATENCY_BUCKETS,
+)
+WRITE_BEHIND_BATCH_RATINGS = Histogram(
+    "write_behind_batch_size",
+    "Number of ratings committed by one batch of buffered rating writes",
+    (),
+    BATCH_SIZE_BUCKETS,
+)
+
+HISTOGRAMS = (
+    REQUEST_SECONDS,
+    REQUEST_QUERIES,
+    REQUEST_DB_SECONDS,
+    REQUEST_SERIALIZATION_SECONDS,
+    QUERY_SECONDS,
+    LEADERBOARD_REFRESH_SECONDS,
+    WRITE_BEHIND_FLUSH_SECONDS,
+    WRITE_BEHIND_BATCH_RATINGS,
+)
+
+
+@dataclass
+class RequestStats:
+    queries: int = 0
+    db_seconds: float = 0.0
+    serialization_seconds: float = 0.0
+    statements: list[tuple[str, float]] = field(default_factory=list)
+    # Statements kept for the slow request log
+    max_statements: int = Settings.slow_request_max_statements
+    # Set while a timed serialization runs, so the ones it calls are not counted twice
+    serializing: bool = False
+
+
+# Statistics of the request being handled
+request_stats: ContextVar[Optional[RequestStats]] = ContextVar(
+    "request_stats", default=None
+)
+
+
+# Engines whose statements are already timed
+instrumented_engines: WeakSet[Engine] = WeakSet()
+
+
+def instrument_engine(name: str, engine: Engine | AsyncEngine) -> None:
+    """
+    Time every statement run by an engine, and count it for the request running it
+
+    :param name: name of the engine in the metrics
+    :param engine: sync or async engine
+    """
+    sync_engine = engine.sync_engine if isinstance(engine, AsyncEngine) else engine
+    if sync_engine in instrumented_engines:
+        return
+    instrumented_engines.add(sync_engine)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        conn.info.setdefault("query_started_at", []).append(perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        seconds = perf_counter() - conn.info["query_started_at"].pop()
+        QUERY_SECONDS.observe(seconds, name)
+        stats = request_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += seconds
+            if len(stats.statements) < stats.max_statements:
+                stats.statements.append((statement, seconds))
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(context):
+        # Failed statements never reach after_cursor_execute
+        if context.connection is not None:
+            started_at = context.connection.info.get("query_started_at")
+            if started_at:
+                started_at.pop()
+
+
+def timed_serialization(function: Callable) -> Callable:
+    """
+    Add the time spent in a function building or encoding a response body to the request stats,
+    once when timed functions call each other
+    """
+
+    @wraps(function)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        stats = request_stats.get()
+        if stats is None or stats.serializing:
+            return function(*args, **kwargs)
+        stats.serializing = True
+        start = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stats.serializing = False
+            stats.serialization_seconds += perf_counter() - start
+
+    return wrapper
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording the latency, SQL statements and serialization time of every HTTP
+    request by route, and logging the slow requests with their statements
+    """
+
+    def __init__(
+        self,
+        app,
+        slow_request_seconds: float = Settings.slow_request_seconds,
+        slow_request_max_statements: int = Settings.slow_request_max_statements,
+    ):
+        self.app = app
+        self.slow_request_seconds = slow_request_seconds
+        self.slow_request_max_statements = slow_request_max_statements
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        stats = RequestStats(max_statements=self.slow_request_max_statements)
+        token = request_stats.set(stats)
+        start = perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            seconds = perf_counter() - start
+            request_stats.reset(token)
+            route = scope.get("route")
+            route = getattr(route, "path", None) or "unmatched"
+            method = scope["method"]
+            REQUEST_SECONDS.observe(seconds, method, route, str(status))
+            REQUEST_QUERIES.observe(stats.queries, method, route)
+            REQUEST_DB_SECONDS.observe(stats.db_seconds, method, route)
+            REQUEST_SERIALIZATION_SECONDS.observe(
+                stats.serialization_seconds, method, route
+            )
+            if seconds >= self.slow_request_seconds:
+                log_slow_request(scope, status, seconds, stats)
+
+
+def log_slow_request(scope: dict, status: int, seconds: float, stats: RequestStats):
+    """
+    Log a slow request with its statements, repeated statements (N+1 queries) once with their
+    count and total time
+    """
+    counts, totals = Counter(), Counter()
+    for statement, statement_seconds in stats.statements:
+        statement = " ".join(statement.split())
+        counts[statement] += 1
+        totals[statement] += statement_seconds
+    statements = "".join(
+        f"\n  {counts[statement]}x {totals[statement] * 1000:.1f} ms: {statement}"
+        for statement in sorted(totals, key=totals.get, reverse=True)
+    )
+    if stats.queries > len(stats.statements):
+        statements += f"\n  ... {stats.queries - len(stats.statements)} more statements"
+    query = scope.get("query_string", b"").decode("latin-1")
+    logger.warning(
+        "Slow request %s %s%s -> %s in %.1f ms: %d queries, %.1f ms in the database, "
+        "%.1f ms serializing%s",
+        scope["method"],
+        scope["path"],
+        f"?{query}" if query else "",
+        status,
+        seconds * 1000,
+        stats.queries,
+        stats.db_seconds * 1000,
+        stats.serialization_seconds * 1000,
+        statements,
+    )
+
+
+def render_pool_stats(pools: Iterable[dict]) -> list[str]:
+    """
+    :param pools: statistics of the connection pools, as returned by pool_stats
+    :return: lines of the numeric pool statistics in the Prometheus text format
+    """
+    lines = []
+    for stats in pools:
+        lines.append(
+            f'db_pool_info{{engine="{escape(stats["engine"])}",'
+            f'pool_class="{stats["pool_class"]}"}} 1'
+        )
+        for key, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(
+                    f'db_pool_{key}{{engine="{escape(stats["engine"])}"}} {value}'
+                )
+    return lines
+
+
+def render_metrics(extra: Iterable[str] = ()) -> str:
+    """
+    :param extra: more lines to expose, in the Prometheus text format
+    :return: every metric in the Prometheus text format
+    """
+    lines = [line for histogram in HISTOGRAMS for line in histogram.render()]
+    lines.extend(extra)
+    return "\n".join(lines) + "\n"
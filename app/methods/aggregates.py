@@ -0,0 +1,192 @@
+from typing import Optional
+
+from sqlalchemy import Select, case, delete, desc, func, insert, literal, or_, select
+from sqlalchemy.orm import Session
+
+from app.methods.upsert import upsert_insert
+from app.models.movie import Movie, MovieRatingAggregate, Rating
+
+# Columns of a movie joined with its rating aggregate, labelled like MovieRankingSchema
+MOVIE_RANKING_COLUMNS = (
+    Movie.id,
+    Movie.title,
+    Movie.genre,
+    Movie.year,
+    Movie.runtime,
+    MovieRatingAggregate.avr_rating,
+    MovieRatingAggregate.rating_count,
+)
+
+
+def apply_rating_delta(
+    db: Session,
+    movie_id: int,
+    old_rating: Optional[int],
+    new_rating: Optional[int],
+) -> None:
+    """
+    Update the rating aggregate of a movie for one rating change, in the caller's transaction.
+    An insert has no old rating, a delete has no new rating and an overwrite has both.
+
+    :param db: database session
+    :param movie_id: id of the rated movie
+    :param old_rating: rating before the change, None if the user had not rated the movie
+    :param new_rating: rating after the change, None if the rating was deleted
+    """
+    sum_delta = (new_rating or 0) - (old_rating or 0)
+    count_delta = (new_rating is not None) - (old_rating is not None)
+    apply_rating_deltas(db, {movie_id: (sum_delta, count_delta)})
+
+
+def apply_rating_deltas(db: Session, deltas: dict[int, tuple[int, int]]) -> None:
+    """
+    Add rating sum and count deltas to the aggregates of several movies with one batched upsert,
+    in the caller's transaction. The arithmetic runs inside the database so concurrent changes to
+    the same movie can't overwrite each other.
+
+    :param db: database session
+    :param deltas: (sum delta, count delta) by movie id
+    """
+    rows = [
+        {
+            "movie_id": movie_id,
+            "rating_sum": sum_delta,
+            "rating_count": count_delta,
+            "avr_rating": sum_delta / count_delta if count_delta > 0 else 0,
+        }
+        for movie_id, (sum_delta, count_delta) in deltas.items()
+        if sum_delta or count_delta
+    ]
+    if not rows:
+        return
+
+    aggregates = MovieRatingAggregate.__table__
+    insert_aggregates = upsert_insert(db, aggregates)
+    rating_sum = aggregates.c.rating_sum + insert_aggregates.excluded.rating_sum
+    rating_count = aggregates.c.rating_count + insert_aggregates.excluded.rating_count
+    db.execute(
+        insert_aggregates.on_conflict_do_update(
+            index_elements=[aggregates.c.movie_id],
+            set_={
+                "rating_sum": rating_sum,
+                "rating_count": rating_count,
+                "avr_rating": case(
+                    (rating_count > 0, rating_sum * literal(1.0) / rating_count),
+                    else_=0,
+                ),
+            },
+        ),
+        rows,
+    )
+
+
+def select_actual_aggregates():
+    """
+    Select the rating aggregates of every rated movie computed from the ratings table
+
+    :return: select statement returning movie_id, rating_sum and rating_count
+    """
+    return select(
+        Rating.movie_id,
+        func.sum(Rating.rating).label("rating_sum"),
+        func.count(Rating.rating).label("rating_count"),
+    ).group_by(Rating.movie_id)
+
+
+def check_rating_aggregates(db: Session) -> list[tuple[int, int, int, int, int]]:
+    """
+    Compare the stored rating aggregates with the ones computed from the ratings table
+
+    :param db: database session
+    :return: list of (movie_id, stored sum, stored count, actual sum, actual count) for every
+        movie whose aggregate is wrong or missing
+    """
+    actual = select_actual_aggregates().subquery()
+    missing_or_wrong = (
+        select(
+            actual.c.movie_id,
+            func.coalesce(MovieRatingAggregate.rating_sum, 0),
+            func.coalesce(MovieRatingAggregate.rating_count, 0),
+            actual.c.rating_sum,
+            actual.c.rating_count,
+        )
+        .select_from(actual)
+        .outerjoin(
+            MovieRatingAggregate, MovieRatingAggregate.movie_id == actual.c.movie_id
+        )
+        .where(
+            or_(
+                MovieRatingAggregate.movie_id.is_(None),
+                MovieRatingAggregate.rating_sum != actual.c.rating_sum,
+                MovieRatingAggregate.rating_count != actual.c.rating_count,
+            )
+        )
+    )
+    stale = (
+        select(
+            MovieRatingAggregate.movie_id,
+            MovieRatingAggregate.rating_sum,
+            MovieRatingAggregate.rating_count,
+            literal(0),
+            literal(0),
+        )
+        .outerjoin(actual, MovieRatingAggregate.movie_id == actual.c.movie_id)
+        .where(actual.c.movie_id.is_(None), MovieRatingAggregate.rating_count != 0)
+    )
+    return [tuple(row) for row in db.execute(missing_or_wrong.union_all(stale)).all()]
+
+
+def rebuild_rating_aggregates(db: Session) -> int:
+    """
+    Recompute the rating aggregates of every movie from the ratings table in one set based
+    statement. The caller is responsible for committing the transaction.
+
+    :param db: database session
+    :return: number of aggregate rows written
+    """
+    db.execute(delete(MovieRatingAggregate))
+    actual = select_actual_aggregates().subquery()
+    result = db.execute(
+        insert(MovieRatingAggregate).from_select(
+            ["movie_id", "rating_sum", "rating_count", "avr_rating"],
+            select(
+                actual.c.movie_id,
+                actual.c.rating_sum,
+                actual.c.rating_count,
+                actual.c.rating_sum * literal(1.0) / actual.c.rating_count,
+            ),
+        )
+    )
+    return result.rowcount
+
+
+def select_movie_rankings(
+    min_votes: int = 1, genre: Optional[str] = None, year: Optional[str] = None
+) -> Select:
+    """
+    Select the rated movies best average rating first. The order is the one of the
+    ix_movie_rating_aggregates_ranking index, so a limit stops the index walk after enough
+    matching movies without sorting the aggregates table.
+
+    :param min_votes: minimum number of ratings a movie needs to be ranked
+    :param genre: Optional genre the movies must have (case insensitive)
+    :param year: Optional year the movies must be released in
+    :return: select statement returning rows in MovieRankingSchema shape
+    """
+    query = (
+        select(*MOVIE_RANKING_COLUMNS)
+        .select_from(MovieRatingAggregate)
+        .join(Movie, MovieRatingAggregate.movie_id == Movie.id)
+        .where(MovieRatingAggregate.rating_count >= max(min_votes, 1))
+    )
+
+    if genre is not None:
+        query = query.where(func.lower(Movie.genre) == genre.lower())
+    if year is not None:
+        query = query.where(Movie.year == year)
+
+    return query.order_by(
+        desc(MovieRatingAggregate.avr_rating),
+        desc(MovieRatingAggregate.rating_count),
+        MovieRatingAggregate.movie_id,
+    )
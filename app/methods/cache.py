@@ -0,0 +1,453 @@
+import asyncio
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from threading import Lock
+from time import monotonic, time
+from typing import Any, Awaitable, Callable, Hashable, Iterable, Optional
+from uuid import uuid4
+
+from app.settings import Settings
+
+# Seconds between two lookups of a result another worker is loading
+SINGLE_FLIGHT_POLL_INTERVAL = 0.01
+
+# Invalidation tags of cached query results
+LEADERBOARD_TAG = ("leaderboard",)
+MOVIE_LISTING_TAG = ("movies",)
+# Invalidated by every rating write, the data version of the routes serving ratings
+RATINGS_TAG = ("ratings",)
+
+
+def movie_tag(movie_id: int) -> tuple:
+    """
+    :param movie_id: id of a movie
+    :return: tag of the cached results holding the movie
+    """
+    return ("movie", movie_id)
+
+
+def user_tag(user_id: int) -> tuple:
+    """
+    :param user_id: id of a user
+    :return: tag of the cached results holding the user's ratings
+    """
+    return ("user", user_id)
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    invalidations: int = 0
+
+
+@dataclass
+class DataVersion:
+    """
+    Version of the data served by the API, or of the part of it under some invalidation tags
+    """
+
+    # Opaque version, different for every state of the data
+    tag: str
+    # Unix time of the last change
+    modified_at: float
+
+
+@dataclass
+class CacheEntry:
+    value: Any
+    tags: frozenset
+    expires_at: float
+
+
+class QueryCache:
+    """
+    Size bounded LRU cache of query results with a time to live. Every entry is stored with a set
+    of tags, like the movies and users it holds, so a write can evict exactly the entries it made
+    stale. Results read while an invalidation of one of their tags ran are not stored, so a slow
+    read can't put back data older than the write that invalidated it.
+    """
+
+    def __init__(
+        self,
+        max_size: int = Settings.query_cache_max_size,
+        ttl: float = Settings.query_cache_ttl,
+        clock: Callable[[], float] = monotonic,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries: OrderedDict[Hashable, CacheEntry] = OrderedDict()
+        self.keys_by_tag: dict[Hashable, set[Hashable]] = {}
+        self.stats = CacheStats()
+        self.lock = Lock()
+        # Sequence number of the last invalidation, overall and by tag
+        self.sequence = 0
+        self.invalidated_at: dict[Hashable, int] = {}
+        # Results read before this sequence number are never stored
+        self.min_token = 0
+
+    def get(self, key: Hashable) -> tuple[bool, Any]:
+        """
+        Look up a cached result and mark it as recently used
+
+        :param key: normalized query key
+        :return: (True, result) on a hit, (False, None) on a miss
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.expires_at <= self.clock():
+                self._remove(key)
+                self.stats.expirations += 1
+                entry = None
+            if entry is None:
+                self.stats.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.stats.hits += 1
+            return True, entry.value
+
+    def token(self) -> int:
+        """
+        Take a token before reading a result from the database, to pass to `set`
+
+        :return: current invalidation sequence number
+        """
+        with self.lock:
+            return self.sequence
+
+    def version(self, tags: Iterable[Hashable] = ()) -> int:
+        """
+        :param tags: invalidation tags
+        :return: sequence number of the last invalidation of one of the tags, of any invalidation
+            when no tag is given
+        """
+        with self.lock:
+            return max(
+                (self.invalidated_at.get(tag, self.min_token) for tag in tags),
+                default=self.sequence,
+            )
+
+    def set(self, key: Hashable, value: Any, tags: Iterable, token: int) -> bool:
+        """
+        Store a result, evicting the least recently used entries when the cache is full
+
+        :param key: normalized query key
+        :param value: result to store
+        :param tags: invalidation tags of the result
+        :param token: token taken before the result was read
+        :return: True if the result was stored, False if it may already be stale
+        """
+        tags = frozenset(tags)
+        with self.lock:
+            if token < self.min_token or any(
+                self.invalidated_at.get(tag, -1) > token for tag in tags
+            ):
+                return False
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = CacheEntry(value, tags, self.clock() + self.ttl)
+            for tag in tags:
+                self.keys_by_tag.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+                self.stats.evictions += 1
+            return True
+
+    def invalidate(self, *tags: Hashable) -> int:
+        """
+        Evict every entry stored with one of the given tags
+
+        :param tags: invalidation tags
+        :return: number of entries evicted
+        """
+        with self.lock:
+            self.sequence += 1
+            keys = set()
+            for tag in tags:
+                self.invalidated_at[tag] = self.sequence
+                keys |= self.keys_by_tag.get(tag, set())
+            for key in keys:
+                self._remove(key)
+            self.stats.invalidations += len(keys)
+            # Forget old invalidations once there are many, refusing every result read before
+            if len(self.invalidated_at) > 4 * self.max_size:
+                self.invalidated_at.clear()
+                self.min_token = self.sequence
+            return len(keys)
+
+    def clear(self) -> None:
+        """
+        Evict every entry and reset the statistics
+        """
+        with self.lock:
+            self.sequence += 1
+            self.min_token = self.sequence
+            self.entries.clear()
+            self.keys_by_tag.clear()
+            self.invalidated_at.clear()
+            self.stats = CacheStats()
+
+    def get_stats(self) -> dict:
+        """
+        :return: hit, miss, eviction, expiration and invalidation counts and the current size
+        """
+        with self.lock:
+            return {**asdict(self.stats), "size": len(self.entries)}
+
+    def _remove(self, key: Hashable) -> None:
+        """
+        Remove an entry and its tag references, the lock must be held
+
+        :param key: key of the entry
+        """
+        entry = self.entries.pop(key)
+        for tag in entry.tags:
+            keys = self.keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_tag[tag]
+
+
+class CacheBackend:
+    """
+    Interface of the query cache used by AsyncCrud. Results are loaded through `get_or_load`,
+    which only lets one request per key run the query when the key is missing: concurrent
+    requests of the same process wait for its result, and backends shared between processes also
+    make other processes wait through `acquire`/`release`.
+    """
+
+    name = "none"
+    # Whether every process sees the same results and data version
+    shared = False
+
+    def __init__(
+        self,
+        enabled: bool = Settings.query_cache_enabled,
+        single_flight_timeout: float = Settings.query_cache_single_flight_timeout,
+    ):
+        self.enabled = enabled
+        self.single_flight_timeout = single_flight_timeout
+        self.flights: dict[Hashable, asyncio.Future] = {}
+
+    async def get(self, key: Hashable, record: bool = True) -> tuple[bool, Any]:
+        """
+        Look up a cached result
+
+        :param key: normalized query key
+        :param record: whether to count the lookup as a hit or miss
+        :return: (True, result) on a hit, (False, None) on a miss
+        """
+        raise NotImplementedError
+
+    async def token(self) -> Any:
+        """
+        Take a token before reading a result from the database, to pass to `set`
+
+        :return: token identifying the invalidations that already ran
+        """
+        raise NotImplementedError
+
+    async def set(self, key: Hashable, value: Any, tags: Iterable, token: Any) -> bool:
+        """
+        Store a result unless one of its tags was invalidated since the token was taken
+
+        :param key: normalized query key
+        :param value: result to store
+        :param tags: invalidation tags of the result
+        :param token: token taken before the result was read
+        :return: True if the result was stored
+        """
+        raise NotImplementedError
+
+    async def invalidate(self, *tags: Hashable) -> int:
+        """
+        Evict every result stored with one of the given tags
+
+        :param tags: invalidation tags
+        :return: number of results evicted, where the backend knows it
+        """
+        raise NotImplementedError
+
+    async def clear(self) -> None:
+        """
+        Evict every result and reset the statistics
+        """
+        raise NotImplementedError
+
+    async def get_stats(self) -> dict:
+        """
+        :return: hit, miss, eviction, expiration and invalidation counts and the current size
+        """
+        raise NotImplementedError
+
+    async def data_version(self, *tags: Hashable) -> Optional[DataVersion]:
+        """
+        Get the version of the data, bumped by every invalidation of one of the given tags, or by
+        every invalidation when no tag is given
+
+        :param tags: invalidation tags of the data
+        :return: current data version, None if it is not available
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """
+        Release what the backend holds besides its results, like connections and threads
+        """
+
+    async def acquire(self, key: Hashable) -> bool:
+        """
+        Take the right to load a missing result, for backends shared between processes
+
+        :param key: normalized query key
+        :return: True if this process should load the result, False if another one already is
+        """
+        return True
+
+    async def release(self, key: Hashable) -> None:
+        """
+        Give up the right to load a result taken by `acquire`
+
+        :param key: normalized query key
+        """
+
+    async def get_or_load(
+        self,
+        key: Hashable,
+        load: Callable[[], Awaitable[Any]],
+        tags: Callable[[Any], Iterable],
+    ) -> Any:
+        """
+        Get a cached result, or load and store it. Only one load per key runs at a time.
+
+        :param key: normalized query key
+        :param load: coroutine function loading the result from the database
+        :param tags: function returning the invalidation tags of a result
+        :return: cached or loaded result
+        """
+        found, value = await self.get(key)
+        if found:
+            return value
+        flight = self.flights.get(key)
+        if flight is not None:
+            return await asyncio.shield(flight)
+
+        flight = asyncio.get_running_loop().create_future()
+        flight.add_done_callback(lambda done: done.cancelled() or done.exception())
+        self.flights[key] = flight
+        try:
+            value = await self._load(key, load, tags)
+        except BaseException as error:
+            flight.set_exception(error)
+            raise
+        else:
+            flight.set_result(value)
+            return value
+        finally:
+            del self.flights[key]
+
+    async def _load(
+        self,
+        key: Hashable,
+        load: Callable[[], Awaitable[Any]],
+        tags: Callable[[Any], Iterable],
+    ) -> Any:
+        """
+        Load and store a result, or wait for the process already loading it
+
+        :param key: normalized query key
+        :param load: coroutine function loading the result from the database
+        :param tags: function returning the invalidation tags of a result
+        :return: loaded result
+        """
+        if not await self.acquire(key):
+            polls = int(self.single_flight_timeout / SINGLE_FLIGHT_POLL_INTERVAL)
+            for _ in range(polls):
+                await asyncio.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+                found, value = await self.get(key, record=False)
+                if found:
+                    return value
+            return await load()
+        try:
+            token = await self.token()
+            value = await load()
+            await self.set(key, value, tags(value), token)
+            return value
+        finally:
+            await self.release(key)
+
+
+class MemoryCacheBackend(CacheBackend):
+    """
+    Query cache kept in the memory of one process
+    """
+
+    name = "memory"
+
+    def __init__(
+        self,
+        max_size: int = Settings.query_cache_max_size,
+        ttl: float = Settings.query_cache_ttl,
+        enabled: bool = Settings.query_cache_enabled,
+        single_flight_timeout: float = Settings.query_cache_single_flight_timeout,
+    ):
+        super().__init__(enabled, single_flight_timeout)
+        self.cache = QueryCache(max_size, ttl)
+        # Versions restart with the process, the epoch keeps them apart from older ones
+        self.epoch = uuid4().hex[:8]
+        self.modified_at = time()
+
+    async def get(self, key: Hashable, record: bool = True) -> tuple[bool, Any]:
+        return self.cache.get(key)
+
+    async def token(self) -> int:
+        return self.cache.token()
+
+    async def set(self, key: Hashable, value: Any, tags: Iterable, token: int) -> bool:
+        return self.cache.set(key, value, tags, token)
+
+    async def invalidate(self, *tags: Hashable) -> int:
+        self.modified_at = time()
+        return self.cache.invalidate(*tags)
+
+    async def clear(self) -> None:
+        self.modified_at = time()
+        self.cache.clear()
+
+    async def data_version(self, *tags: Hashable) -> DataVersion:
+        # The time of the last change is only kept overall, it may be later than the tags' one
+        return DataVersion(f"{self.epoch}-{self.cache.version(tags)}", self.modified_at)
+
+    async def get_stats(self) -> dict:
+        return self.cache.get_stats()
+
+
+def create_query_cache(settings: Settings) -> CacheBackend:
+    """
+    Create the query cache backend configured for this process, by the app lifespan
+
+    :param settings: settings of the application, a shared cache when query_cache_url is set and
+        a per process cache otherwise
+    :return: cache backend
+    """
+    if settings.query_cache_url:
+        from app.methods.redis_cache import RedisCacheBackend
+
+        return RedisCacheBackend.from_url(
+            settings.query_cache_url,
+            ttl=settings.query_cache_ttl,
+            local_ttl=settings.query_cache_local_ttl,
+            local_max_size=settings.query_cache_max_size,
+            enabled=settings.query_cache_enabled,
+            single_flight_timeout=settings.query_cache_single_flight_timeout,
+        )
+    return MemoryCacheBackend(
+        settings.query_cache_max_size,
+        settings.query_cache_ttl,
+        settings.query_cache_enabled,
+        settings.query_cache_single_flight_timeout,
+    )
@@ -0,0 +1,513 @@
+import asyncio
+import logging
+from collections import namedtuple
+from dataclasses import dataclass
+from itertools import chain, count
+from time import monotonic
+from typing import Iterable, Optional
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from app.database import Database
+from app.models.movie import Movie, Rating
+from app.schemas.base import MovieRankingSchema, MovieSchema
+from app.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+# Ratings fetched from the database per batch while loading
+LOAD_BATCH_SIZE = 100_000
+
+# Rows returned by the engine, shaped like the rows of the matching SQL queries
+RatingRow = namedtuple("RatingRow", list(MovieSchema.model_fields))
+RankingRow = namedtuple("RankingRow", list(MovieRankingSchema.model_fields))
+
+
+@dataclass(frozen=True)
+class RatingsMatrix:
+    """
+    Immutable snapshot of every rating in two compressed sparse row layouts.
+
+    Users and movies are numbered by their position in the sorted `user_ids` and `movie_ids`, so
+    the movie index order is the movie id order. The ratings of user u are
+    `user_movies[user_indptr[u]:user_indptr[u + 1]]` (movie indexes, ascending) with their values
+    in `user_ratings` at the same positions, and likewise by movie with `movie_users` and
+    `movie_ratings`. Each rating takes 10 bytes: a 4 byte index and a 1 byte value in each layout.
+    Every user adds 12 bytes (id and row pointer), and every movie its row pointer, rating totals
+    and catalog columns.
+    """
+
+    user_ids: np.ndarray  # int32, sorted
+    user_indptr: np.ndarray  # int64, one more than the users
+    user_movies: np.ndarray  # int32 movie indexes
+    user_ratings: np.ndarray  # int8
+    movie_ids: np.ndarray  # int32, sorted
+    movie_indptr: np.ndarray  # int64, one more than the movies
+    movie_users: np.ndarray  # int32 user indexes
+    movie_ratings: np.ndarray  # int8
+    rating_sums: np.ndarray  # int64 by movie index
+    rating_counts: np.ndarray  # int64 by movie index
+    # Catalog columns by movie index, genres and years also as codes for vectorized filters
+    catalog: list[tuple]
+    genre_codes: np.ndarray  # int32 by movie index, -1 without genre
+    genre_index: dict[str, int]
+    year_codes: np.ndarray  # int32 by movie index, -1 without year
+    year_index: dict[str, int]
+    # Whether the database rounds averages half to even (Postgres) rather than away from zero
+    round_half_even: bool = False
+
+    @property
+    def size(self) -> int:
+        return len(self.user_movies)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        :return: bytes held by the arrays, the catalog columns excluded
+        """
+        return sum(
+            value.nbytes
+            for value in vars(self).values()
+            if isinstance(value, np.ndarray)
+        )
+
+    def movie_index(self, movie_id: int) -> Optional[int]:
+        index = int(np.searchsorted(self.movie_ids, movie_id))
+        if index < len(self.movie_ids) and self.movie_ids[index] == movie_id:
+            return index
+        return None
+
+    def user_row(self, user_id: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        :return: movie indexes and ratings of a user, empty for an unknown user
+        """
+        index = int(np.searchsorted(self.user_ids, user_id))
+        if index == len(self.user_ids) or self.user_ids[index] != user_id:
+            return self.user_movies[:0], self.user_ratings[:0]
+        start, end = self.user_indptr[index], self.user_indptr[index + 1]
+        return self.user_movies[start:end], self.user_ratings[start:end]
+
+    def rating(self, user_id: int, movie_index: int) -> Optional[int]:
+        movies, ratings = self.user_row(user_id)
+        position = int(np.searchsorted(movies, movie_index))
+        if position < len(movies) and movies[position] == movie_index:
+            return int(ratings[position])
+        return None
+
+
+def codes(values: list[Optional[str]]) -> tuple[np.ndarray, dict[str, int]]:
+    """
+    :param values: value of every movie
+    :return: code of every movie (-1 for None) and the code of every distinct value
+    """
+    index: dict[str, int] = {}
+    return (
+        np.array(
+            [
+                -1 if value is None else index.setdefault(value, len(index))
+                for value in values
+            ],
+            dtype=np.int32,
+        ),
+        index,
+    )
+
+
+def build_matrix(
+    user_ids: np.ndarray,
+    movie_ids: np.ndarray,
+    ratings: np.ndarray,
+    catalog: list[tuple],
+    round_half_even: bool = False,
+) -> RatingsMatrix:
+    """
+    Build both layouts from unordered ratings, with vectorized sorts only
+
+    :param user_ids: user id of every rating
+    :param movie_ids: movie id of every rating, each one in the catalog
+    :param ratings: value of every rating
+    :param catalog: (id, title, genre, year, runtime) of every movie, by ascending id
+    :param round_half_even: whether averages are rounded like Postgres does
+    :return: ratings matrix
+    """
+    catalog_ids = np.array([movie[0] for movie in catalog], dtype=np.int32)
+    users, user_index = np.unique(
+        np.asarray(user_ids, dtype=np.int32), return_inverse=True
+    )
+    movie_index = np.searchsorted(catalog_ids, np.asarray(movie_ids, dtype=np.int32))
+    ratings = np.asarray(ratings, dtype=np.int8)
+
+    by_user = np.lexsort((movie_index, user_index))
+    by_movie = np.lexsort((user_index, movie_index))
+    user_counts = np.bincount(user_index, minlength=len(users))
+    movie_counts = np.bincount(movie_index, minlength=len(catalog_ids))
+    genre_codes, genre_index = codes(
+        [(movie[2] or "").lower() or None for movie in catalog]
+    )
+    year_codes, year_index = codes([movie[3] for movie in catalog])
+    return RatingsMatrix(
+        user_ids=users.astype(np.int32),
+        user_indptr=np.concatenate(([0], np.cumsum(user_counts))).astype(np.int64),
+        user_movies=movie_index[by_user].astype(np.int32),
+        user_ratings=ratings[by_user],
+        movie_ids=catalog_ids,
+        movie_indptr=np.concatenate(([0], np.cumsum(movie_counts))).astype(np.int64),
+        movie_users=user_index[by_movie].astype(np.int32),
+        movie_ratings=ratings[by_movie],
+        rating_sums=np.bincount(
+            movie_index, weights=ratings, minlength=len(catalog_ids)
+        ).astype(np.int64),
+        rating_counts=movie_counts.astype(np.int64),
+        catalog=[tuple(movie) for movie in catalog],
+        genre_codes=genre_codes,
+        genre_index=genre_index,
+        year_codes=year_codes,
+        year_index=year_index,
+        round_half_even=round_half_even,
+    )
+
+
+def load_matrix(db: Session, batch_size: int = LOAD_BATCH_SIZE) -> RatingsMatrix:
+    """
+    Load the movie catalog and every rating from the database
+
+    :param db: database session
+    :param batch_size: number of ratings fetched at a time
+    :return: ratings matrix
+    """
+    catalog = db.execute(
+        select(Movie.id, Movie.title, Movie.genre, Movie.year, Movie.runtime).order_by(
+            Movie.id
+        )
+    ).all()
+    result = db.execute(
+        select(Rating.user_id, Rating.movie_id, Rating.rating).execution_options(
+            yield_per=batch_size
+        )
+    )
+    # fromiter reads the flattened rows much faster than np.array builds them from row objects
+    batches = [
+        np.fromiter(chain.from_iterable(rows), np.int32, len(rows) * 3).reshape(-1, 3)
+        for rows in result.partitions()
+    ]
+    ratings = np.concatenate(batches) if batches else np.empty((0, 3), np.int32)
+    return build_matrix(
+        ratings[:, 0],
+        ratings[:, 1],
+        ratings[:, 2],
+        catalog,
+        db.get_bind().dialect.name == "postgresql",
+    )
+
+
+def merge_matrix(
+    matrix: RatingsMatrix, changes: dict[tuple[int, int], Optional[int]]
+) -> RatingsMatrix:
+    """
+    Build a new matrix with rating changes applied
+
+    :param matrix: current matrix
+    :param changes: new rating by (user id, movie id), None for a deleted rating
+    :return: new matrix
+    """
+    user_ids = np.repeat(matrix.user_ids, np.diff(matrix.user_indptr))
+    movie_ids = matrix.movie_ids[matrix.user_movies]
+    changed = np.array(list(changes), dtype=np.int64).reshape(-1, 2)
+    # Drop the old value of every changed rating, then add the new values
+    keys = user_ids.astype(np.int64) << 32 | movie_ids
+    keep = ~np.isin(keys, changed[:, 0] << 32 | changed[:, 1])
+    added = [(key, rating) for key, rating in changes.items() if rating is not None]
+    return build_matrix(
+        np.concatenate((user_ids[keep], [key[0] for key, _ in added])),
+        np.concatenate((movie_ids[keep], [key[1] for key, _ in added])),
+        np.concatenate((matrix.user_ratings[keep], [rating for _, rating in added])),
+        matrix.catalog,
+        matrix.round_half_even,
+    )
+
+
+class ColumnarEngine:
+    """
+    In-memory ratings engine answering the rankings, the top ratings of a user and the movie
+    averages without querying the database.
+
+    The ratings are held in a RatingsMatrix. Rating writes of this worker are applied at once:
+    the rating totals of the movies are updated in place, and the new values are kept beside the
+    matrix until enough accumulated to merge them into a new matrix, built in a thread while the
+    current one keeps serving reads. The matrix is reloaded from the database at an interval to
+    pick up the writes of other workers and catalog changes.
+    """
+
+    def __init__(
+        self,
+        reload_interval: float = Settings.columnar_reload_interval,
+        merge_threshold: int = Settings.columnar_merge_threshold,
+    ):
+        self.reload_interval = reload_interval
+        self.merge_threshold = merge_threshold
+        self.matrix: Optional[RatingsMatrix] = None
+        self.rating_sums: Optional[np.ndarray] = None
+        self.rating_counts: Optional[np.ndarray] = None
+        # (rating, sequence number of the write) by movie id, by user id
+        self.pending: dict[int, dict[int, tuple[Optional[int], int]]] = {}
+        self.pending_count = 0
+        self.sequence = count(1)
+        self.last_sequence = 0
+        # Set when a write rated a movie missing from the catalog, reloaded as soon as possible
+        self.catalog_stale = False
+        self.wake = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.matrix is not None
+
+    @property
+    def bytes_per_rating(self) -> float:
+        """
+        :return: bytes of the matrix arrays and rating totals per loaded rating
+        """
+        if not self.matrix or not self.matrix.size:
+            return 0.0
+        totals = self.rating_sums.nbytes + self.rating_counts.nbytes
+        return (self.matrix.nbytes + totals) / self.matrix.size
+
+    def install(self, matrix: RatingsMatrix, since: int = 0) -> None:
+        """
+        Serve a new matrix, applying again the pending writes it may not include
+
+        :param matrix: new matrix
+        :param since: sequence number of the last write the matrix is known to include
+        """
+        later = [
+            (user_id, movie_id, rating, sequence)
+            for user_id, ratings in self.pending.items()
+            for movie_id, (rating, sequence) in ratings.items()
+            if sequence > since
+        ]
+        self.matrix = matrix
+        self.rating_sums = matrix.rating_sums.copy()
+        self.rating_counts = matrix.rating_counts.copy()
+        self.pending, self.pending_count = {}, 0
+        for user_id, movie_id, rating, sequence in later:
+            self._set(user_id, movie_id, rating, sequence)
+
+    def rating(self, user_id: int, movie_id: int) -> Optional[int]:
+        """
+        :return: current rating of a movie by a user, None if the user did not rate it
+        """
+        pending = self.pending.get(user_id, {}).get(movie_id)
+        if pending is not None:
+            return pending[0]
+        movie_index = self.matrix.movie_index(movie_id)
+        if movie_index is None:
+            return None
+        return self.matrix.rating(user_id, movie_index)
+
+    def _set(
+        self, user_id: int, movie_id: int, rating: Optional[int], sequence: int
+    ) -> None:
+        movie_index = self.matrix.movie_index(movie_id)
+        if movie_index is None:
+            self.catalog_stale = True
+            self.wake.set()
+            return
+        old_rating = self.rating(user_id, movie_id)
+        self.rating_sums[movie_index] += (rating or 0) - (old_rating or 0)
+        self.rating_counts[movie_index] += (rating is not None) - (
+            old_rating is not None
+        )
+        ratings = self.pending.setdefault(user_id, {})
+        self.pending_count += movie_id not in ratings
+        ratings[movie_id] = (rating, sequence)
+
+    def apply(self, changes: Iterable[tuple[int, int, Optional[int]]]) -> None:
+        """
+        Apply committed rating writes
+
+        :param changes: (user id, movie id, new rating) of every write, None for a deletion
+        """
+        if not self.ready:
+            return
+        for user_id, movie_id, rating in changes:
+            self.last_sequence = next(self.sequence)
+            self._set(user_id, movie_id, rating, self.last_sequence)
+        if self.pending_count >= self.merge_threshold:
+            self.wake.set()
+
+    def movie_average(self, movie_id: int) -> Optional[float]:
+        """
+        :return: average rating of a movie, None if it has no ratings
+        """
+        movie_index = self.matrix.movie_index(movie_id)
+        if movie_index is None or not self.rating_counts[movie_index]:
+            return None
+        return float(self.rating_sums[movie_index] / self.rating_counts[movie_index])
+
+    def top_movies(
+        self,
+        k: int = 5,
+        min_votes: int = 1,
+        genre: Optional[str] = None,
+        year: Optional[str] = None,
+    ) -> list[RankingRow]:
+        """
+        Rank the top k movies by average rating, ties broken by vote count then movie id like the
+        SQL ranking. Only the movies whose average reaches the k-th best are sorted.
+
+        :param k: number of movies to return
+        :param min_votes: minimum number of ratings a movie needs to be ranked
+        :param genre: Optional genre the movies must have (case insensitive)
+        :param year: Optional year the movies must be released in
+        :return: rows shaped like the rows of Crud.get_top_movie_rankings
+        """
+        matrix, counts = self.matrix, self.rating_counts
+        mask = counts >= max(min_votes, 1)
+        for value, index, movie_codes in (
+            (genre and genre.lower(), matrix.genre_index, matrix.genre_codes),
+            (year, matrix.year_index, matrix.year_codes),
+        ):
+            if value is not None:
+                if value not in index:
+                    return []
+                mask &= movie_codes == index[value]
+        candidates = np.flatnonzero(mask)
+        averages = self.rating_sums[candidates] / counts[candidates]
+        if len(candidates) > k:
+            kth_best = np.partition(averages, len(candidates) - k)[len(candidates) - k]
+            best = averages >= kth_best
+            candidates, averages = candidates[best], averages[best]
+        order = np.lexsort((candidates, -counts[candidates], -averages))[:k]
+        return [
+            RankingRow(
+                *matrix.catalog[candidates[i]],
+                float(averages[i]),
+                int(counts[candidates[i]]),
+            )
+            for i in order
+        ]
+
+    def user_top_ratings(self, user_id: int, k: int = 5) -> list[RatingRow]:
+        """
+        Return the k highest ratings of a user, ties broken by movie id like the SQL query
+
+        :param user_id: id of the user
+        :param k: number of ratings to return
+        :return: rows shaped like the rows of Crud.get_user_ratings_page
+        """
+        matrix = self.matrix
+        movie_indexes, ratings = matrix.user_row(user_id)
+        pending = self.pending.get(user_id)
+        if pending:
+            current = dict(zip(movie_indexes.tolist(), ratings.tolist()))
+            for movie_id, (rating, _) in pending.items():
+                movie_index = matrix.movie_index(movie_id)
+                if rating is None:
+                    current.pop(movie_index, None)
+                elif movie_index is not None:
+                    current[movie_index] = rating
+            movie_indexes = np.fromiter(sorted(current), dtype=np.int32)
+            ratings = np.array([current[i] for i in movie_indexes.tolist()], np.int8)
+        # The row is in movie order, a stable sort keeps it for equal ratings
+        top = np.argsort(-ratings.astype(np.int16), kind="stable")[:k]
+        rows = []
+        for i in top:
+            movie_index = movie_indexes[i]
+            movie_id, title, genre, year, runtime = matrix.catalog[movie_index]
+            votes = self.rating_counts[movie_index]
+            average = self.rating_sums[movie_index] / votes if votes else 0
+            if matrix.round_half_even:
+                average = round(average)
+            else:
+                average = int(np.floor(average + 0.5))
+            rows.append(
+                RatingRow(
+                    movie_id,
+                    user_id,
+                    title,
+                    genre,
+                    year,
+                    runtime,
+                    int(ratings[i]),
+                    average,
+                )
+            )
+        return rows
+
+    async def load(self, database: Database) -> None:
+        """
+        Load the matrix from the database in a thread
+        """
+        since = self.last_sequence
+
+        def load_from_database() -> RatingsMatrix:
+            with database.SessionLocal() as db:
+                return load_matrix(db)
+
+        self.catalog_stale = False
+        self.install(await asyncio.to_thread(load_from_database), since)
+        logger.info(
+            "Columnar engine loaded %d ratings, %.1f bytes per rating",
+            self.matrix.size,
+            self.bytes_per_rating,
+        )
+
+    async def merge(self) -> None:
+        """
+        Merge the pending writes into a new matrix, built in a thread
+        """
+        since = self.last_sequence
+        changes = {
+            (user_id, movie_id): rating
+            for user_id, ratings in self.pending.items()
+            for movie_id, (rating, _) in ratings.items()
+        }
+        self.install(await asyncio.to_thread(merge_matrix, self.matrix, changes), since)
+
+    async def run(self, database: Database) -> None:
+        """
+        Load the matrix once the first request prepared the schema, then reload it every
+        interval and merge the pending writes whenever they reach the threshold
+        """
+        while not database.schema_ready:
+            await asyncio.sleep(0.5)
+        reload_at = monotonic()
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self.wake.wait(), max(reload_at - monotonic(), 0)
+                )
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            try:
+                if monotonic() >= reload_at or self.catalog_stale:
+                    reload_at = monotonic() + self.reload_interval
+                    await self.load(database)
+                elif self.pending_count >= self.merge_threshold:
+                    await self.merge()
+            except (SQLAlchemyError, OSError) as error:
+                logger.warning("Columnar engine load failed: %s", error)
+
+    def start(self, database: Database) -> None:
+        """
+        Start loading the matrix in the background, in the running event loop
+        """
+        self.wake = asyncio.Event()
+        self.task = asyncio.create_task(self.run(database))
+
+    async def stop(self) -> None:
+        """
+        Stop the background loads and merges
+        """
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
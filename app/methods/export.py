@@ -0,0 +1,62 @@
+import csv
+import io
+from typing import Iterable, Literal, Optional, Sequence, Type
+
+import orjson
+from pydantic import BaseModel
+from sqlalchemy import Row
+
+from app.instrumentation import timed_serialization
+from app.methods.fast_json import encode_default, rows_to_dicts
+
+ExportFormat = Literal["ndjson", "csv"]
+
+EXPORT_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+@timed_serialization
+def encode_ndjson(
+    rows: Sequence[Row],
+    schema: Type[BaseModel],
+    fields: Optional[Iterable[str]] = None,
+) -> bytes:
+    """
+    Encode a batch of rows as newline delimited JSON, one object per row, typed like the schema
+
+    :param rows: rows to encode
+    :param schema: schema whose fields (and field order) every object follows
+    :param fields: Optional fields to write, all fields of the schema by default
+    :return: encoded batch
+    """
+    return b"".join(
+        orjson.dumps(item, default=encode_default, option=orjson.OPT_APPEND_NEWLINE)
+        for item in rows_to_dicts(rows, schema, fields)
+    )
+
+
+@timed_serialization
+def encode_csv(
+    rows: Sequence[Row],
+    schema: Type[BaseModel],
+    fields: Optional[Iterable[str]] = None,
+    header: bool = False,
+) -> bytes:
+    """
+    Encode a batch of rows as CSV, with the values typed like the schema
+
+    :param rows: rows to encode
+    :param schema: schema whose fields (and field order) give the columns
+    :param fields: Optional fields to write, all fields of the schema by default
+    :param header: whether to write the header line first
+    :return: encoded batch
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        keep = set(schema.model_fields if fields is None else fields)
+        writer.writerow([field for field in schema.model_fields if field in keep])
+    writer.writerows(item.values() for item in rows_to_dicts(rows, schema, fields))
+    return buffer.getvalue().encode()
@@ -0,0 +1,101 @@
+from decimal import Decimal
+from typing import Any, Iterable, Optional, Sequence, Type
+
+import orjson
+from fastapi import Response
+from pydantic import BaseModel
+from sqlalchemy import Row
+
+from app.instrumentation import timed_serialization
+
+# Conversions from column values to the types of the response schemas, for columns whose database
+# type differs from the schema type. Every other column is written as selected.
+FIELD_CONVERTERS = {"year": int}
+
+
+class RawJSONResponse(Response):
+    """
+    Response whose content is already encoded JSON
+    """
+
+    media_type = "application/json"
+
+
+def encode_default(value: Any) -> Any:
+    """
+    Encode values orjson has no native support for
+
+    :param value: value to encode
+    :return: JSON compatible value
+    """
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+@timed_serialization
+def rows_to_dicts(
+    rows: Sequence[Row],
+    schema: Type[BaseModel],
+    fields: Optional[Iterable[str]] = None,
+) -> list[dict]:
+    """
+    Turn rows into dictionaries shaped like a response schema, without building the schema. The
+    columns are typed by the query, so only the fields in FIELD_CONVERTERS are converted.
+
+    :param rows: rows to convert, with a column for every field
+    :param schema: schema whose fields (and field order) the dictionaries follow
+    :param fields: Optional fields to keep, all fields of the schema by default
+    :return: list of dictionaries
+    """
+    if not rows:
+        return []
+    keep = set(schema.model_fields if fields is None else fields)
+    columns = rows[0]._fields
+    specs = [
+        (field, columns.index(field), FIELD_CONVERTERS.get(field))
+        for field in schema.model_fields
+        if field in keep
+    ]
+    if all(converter is None for _, _, converter in specs):
+        return [{field: row[index] for field, index, _ in specs} for row in rows]
+
+    dicts = []
+    for row in rows:
+        values = [row[index] for _, index, _ in specs]
+        dicts.append(
+            {
+                field: (
+                    value if converter is None or value is None else converter(value)
+                )
+                for (field, _, converter), value in zip(specs, values)
+            }
+        )
+    return dicts
+
+
+@timed_serialization
+def json_response(
+    content: Any, response: Optional[Response] = None, status_code: int = 200
+) -> RawJSONResponse:
+    """
+    Encode response content with orjson, skipping the validation and serialization FastAPI runs
+    for the response model
+
+    :param content: JSON compatible content, in the shape of the route's response model
+    :param response: Optional response passed to the route, whose headers are kept
+    :param status_code: HTTP status of the response
+    :return: JSON response
+    """
+    headers = None
+    if response is not None:
+        headers = {
+            name: value
+            for name, value in response.headers.items()
+            if name != "content-length"
+        }
+    return RawJSONResponse(
+        orjson.dumps(content, default=encode_default),
+        status_code=status_code,
+        headers=headers,
+    )
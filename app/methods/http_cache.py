@@ -0,0 +1,101 @@
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Callable, Hashable, Iterable, Optional
+
+from fastapi import Depends, HTTPException, Request, Response
+
+from app.database import get_query_cache
+from app.methods.cache import CacheBackend, DataVersion
+from app.settings import Settings
+
+
+def make_etag(version: DataVersion) -> str:
+    """
+    :param version: data version
+    :return: weak ETag of every representation of the data at this version
+    """
+    return f'W/"{version.tag}"'
+
+
+def is_not_modified(request: Request, etag: str, modified_at: float) -> bool:
+    """
+    Check the conditional headers of a GET request. If-Modified-Since is only used without
+    If-None-Match, and only a change strictly after the given time counts as a modification.
+
+    :param request: incoming request
+    :param etag: current ETag
+    :param modified_at: Unix time of the last change
+    :return: True if the client's copy is current
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        client_etags = {
+            tag.strip().removeprefix("W/") for tag in if_none_match.split(",")
+        }
+        return "*" in client_etags or etag.removeprefix("W/") in client_etags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            return False
+        return modified_at <= since.timestamp()
+    return False
+
+
+def route_cache_control(settings: Settings, route_name: str) -> str:
+    """
+    :param settings: settings of the application
+    :param route_name: name of the route
+    :return: Cache-Control of the route, CACHE_CONTROL_<ROUTE NAME> or CACHE_CONTROL
+    """
+    return settings.route_cache_control.get(route_name, settings.cache_control)
+
+
+def conditional_get(
+    route_name: str,
+    cache_control: Optional[str] = None,
+    tags: Iterable[Hashable] = (),
+) -> Callable:
+    """
+    Create a dependency answering conditional GET requests of a read endpoint from the data
+    version of the query cache. A client holding the current version gets a 304 before the
+    endpoint runs any query, other responses get ETag, Last-Modified and Cache-Control headers.
+    The data version of a per process cache only changes with the writes of its own worker, so
+    validators are only sent when the query cache is shared.
+
+    :param route_name: name of the route, used to look up its Cache-Control in the settings
+    :param cache_control: Cache-Control of the route, from the settings of the app by default
+    :param tags: invalidation tags of the data the route serves, so only their invalidations
+        change its version, any invalidation by default
+    :return: route dependency
+    """
+    tags = tuple(tags)
+
+    async def check_not_modified(
+        request: Request,
+        response: Response,
+        query_cache: CacheBackend = Depends(get_query_cache),
+    ) -> None:
+        if not query_cache.shared:
+            return
+        version = await query_cache.data_version(*tags)
+        if version is None:
+            return
+        etag = make_etag(version)
+        headers = {
+            "ETag": etag,
+            "Last-Modified": format_datetime(
+                datetime.fromtimestamp(int(version.modified_at), timezone.utc),
+                usegmt=True,
+            ),
+            "Cache-Control": cache_control
+            or route_cache_control(request.app.state.settings, route_name),
+        }
+        if is_not_modified(request, etag, version.modified_at):
+            raise HTTPException(status_code=304, headers=headers)
+        response.headers.update(headers)
+
+    return check_not_modified
@@ -0,0 +1,367 @@
+import asyncio
+import logging
+from functools import partial
+from time import monotonic, perf_counter, time
+from typing import Callable, Iterable, Optional
+
+from sqlalchemy import Row, delete, func, select, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from app.database import Database
+from app.instrumentation import LEADERBOARD_REFRESH_SECONDS
+from app.methods.aggregates import MOVIE_RANKING_COLUMNS, select_movie_rankings
+from app.methods.cache import LEADERBOARD_TAG, CacheBackend
+from app.methods.upsert import upsert_insert
+from app.models.movie import Movie, MovieLeaderboard, MovieRatingAggregate
+from app.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two checks of whether the schema is ready for the first refresh
+SCHEMA_POLL_INTERVAL = 0.5
+
+# Response header giving the seconds since the served ranking was refreshed
+LEADERBOARD_AGE_HEADER = "X-Leaderboard-Age"
+
+# Scope of the ranking of all movies, its key is always empty
+ALL_SCOPE = ("all", "")
+
+# Columns of a stored ranking, labelled like MovieRankingSchema
+LEADERBOARD_COLUMNS = (
+    MovieLeaderboard.id,
+    MovieLeaderboard.title,
+    MovieLeaderboard.genre,
+    MovieLeaderboard.year,
+    MovieLeaderboard.runtime,
+    MovieLeaderboard.avr_rating,
+    MovieLeaderboard.rating_count,
+    MovieLeaderboard.scope_size,
+    MovieLeaderboard.refreshed_at,
+)
+
+
+def leaderboard_scope(
+    genre: Optional[str] = None, year: Optional[str] = None
+) -> Optional[tuple[str, str]]:
+    """
+    :param genre: Optional genre of the ranking
+    :param year: Optional year of the ranking
+    :return: (scope, key) of the ranking, None if it is not precomputed
+    """
+    if genre is not None and year is not None:
+        return None
+    if genre is not None:
+        return "genre", genre.lower()
+    if year is not None:
+        return "year", year
+    return ALL_SCOPE
+
+
+def leaderboard_scopes(
+    db: Session, movie_ids: Optional[Iterable[int]] = None
+) -> list[tuple[str, str]]:
+    """
+    :param db: database session
+    :param movie_ids: Optional ids of changed movies, every rated movie by default
+    :return: (scope, key) of every ranking the movies are part of, sorted so concurrent
+        refreshes write the scopes in the same order
+    """
+    query = (
+        select(func.lower(Movie.genre), Movie.year)
+        .distinct()
+        .join(MovieRatingAggregate, MovieRatingAggregate.movie_id == Movie.id)
+    )
+    if movie_ids is not None:
+        query = query.where(Movie.id.in_(list(movie_ids)))
+    scopes = {ALL_SCOPE}
+    for genre, year in db.execute(query).all():
+        if genre is not None:
+            scopes.add(("genre", genre))
+        if year is not None:
+            scopes.add(("year", year))
+    return sorted(scopes)
+
+
+def refresh_leaderboard_scope(
+    db: Session,
+    scope: str,
+    scope_key: str,
+    refreshed_at: float,
+    size: int = Settings.leaderboard_size,
+    min_votes: int = Settings.leaderboard_min_votes,
+) -> bool:
+    """
+    Rank the top movies of a scope from the rating aggregates and overwrite its stored ranking,
+    in the caller's transaction. Positions are upserted rather than deleted and inserted again,
+    so two workers refreshing the same scope at once never conflict. A ranking that did not
+    change only gets its refresh time updated.
+
+    :param db: database session
+    :param scope: all, genre or year
+    :param scope_key: genre (lower case) or year of the scope, empty for all movies
+    :param refreshed_at: Unix time stored with the ranking
+    :param size: number of movies to store
+    :param min_votes: minimum number of ratings of the stored movies
+    :return: True if the stored ranking changed
+    """
+    rows = db.execute(
+        select_movie_rankings(
+            min_votes,
+            scope_key if scope == "genre" else None,
+            scope_key if scope == "year" else None,
+        ).limit(size)
+    ).all()
+    leaderboard = MovieLeaderboard.__table__
+    in_scope = (
+        MovieLeaderboard.scope == scope,
+        MovieLeaderboard.scope_key == scope_key,
+    )
+    stored = db.execute(
+        select(*(leaderboard.c[column.key] for column in MOVIE_RANKING_COLUMNS))
+        .where(*in_scope)
+        .order_by(MovieLeaderboard.position)
+    ).all()
+    if [tuple(row) for row in stored] == [tuple(row) for row in rows]:
+        db.execute(
+            update(MovieLeaderboard).where(*in_scope).values(refreshed_at=refreshed_at)
+        )
+        return False
+    if rows:
+        insert_rows = upsert_insert(db, leaderboard)
+        db.execute(
+            insert_rows.on_conflict_do_update(
+                index_elements=[
+                    leaderboard.c.scope,
+                    leaderboard.c.scope_key,
+                    leaderboard.c.position,
+                ],
+                set_={
+                    column.name: insert_rows.excluded[column.name]
+                    for column in leaderboard.columns
+                    if not column.primary_key
+                },
+            ),
+            [
+                {
+                    **row._asdict(),
+                    "scope": scope,
+                    "scope_key": scope_key,
+                    "position": position,
+                    "scope_size": len(rows),
+                    "refreshed_at": refreshed_at,
+                }
+                for position, row in enumerate(rows, start=1)
+            ],
+        )
+    db.execute(
+        delete(MovieLeaderboard).where(*in_scope, MovieLeaderboard.position > len(rows))
+    )
+    return True
+
+
+def refresh_leaderboard(
+    db: Session,
+    movie_ids: Optional[Iterable[int]] = None,
+    clock: Callable[[], float] = time,
+    size: int = Settings.leaderboard_size,
+    min_votes: int = Settings.leaderboard_min_votes,
+) -> bool:
+    """
+    Refresh the stored rankings in one transaction, so readers see every scope either before or
+    after the refresh. A full refresh also removes the scopes no rated movie is part of anymore.
+
+    :param db: database session
+    :param movie_ids: Optional ids of the movies whose ratings changed, to refresh only the
+        scopes they are part of, every scope by default
+    :param clock: function returning the current Unix time
+    :param size: number of movies to store per scope
+    :param min_votes: minimum number of ratings of the stored movies
+    :return: True if a stored ranking changed
+    """
+    refreshed_at = clock()
+    changed = False
+    for scope, scope_key in leaderboard_scopes(db, movie_ids):
+        if refresh_leaderboard_scope(
+            db, scope, scope_key, refreshed_at, size, min_votes
+        ):
+            changed = True
+    if movie_ids is None:
+        removed = db.execute(
+            delete(MovieLeaderboard).where(MovieLeaderboard.refreshed_at < refreshed_at)
+        )
+        if removed.rowcount:
+            changed = True
+    db.commit()
+    return changed
+
+
+def read_leaderboard(
+    db: Session,
+    k: int,
+    min_votes: int = 1,
+    genre: Optional[str] = None,
+    year: Optional[str] = None,
+    size: int = Settings.leaderboard_size,
+    stored_min_votes: int = Settings.leaderboard_min_votes,
+) -> Optional[list[Row]]:
+    """
+    Read the top k movies of a ranking from the leaderboard, a range scan of its primary key
+
+    :param db: database session
+    :param k: number of movies to return
+    :param min_votes: minimum number of ratings a movie needs to be ranked
+    :param genre: Optional genre the movies must have (case insensitive)
+    :param year: Optional year the movies must be released in
+    :param size: number of movies stored per scope by the refreshes
+    :param stored_min_votes: minimum number of ratings of the movies stored by the refreshes
+    :return: movies with their average rating, number of ratings and refresh time, None if the
+        ranking is not stored and has to be computed
+    """
+    scope = leaderboard_scope(genre, year)
+    if scope is None or k > size or min_votes < stored_min_votes:
+        return None
+    rows = db.execute(
+        select(*LEADERBOARD_COLUMNS)
+        .where(
+            MovieLeaderboard.scope == scope[0],
+            MovieLeaderboard.scope_key == scope[1],
+            MovieLeaderboard.rating_count >= min_votes,
+        )
+        .order_by(MovieLeaderboard.position)
+        .limit(k)
+    ).all()
+    # A missing scope may just not be refreshed yet, and a scope cut at the leaderboard size may
+    # not hold k movies with more than min_votes ratings
+    if not rows or (len(rows) < k and rows[0].scope_size >= size):
+        return None
+    return rows
+
+
+class LeaderboardRefresher:
+    """
+    Background task keeping the leaderboard fresh in the app lifespan.
+
+    Every worker counts its own rating writes and refreshes the scopes of the changed movies
+    once enough were written, and refreshes every scope at a fixed interval, which picks up the
+    writes of the other workers. Refreshes write the leaderboard through the primary, and evict
+    the cached rankings when a stored ranking changed, which also changes the data version of the
+    conditional requests of the rankings.
+    """
+
+    def __init__(
+        self,
+        interval: float = Settings.leaderboard_refresh_interval,
+        write_threshold: int = Settings.leaderboard_refresh_writes,
+        cache: Optional[CacheBackend] = None,
+        size: int = Settings.leaderboard_size,
+        min_votes: int = Settings.leaderboard_min_votes,
+    ):
+        self.interval = interval
+        # Optional query cache the refreshed rankings are evicted from
+        self.cache = cache
+        self.write_threshold = write_threshold
+        self.size = size
+        self.min_votes = min_votes
+        self.changed_movies: set[int] = set()
+        self.writes = 0
+        self.wake = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def mark_changed(self, movie_ids: Iterable[int]) -> None:
+        """
+        Count rating writes, and wake the refresher once enough were written
+
+        :param movie_ids: id of the movie of every written rating
+        """
+        if not self.running:
+            return
+        movie_ids = list(movie_ids)
+        self.changed_movies.update(movie_ids)
+        self.writes += len(movie_ids)
+        if self.writes >= self.write_threshold:
+            self.wake.set()
+
+    async def refresh(self, database: Database, full: bool) -> bool:
+        """
+        Refresh every scope, or the scopes of the movies changed since the last refresh
+
+        :param database: database of the application
+        :param full: whether to refresh every scope
+        :return: True if a stored ranking changed
+        """
+        changed, self.changed_movies, self.writes = self.changed_movies, set(), 0
+        kind = "full" if full else "incremental"
+        start = perf_counter()
+        try:
+            async with database.AsyncSessionLocal() as session:
+                refreshed = await session.run_sync(
+                    partial(
+                        refresh_leaderboard,
+                        movie_ids=None if full else changed,
+                        size=self.size,
+                        min_votes=self.min_votes,
+                    )
+                )
+        except BaseException:
+            # Refresh the movies again next time
+            self.changed_movies.update(changed)
+            self.writes += len(changed)
+            LEADERBOARD_REFRESH_SECONDS.observe(perf_counter() - start, kind, "error")
+            raise
+        LEADERBOARD_REFRESH_SECONDS.observe(perf_counter() - start, kind, "ok")
+        if refreshed and self.cache is not None:
+            await self.cache.invalidate(LEADERBOARD_TAG)
+        return refreshed
+
+    async def run(self, database: Database) -> None:
+        """
+        Refresh the leaderboard until cancelled, fully once the first request prepared the schema
+        and then every interval, and incrementally whenever the write threshold is reached in
+        between
+        """
+        while not database.schema_ready:
+            await asyncio.sleep(SCHEMA_POLL_INTERVAL)
+        full_refresh_at = monotonic()
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self.wake.wait(), max(full_refresh_at - monotonic(), 0)
+                )
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            full = monotonic() >= full_refresh_at
+            if full:
+                full_refresh_at = monotonic() + self.interval
+            elif not self.changed_movies:
+                continue
+            try:
+                await self.refresh(database, full)
+            except (SQLAlchemyError, OSError) as error:
+                logger.warning("Leaderboard refresh failed: %s", error)
+
+    def start(self, database: Database) -> None:
+        """
+        Start refreshing the leaderboard in the background, in the running event loop
+        """
+        self.wake = asyncio.Event()
+        self.task = asyncio.create_task(self.run(database))
+
+    async def stop(self) -> None:
+        """
+        Stop the background refreshes, waiting for a running refresh to be cancelled
+        """
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        self.changed_movies, self.writes = set(), 0
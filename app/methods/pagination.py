@@ -0,0 +1,40 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from typing import Any, Callable, Optional
+
+# Page size used when the client doesn't ask for one, and the largest page a client can ask for
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(*values: Any) -> str:
+    """
+    Encode the sort key of the last row of a page into an opaque keyset cursor
+
+    :param values: sort key values of the last row
+    :return: url safe cursor string
+    """
+    raw = ",".join(repr(value) for value in values)
+    return urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(
+    cursor: Optional[str], types: tuple[Callable[[str], Any], ...]
+) -> Optional[tuple]:
+    """
+    Decode a keyset cursor created by encode_cursor back into its sort key
+
+    :param cursor: cursor string, None for the first page
+    :param types: type of every value the cursor must hold, e.g. (int, int)
+    :return: tuple of sort key values, None for the first page
+    :raises ValueError: if the cursor is malformed
+    """
+    if cursor is None:
+        return None
+    try:
+        raw = urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        values = raw.split(",")
+        if len(values) != len(types):
+            raise ValueError
+        return tuple(value_type(value) for value_type, value in zip(types, values))
+    except (UnicodeDecodeError, ValueError):
+        raise ValueError(f"Invalid cursor: {cursor}")
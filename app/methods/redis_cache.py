@@ -0,0 +1,353 @@
+import json
+import logging
+import pickle
+from hashlib import sha1
+from threading import Event, Thread
+from time import time
+from typing import Any, Hashable, Iterable, Optional
+from uuid import uuid4
+
+from redis import Redis, RedisError
+from redis.asyncio import Redis as AsyncRedis
+
+from app.methods.cache import CacheBackend, CacheStats, DataVersion, QueryCache
+from app.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+# Part of every key, bump it when the shape of the cached rows changes so workers running the old
+# and new code never read each other's results
+CACHE_KEY_VERSION = 1
+
+# Seconds the invalidation listener waits before reconnecting to Redis, doubled after every failed
+# attempt up to the maximum
+LISTENER_RETRY_INTERVAL = 1.0
+LISTENER_MAX_RETRY_INTERVAL = 30.0
+
+
+class RedisCacheBackend(CacheBackend):
+    """
+    Query cache shared by every worker through Redis.
+
+    Every tag has a version in Redis, set to a new value of a global sequence when the tag is
+    invalidated, and the time of that invalidation. Results are stored with the versions of their
+    tags and are stale as soon as one of them changed, so an invalidation is a single write
+    however many results it affects and is seen by every worker at once. The versions of tags are
+    also the data versions of the conditional requests reading them.
+
+    Workers also keep the results they read for a short time in memory. Invalidations are
+    published on a channel every worker listens on, so these copies are evicted as well, and they
+    are only used while the listener is subscribed.
+    """
+
+    name = "redis"
+    shared = True
+
+    def __init__(
+        self,
+        client: AsyncRedis,
+        listener_client: Optional[Redis] = None,
+        prefix: str = "movie-api",
+        ttl: float = Settings.query_cache_ttl,
+        local_ttl: float = Settings.query_cache_local_ttl,
+        local_max_size: int = Settings.query_cache_max_size,
+        enabled: bool = Settings.query_cache_enabled,
+        single_flight_timeout: float = Settings.query_cache_single_flight_timeout,
+    ):
+        super().__init__(enabled, single_flight_timeout)
+        self.client = client
+        self.prefix = f"{prefix}:v{CACHE_KEY_VERSION}"
+        self.channel = f"{self.prefix}:invalidations"
+        self.ttl = ttl
+        self.sender = uuid4().hex
+        self.stats = CacheStats()
+        self.local = QueryCache(local_max_size, local_ttl) if local_ttl > 0 else None
+        self.listener: Optional[Thread] = None
+        self.stopping = Event()
+        self.subscribed = Event()
+        if self.local is not None and listener_client is not None:
+            self.listener = Thread(
+                target=self.listen, args=(listener_client,), daemon=True
+            )
+            self.listener.start()
+
+    @property
+    def local_ready(self) -> bool:
+        """
+        :return: whether results can be read from and kept in the local copies, not while the
+            listener is not subscribed as it would miss invalidations
+        """
+        return self.local is not None and (
+            self.listener is None or self.subscribed.is_set()
+        )
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs: Any) -> "RedisCacheBackend":
+        """
+        Create a backend connected to a Redis server
+
+        :param url: Redis URL, e.g. redis://cache:6379/0
+        :return: cache backend
+        """
+        return cls(AsyncRedis.from_url(url), Redis.from_url(url), **kwargs)
+
+    def entry_key(self, key: Hashable) -> str:
+        """
+        :param key: normalized query key
+        :return: Redis key of the cached result
+        """
+        return f"{self.prefix}:entry:{sha1(repr(key).encode()).hexdigest()}"
+
+    def lock_key(self, key: Hashable) -> str:
+        """
+        :param key: normalized query key
+        :return: Redis key of the lock held by the worker loading the result
+        """
+        return f"{self.prefix}:lock:{sha1(repr(key).encode()).hexdigest()}"
+
+    def tag_key(self, tag: Hashable) -> str:
+        """
+        :param tag: invalidation tag
+        :return: Redis key of the version of the tag
+        """
+        return f"{self.prefix}:tag:{':'.join(map(str, tag))}"
+
+    def tag_modified_key(self, tag: Hashable) -> str:
+        """
+        :param tag: invalidation tag
+        :return: Redis key of the Unix time the tag was last invalidated
+        """
+        return f"{self.prefix}:modified:{':'.join(map(str, tag))}"
+
+    async def get(self, key: Hashable, record: bool = True) -> tuple[bool, Any]:
+        found, value = await self._get(key)
+        if record:
+            if found:
+                self.stats.hits += 1
+            else:
+                self.stats.misses += 1
+        return found, value
+
+    async def _get(self, key: Hashable) -> tuple[bool, Any]:
+        """
+        Look up a result in the local copies, then in Redis
+
+        :param key: normalized query key
+        :return: (True, result) on a hit, (False, None) on a miss
+        """
+        local_ready = self.local_ready
+        if local_ready:
+            found, value = self.local.get(key)
+            if found:
+                return found, value
+            local_token = self.local.token()
+        try:
+            stored = await self.client.get(self.entry_key(key))
+            if stored is None:
+                return False, None
+            versions, value = pickle.loads(stored)
+            if versions:
+                current = await self.client.mget(map(self.tag_key, versions))
+                if any(
+                    int(version or 0) != stored_version
+                    for version, stored_version in zip(current, versions.values())
+                ):
+                    return False, None
+        except RedisError as error:
+            logger.warning("Query cache lookup failed: %s", error)
+            return False, None
+        if local_ready:
+            self.local.set(key, value, versions, local_token)
+        return True, value
+
+    async def token(self) -> Optional[tuple[int, Optional[int]]]:
+        try:
+            sequence = int(await self.client.get(f"{self.prefix}:sequence") or 0)
+        except RedisError as error:
+            logger.warning("Query cache token failed: %s", error)
+            return None
+        return sequence, self.local and self.local.token()
+
+    async def set(
+        self,
+        key: Hashable,
+        value: Any,
+        tags: Iterable,
+        token: Optional[tuple[int, Optional[int]]],
+    ) -> bool:
+        if token is None:
+            return False
+        sequence, local_token = token
+        tags = list(set(tags))
+        try:
+            versions = [
+                int(version or 0)
+                for version in (
+                    await self.client.mget(map(self.tag_key, tags)) if tags else []
+                )
+            ]
+            if any(version > sequence for version in versions):
+                return False
+            await self.client.set(
+                self.entry_key(key),
+                pickle.dumps((dict(zip(tags, versions)), value)),
+                px=int(self.ttl * 1000),
+            )
+        except RedisError as error:
+            logger.warning("Query cache store failed: %s", error)
+            return False
+        if self.local_ready and local_token is not None:
+            self.local.set(key, value, tags, local_token)
+        return True
+
+    async def invalidate(self, *tags: Hashable) -> int:
+        if self.local is not None:
+            self.local.invalidate(*tags)
+        try:
+            sequence = await self.client.incr(f"{self.prefix}:sequence")
+            modified_at = time()
+            async with self.client.pipeline(transaction=False) as pipeline:
+                pipeline.mset(
+                    {
+                        **{self.tag_key(tag): sequence for tag in tags},
+                        **{self.tag_modified_key(tag): modified_at for tag in tags},
+                    }
+                )
+                pipeline.set(f"{self.prefix}:modified", modified_at)
+                pipeline.publish(
+                    self.channel,
+                    json.dumps(
+                        {"sender": self.sender, "tags": [list(t) for t in tags]}
+                    ),
+                )
+                await pipeline.execute()
+        except RedisError as error:
+            logger.warning("Query cache invalidation failed: %s", error)
+            return 0
+        self.stats.invalidations += len(tags)
+        return len(tags)
+
+    async def clear(self) -> None:
+        if self.local is not None:
+            self.local.clear()
+        keys = [key async for key in self.client.scan_iter(match=f"{self.prefix}:*")]
+        if keys:
+            await self.client.delete(*keys)
+        self.stats = CacheStats()
+
+    async def get_stats(self) -> dict:
+        size = 0
+        async for _ in self.client.scan_iter(match=f"{self.prefix}:entry:*"):
+            size += 1
+        return {
+            "hits": self.stats.hits,
+            "misses": self.stats.misses,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": self.stats.invalidations,
+            "size": size,
+        }
+
+    async def data_version(self, *tags: Hashable) -> Optional[DataVersion]:
+        keys = [
+            f"{self.prefix}:{name}"
+            for name in ("epoch", "started", "sequence", "modified")
+        ]
+        for tag in tags:
+            keys += [self.tag_key(tag), self.tag_modified_key(tag)]
+        try:
+            values = await self.client.mget(keys)
+            if values[0] is None or values[1] is None:
+                # First use of the server, or its data was lost: start a new epoch
+                started_at = time()
+                await self.client.set(keys[0], uuid4().hex[:8], nx=True)
+                await self.client.set(keys[1], started_at, nx=True)
+                await self.client.set(keys[3], started_at, nx=True)
+                values = await self.client.mget(keys)
+        except RedisError as error:
+            logger.warning("Query cache data version failed: %s", error)
+            return None
+        epoch, started_at, sequence, modified_at = values[:4]
+        if tags:
+            # Tags never invalidated in this epoch are as old as the epoch
+            sequence = max(int(version or 0) for version in values[4::2])
+            modified_at = max(
+                (float(modified) for modified in values[5::2] if modified is not None),
+                default=float(started_at),
+            )
+        return DataVersion(
+            f"{epoch.decode()}-{int(sequence or 0)}",
+            float(modified_at) if modified_at is not None else time(),
+        )
+
+    async def acquire(self, key: Hashable) -> bool:
+        try:
+            return bool(
+                await self.client.set(
+                    self.lock_key(key),
+                    self.sender,
+                    nx=True,
+                    px=int(self.single_flight_timeout * 1000),
+                )
+            )
+        except RedisError as error:
+            logger.warning("Query cache lock failed: %s", error)
+            return True
+
+    async def release(self, key: Hashable) -> None:
+        lock = self.lock_key(key)
+        try:
+            if await self.client.get(lock) == self.sender.encode():
+                await self.client.delete(lock)
+        except RedisError as error:
+            logger.warning("Query cache unlock failed: %s", error)
+
+    def listen(self, listener_client: Redis) -> None:
+        """
+        Evict the local copies of results invalidated by other workers, until `close` is called.
+        When Redis can't be reached the local copies are dropped and the listener subscribes
+        again, with a backoff.
+
+        :param listener_client: blocking Redis client, used by this thread only
+        """
+        pubsub = listener_client.pubsub(ignore_subscribe_messages=True)
+        retry_interval = LISTENER_RETRY_INTERVAL
+        try:
+            while not self.stopping.is_set():
+                try:
+                    if not self.subscribed.is_set():
+                        pubsub.subscribe(self.channel)
+                        # Invalidations published before the subscription were missed
+                        self.local.clear()
+                        self.subscribed.set()
+                        retry_interval = LISTENER_RETRY_INTERVAL
+                    message = pubsub.get_message(timeout=0.1)
+                except RedisError as error:
+                    logger.warning(
+                        "Query cache listener failed, subscribing again in %.1fs: %s",
+                        retry_interval,
+                        error,
+                    )
+                    self.subscribed.clear()
+                    self.local.clear()
+                    pubsub.reset()
+                    self.stopping.wait(retry_interval)
+                    retry_interval = min(
+                        retry_interval * 2, LISTENER_MAX_RETRY_INTERVAL
+                    )
+                    continue
+                if message is None:
+                    continue
+                invalidation = json.loads(message["data"])
+                if invalidation["sender"] != self.sender:
+                    self.local.invalidate(*map(tuple, invalidation["tags"]))
+        finally:
+            pubsub.close()
+
+    def close(self) -> None:
+        """
+        Stop listening for invalidations
+        """
+        self.stopping.set()
+        if self.listener is not None:
+            self.listener.join()
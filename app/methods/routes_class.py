@@ -1,44 +1,286 @@
-from typing import Any, List, Optional, Type
+from time import time
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Type,
+)
 
-from sqlalchemy import desc
-from sqlalchemy.orm import Session
+from pydantic import BaseModel
+from sqlalchemy import (
+    Integer,
+    Row,
+    Select,
+    and_,
+    cast,
+    delete,
+    desc,
+    exists,
+    literal,
+    or_,
+    select,
+    tuple_,
+    update,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, aliased
 from sqlalchemy.sql.expression import func
 
-from app.models.movie import Movie
-from app.schemas.base import MovieSchema
+from app.instrumentation import timed_serialization
+from app.methods.aggregates import (
+    apply_rating_delta,
+    apply_rating_deltas,
+    select_movie_rankings,
+)
+from app.methods.cache import (
+    LEADERBOARD_TAG,
+    MOVIE_LISTING_TAG,
+    RATINGS_TAG,
+    CacheBackend,
+    movie_tag,
+    user_tag,
+)
+from app.methods.leaderboard import read_leaderboard
+from app.methods.search import SearchMode, get_search_backend
+from app.methods.similarity import SimilarityIndex, SimilarRow
+from app.methods.upsert import upsert_insert
+from app.models.movie import Movie, MovieRatingAggregate, Rating, User
+from app.schemas.base import MovieSchema, RatingInSchema
+from app.settings import Settings
+
+if TYPE_CHECKING:
+    from app.methods.columnar import ColumnarEngine
+    from app.methods.leaderboard import LeaderboardRefresher
+
+# Number of ratings written per batch by bulk_upsert_ratings
+BULK_BATCH_SIZE = 1000
+
+
+def movie_rating_columns(ratings=Rating) -> tuple:
+    """
+    Columns of a rating joined with its movie and rating aggregate, labelled like MovieSchema
+
+    :param ratings: ratings table or alias the rating columns are read from
+    :return: tuple of columns
+    """
+    return (
+        Movie.id,
+        ratings.user_id,
+        Movie.title,
+        Movie.genre,
+        Movie.year,
+        Movie.runtime,
+        ratings.rating,
+        cast(
+            func.round(func.coalesce(MovieRatingAggregate.avr_rating, 0)), Integer
+        ).label("avr_rating"),
+    )
+
+
+MOVIE_RATING_COLUMNS = movie_rating_columns()
+
+# MovieSchema field name -> column, for field projection
+MOVIE_RATING_FIELDS = {column.key: column for column in MOVIE_RATING_COLUMNS}
+
+
+def select_movie_ratings(
+    fields: Optional[Iterable[str]] = None, ratings=Rating, page=None
+):
+    """
+    Select ratings joined with their movie and rating aggregate
+
+    :param fields: Optional MovieSchema fields to select, the movie and user ids are always selected
+    :param ratings: ratings table or alias to select from
+    :param page: Optional subquery of movie ids the ratings are joined to, selected from first so
+        lateral ratings can reference it
+    :return: select statement returning rows in MovieSchema shape
+    """
+    columns = movie_rating_columns(ratings)
+    if fields is not None:
+        keys = {"id", "user_id", *fields}
+        columns = [column for column in columns if column.key in keys]
+    query = select(*columns)
+    if page is not None:
+        query = query.select_from(page).join(ratings, ratings.movie_id == page.c.id)
+    else:
+        query = query.select_from(ratings)
+    return query.join(Movie, ratings.movie_id == Movie.id).outerjoin(
+        MovieRatingAggregate, MovieRatingAggregate.movie_id == Movie.id
+    )
 
 
 class Crud:
-    def __init__(self, db: Session):
+    def __init__(self, db: Session, columnar: Optional["ColumnarEngine"] = None):
         self.db = db
+        # Optional in-memory engine answering the rankings and averages once it is loaded
+        self.columnar = columnar
+
+    @property
+    def columnar_ready(self) -> bool:
+        return self.columnar is not None and self.columnar.ready
 
     def get_movies_info(
         self,
         title: Optional[str] = None,
         genre: Optional[str] = None,
         year: Optional[str] = None,
-    ):
+        mode: SearchMode = "contains",
+        limit: Optional[int] = None,
+        after: Optional[tuple] = None,
+        fields: Optional[Iterable[str]] = None,
+    ) -> list[Row]:
         """
-        Get movies from the database that match the given filters (if any) and return them
+        Get movies from the database that match the given filters (if any) and return them, the
+        most relevant title and genre matches first. Searches by title or genre return a
+        `relevance` column along with the movie.
 
         :param title: title of the movie
         :param genre: genre of the movie
-        :param year: year of the movie
+        :param year: year of the movie, matched exactly
+        :param mode: how title and genre are matched: contains, prefix or fuzzy
+        :param limit: Optional maximum number of movies to return
+        :param after: Optional sort key of the last movie of the previous page, (movie id, user id)
+            or (relevance, movie id, user id) when searching by title or genre
+        :param fields: Optional MovieSchema fields to select, all fields by default
         :return: list of movies that match the given filters
         """
-        query = self.db.query(Movie)
+        movies = []
+        for query in self.select_movies_info(
+            title, genre, year, mode, limit, after, fields
+        ):
+            movies += self.db.execute(query).all()
+            if limit is not None and len(movies) >= limit:
+                return movies[:limit]
+        return movies
 
-        if title is not None:
-            query = query.filter(func.lower(Movie.title).contains(title.lower()))
-        if genre is not None:
-            query = query.filter(func.lower(Movie.genre).contains(genre.lower()))
+    def select_movies_info(
+        self,
+        title: Optional[str] = None,
+        genre: Optional[str] = None,
+        year: Optional[str] = None,
+        mode: SearchMode = "contains",
+        limit: Optional[int] = None,
+        after: Optional[tuple] = None,
+        fields: Optional[Iterable[str]] = None,
+    ) -> Iterator[Select]:
+        """
+        Build the select statements of get_movies_info, so they can also be streamed. A search by
+        title or genre ranks the matching movies first and then reads the ratings of a page of
+        them, possibly over several statements whose rows follow each other in order.
+
+        :return: iterator of select statements of the movies that match the given filters
+        """
+        filters = {
+            field: text
+            for field, text in (("title", title), ("genre", genre))
+            if text is not None
+        }
+        if not filters:
+            query = select_movie_ratings(fields)
+            if after is not None:
+                query = query.where(
+                    tuple_(Rating.movie_id, Rating.user_id) > tuple_(*after)
+                )
+            if year is not None:
+                query = query.where(Movie.year == year)
+            query = query.order_by(Rating.movie_id, Rating.user_id)
+            if limit is not None:
+                query = query.limit(limit)
+            return iter([query])
+
+        movies = select(Movie.id).where(exists().where(Rating.movie_id == Movie.id))
         if year is not None:
-            query = query.filter(func.lower(Movie.year).contains(year.lower()))
+            movies = movies.where(Movie.year == year)
+        # Every ranked movie has a rating, so a page of `limit` rows spans at most `limit` movies,
+        # plus the movie of the cursor which may have no rating left after it
+        page_size = None if limit is None else limit + 1
+        matches = get_search_backend(self.db).apply(
+            self.db,
+            movies,
+            filters,
+            mode,
+            after=None if after is None else tuple(after[:2]),
+            chunk_size=page_size,
+        )
+        lateral = self.db.get_bind().dialect.name == "postgresql"
+        return (
+            self._select_ranked_ratings(
+                movies, relevance, page_size, limit, after, fields, lateral
+            )
+            for movies, relevance in matches
+        )
 
-        movies = query.all()
-        return movies
+    @staticmethod
+    def _select_ranked_ratings(
+        movies: Select,
+        relevance,
+        page_size: Optional[int],
+        limit: Optional[int],
+        after: Optional[tuple],
+        fields: Optional[Iterable[str]],
+        lateral: bool,
+    ) -> Select:
+        """
+        Select the ratings of the most relevant matching movies, so only the ratings of one page
+        of movies are sorted. On Postgres the ratings of every movie are read through a lateral
+        subquery stopping at `limit` ratings, in the order of the (movie_id, user_id) index.
+
+        :param movies: select statement of the matching movie ids
+        :param relevance: relevance score expression of the movies
+        :param page_size: Optional number of movies to read the ratings of
+        :param limit: Optional maximum number of ratings to return
+        :param after: Optional (relevance, movie id, user id) of the last rating of the
+            previous page
+        :param fields: Optional MovieSchema fields to select
+        :param lateral: whether the database supports lateral subqueries
+        :return: select statement of the ratings ordered by relevance, movie id and user id
+        """
+        relevance = relevance.label("relevance")
+        page = movies.add_columns(relevance).order_by(relevance.desc(), Movie.id)
+        if page_size is not None:
+            page = page.limit(page_size)
+        page = page.subquery("page")
+
+        # The backend left out the movies ranked before the cursor, but the movie of the cursor
+        # still has its ratings up to the cursor
+        after_rating = None
+        if after is not None:
+            _, after_movie, after_user = after
+            after_rating = lambda ratings: or_(
+                ratings.movie_id != after_movie, ratings.user_id > after_user
+            )
+        ratings = Rating
+        if lateral and limit is not None:
+            movie_ratings = (
+                select(Rating)
+                .where(Rating.movie_id == page.c.id)
+                .order_by(Rating.user_id)
+                .limit(limit)
+            )
+            if after_rating is not None:
+                movie_ratings = movie_ratings.where(after_rating(Rating))
+            ratings = aliased(Rating, movie_ratings.lateral("movie_ratings"))
+
+        query = select_movie_ratings(fields, ratings, page).add_columns(
+            page.c.relevance
+        )
+        if after_rating is not None and ratings is Rating:
+            query = query.where(after_rating(Rating))
+        query = query.order_by(
+            page.c.relevance.desc(), ratings.movie_id, ratings.user_id
+        )
+        if limit is not None:
+            query = query.limit(limit)
+        return query
 
-    def get_movie_rating_by_unique_filter(self, movie_id: int, user_id: int) -> Any:
+    def get_movie_rating_by_unique_filter(
+        self, movie_id: int, user_id: int
+    ) -> Optional[Row]:
         """
         Get a movie from the database by its user id and return it to the user in JSON format
 
@@ -46,27 +288,30 @@ class Crud:
         :param user_id: user id of the movie to retrieve
         :return: movie with the given movie id or user id.
         """
-        return (
-            self.db.query(Movie)
-            .filter(Movie.id == movie_id, Movie.user_id == user_id)
-            .first()
-        )
+        return self.db.execute(
+            select_movie_ratings().where(
+                Rating.movie_id == movie_id, Rating.user_id == user_id
+            )
+        ).first()
 
-    def get_movie_average_rating(self, movie: Movie) -> Any:
+    def get_movie_average_rating(self, movie_id: int) -> Any:
         """
-        Retrieve the top five movie average ratings from the database and return them to the
-        user in JSON format
+        Retrieve the average rating of a movie from the rating aggregates
 
-        :param movie: object of the movie
+        :param movie_id: id of the movie
         :return: select average rating of the movie
         """
-        return (
-            self.db.query(func.avg(Movie.rating))
-            .filter(func.lower(Movie.title).contains(movie.title.lower()))
-            .scalar()
-        )
+        if self.columnar_ready:
+            return self.columnar.movie_average(movie_id)
+        return self.db.execute(
+            select(MovieRatingAggregate.avr_rating).where(
+                MovieRatingAggregate.movie_id == movie_id
+            )
+        ).scalar()
 
-    def update_movie_rating(self, movie_id: int, user_id: int, rating: int) -> Movie:
+    def update_movie_rating(
+        self, movie_id: int, user_id: int, rating: int
+    ) -> Optional[Row]:
         """
         Update the rating of a movie for a given user in the database and return it to the
         user in JSON format
@@ -74,47 +319,450 @@ class Crud:
         :param movie_id: id of the movie
         :param user_id: id of the user
         :param rating: rating of the movie
-        :return: updated movie rating
+        :return: updated movie rating, None if the user has not rated the movie
         """
-        db_rating = self.get_movie_rating_by_unique_filter(movie_id, user_id)
-        avr_ratings = self.get_movie_average_rating(db_rating)
-        if db_rating:
-            db_rating.rating = rating
-            db_rating.avr_rating = avr_ratings
-            self.db.merge(db_rating)
-        db_rating = Movie(
-            user_id=user_id,
-            rating=rating,
-            avr_rating=avr_ratings,
-            year=db_rating.year,
-            runtime=db_rating.runtime,
-            genre=db_rating.genre,
-            title=db_rating.title,
-        )
-        self.db.add(db_rating)
+        if self.db.get_bind().dialect.name == "postgresql":
+            db_rating = self._update_movie_rating_in_one_statement(
+                movie_id, user_id, rating
+            )
+        else:
+            db_rating = self._update_movie_rating_in_two_statements(
+                movie_id, user_id, rating
+            )
 
         self.db.commit()
-        self.db.refresh(db_rating)
         return db_rating
 
+    def _update_movie_rating_in_one_statement(
+        self, movie_id: int, user_id: int, rating: int
+    ) -> Optional[Row]:
+        """
+        Update a rating and its movie's aggregate with one statement on Postgres. The old rating is
+        locked and read, the rating and aggregate are updated and the final row is returned by
+        chained data modifying CTEs. A concurrent update of the same rating waits on the row lock
+        and then sees the committed rating, and the aggregate is updated in place, so no change is
+        lost.
+
+        :param movie_id: id of the movie
+        :param user_id: id of the user
+        :param rating: rating of the movie
+        :return: updated movie rating, None if the user has not rated the movie
+        """
+        old = (
+            select(Rating.user_id, Rating.movie_id, Rating.rating)
+            .where(Rating.movie_id == movie_id, Rating.user_id == user_id)
+            .with_for_update()
+            .cte("old_rating")
+        )
+        new = (
+            update(Rating)
+            .where(Rating.user_id == old.c.user_id, Rating.movie_id == old.c.movie_id)
+            .values(rating=rating)
+            .returning(
+                Rating.user_id,
+                Rating.movie_id,
+                Rating.rating,
+                old.c.rating.label("old_rating"),
+            )
+            .cte("new_rating")
+        )
+        rating_sum = MovieRatingAggregate.rating_sum + new.c.rating - new.c.old_rating
+        aggregate = (
+            update(MovieRatingAggregate)
+            .where(MovieRatingAggregate.movie_id == new.c.movie_id)
+            .values(
+                rating_sum=rating_sum,
+                avr_rating=rating_sum
+                * literal(1.0)
+                / MovieRatingAggregate.rating_count,
+            )
+            .returning(MovieRatingAggregate.movie_id, MovieRatingAggregate.avr_rating)
+            .cte("new_aggregate")
+        )
+        return self.db.execute(
+            select(
+                Movie.id,
+                new.c.user_id,
+                Movie.title,
+                Movie.genre,
+                Movie.year,
+                Movie.runtime,
+                new.c.rating,
+                cast(
+                    func.round(func.coalesce(aggregate.c.avr_rating, 0)), Integer
+                ).label("avr_rating"),
+            )
+            .select_from(new)
+            .join(Movie, Movie.id == new.c.movie_id)
+            .outerjoin(aggregate, aggregate.c.movie_id == new.c.movie_id)
+        ).first()
+
+    def _update_movie_rating_in_two_statements(
+        self, movie_id: int, user_id: int, rating: int
+    ) -> Optional[Row]:
+        """
+        Update a rating and its movie's aggregate with two statements, for databases without data
+        modifying CTEs. The aggregate is updated first, with the old rating read by a subquery,
+        which takes the write lock before the rating is read. The rating update then returns the
+        final row.
+
+        :param movie_id: id of the movie
+        :param user_id: id of the user
+        :param rating: rating of the movie
+        :return: updated movie rating, None if the user has not rated the movie
+        """
+        old_rating = (
+            select(Rating.rating)
+            .where(Rating.movie_id == movie_id, Rating.user_id == user_id)
+            .scalar_subquery()
+        )
+        rating_sum = MovieRatingAggregate.rating_sum + rating - old_rating
+        self.db.execute(
+            update(MovieRatingAggregate)
+            .where(MovieRatingAggregate.movie_id == movie_id, old_rating.is_not(None))
+            .values(
+                rating_sum=rating_sum,
+                avr_rating=rating_sum
+                * literal(1.0)
+                / MovieRatingAggregate.rating_count,
+            )
+        )
+
+        # SQLite renders the columns of RETURNING subqueries without their table, so they are
+        # matched on the bound movie id instead of being correlated with the updated row
+        def movie_column(column):
+            return select(column).where(Movie.id == movie_id).scalar_subquery()
+
+        return self.db.execute(
+            update(Rating)
+            .where(Rating.movie_id == movie_id, Rating.user_id == user_id)
+            .values(rating=rating)
+            .returning(
+                Rating.movie_id.label("id"),
+                Rating.user_id,
+                movie_column(Movie.title).label("title"),
+                movie_column(Movie.genre).label("genre"),
+                movie_column(Movie.year).label("year"),
+                movie_column(Movie.runtime).label("runtime"),
+                Rating.rating,
+                cast(
+                    func.round(
+                        func.coalesce(
+                            select(MovieRatingAggregate.avr_rating)
+                            .where(MovieRatingAggregate.movie_id == movie_id)
+                            .scalar_subquery(),
+                            0,
+                        )
+                    ),
+                    Integer,
+                ).label("avr_rating"),
+            )
+        ).first()
+
+    def delete_movie_rating(self, movie_id: int, user_id: int) -> bool:
+        """
+        Delete the rating of a movie for a given user and update the movie's rating aggregate
+
+        :param movie_id: id of the movie
+        :param user_id: id of the user
+        :return: True if a rating was deleted
+        """
+        old_rating = self.db.execute(
+            delete(Rating)
+            .where(Rating.movie_id == movie_id, Rating.user_id == user_id)
+            .returning(Rating.rating)
+        ).scalar()
+        if old_rating is None:
+            return False
+        apply_rating_delta(self.db, movie_id, old_rating, None)
+
+        self.db.commit()
+        return True
+
+    def bulk_upsert_ratings(
+        self,
+        ratings: List[RatingInSchema],
+        batch_size: int = BULK_BATCH_SIZE,
+        create: bool = True,
+    ) -> dict[tuple[int, int], str]:
+        """
+        Insert or overwrite many ratings in one transaction. Every batch costs a fixed number of
+        statements: a lookup of the rated movies, batched inserts of the users and new ratings, a
+        locked read and batched update of the existing ratings, then an upsert of the rating
+        aggregates of every affected movie. If a user rates the same movie more than once, the
+        last rating wins.
+
+        :param ratings: validated ratings to write
+        :param batch_size: number of ratings written per batch
+        :param create: whether to create missing ratings, or only overwrite existing ones like
+            update_movie_rating
+        :return: created, updated, unchanged, movie_not_found or rating_not_found by
+            (user id, movie id)
+        """
+        latest = {
+            (rating.user_id, rating.movie_id): rating.rating for rating in ratings
+        }
+        statuses = {}
+        keys = list(latest)
+        for start in range(0, len(keys), batch_size):
+            batch = {key: latest[key] for key in keys[start : start + batch_size]}
+            statuses.update(self._upsert_rating_batch(batch, create))
+
+        self.db.commit()
+        return statuses
+
+    def _upsert_rating_batch(
+        self, batch: dict[tuple[int, int], int], create: bool = True
+    ) -> dict[tuple[int, int], str]:
+        """
+        Write one batch of bulk_upsert_ratings
+
+        :param batch: rating by (user id, movie id)
+        :param create: whether to create missing ratings
+        :return: status by (user id, movie id)
+        """
+        movie_ids = set(
+            self.db.execute(
+                select(Movie.id).where(Movie.id.in_({movie for _, movie in batch}))
+            ).scalars()
+        )
+        statuses, deltas = {}, {}
+        pending = {}
+        for (user_id, movie_id), rating in batch.items():
+            if movie_id in movie_ids:
+                pending[user_id, movie_id] = rating
+            else:
+                statuses[user_id, movie_id] = "movie_not_found"
+        if not pending:
+            return statuses
+
+        def add_delta(movie_id: int, sum_delta: int, count_delta: int) -> None:
+            old_sum, old_count = deltas.get(movie_id, (0, 0))
+            deltas[movie_id] = (old_sum + sum_delta, old_count + count_delta)
+
+        if create:
+            self.db.execute(
+                upsert_insert(self.db, User.__table__).on_conflict_do_nothing(),
+                [{"id": user_id} for user_id in {user for user, _ in pending}],
+            )
+            # The insert only returns the ratings it created. A concurrent insert of the same
+            # rating waits on the unique index and then conflicts, so it is counted only once.
+            created = self.db.execute(
+                upsert_insert(self.db, Rating.__table__)
+                .on_conflict_do_nothing()
+                .returning(Rating.user_id, Rating.movie_id),
+                [
+                    {"user_id": user_id, "movie_id": movie_id, "rating": rating}
+                    for (user_id, movie_id), rating in pending.items()
+                ],
+            ).all()
+            for user_id, movie_id in created:
+                statuses[user_id, movie_id] = "created"
+                add_delta(movie_id, pending.pop((user_id, movie_id)), 1)
+
+        if pending:
+            # Every remaining rating existed before the insert, so the lock covers all of them
+            # and the ratings read are the latest committed ones
+            old_ratings = {
+                (user_id, movie_id): rating
+                for user_id, movie_id, rating in self.db.execute(
+                    select(Rating.user_id, Rating.movie_id, Rating.rating)
+                    .where(
+                        # SQLite scans the whole table for a list of row values, but searches
+                        # the index for a list of user ids
+                        Rating.user_id.in_({user for user, _ in pending}),
+                        tuple_(Rating.user_id, Rating.movie_id).in_(list(pending)),
+                    )
+                    .with_for_update()
+                )
+            }
+            rows = []
+            for (user_id, movie_id), rating in pending.items():
+                old_rating = old_ratings.get((user_id, movie_id))
+                if old_rating is None:
+                    statuses[user_id, movie_id] = "rating_not_found"
+                elif old_rating == rating:
+                    statuses[user_id, movie_id] = "unchanged"
+                else:
+                    statuses[user_id, movie_id] = "updated"
+                    rows.append(
+                        {"user_id": user_id, "movie_id": movie_id, "rating": rating}
+                    )
+                    add_delta(movie_id, rating - old_rating, 0)
+            if rows:
+                self.db.execute(update(Rating), rows)
+
+        apply_rating_deltas(self.db, deltas)
+        return statuses
+
     def get_top_five_movie_ratings(
-        self, user_id: Optional[int] = None
-    ) -> list[Type[Movie]]:
+        self,
+        user_id: Optional[int] = None,
+        k: int = 5,
+        min_votes: int = 1,
+        genre: Optional[str] = None,
+        year: Optional[str] = None,
+    ) -> list[Row]:
         """
         Retrieve the top five movie average ratings from the database. If a user_id is provided,
-        it filters the movies to only those associated with the user.
+        the five highest rated movies of the user are returned, otherwise the top k distinct
+        movies of all users are ranked. Both are answered by the columnar engine when it is loaded.
 
         :param user_id: Optional user id to filter movies
+        :param k: number of movies to rank for all users
+        :param min_votes: minimum number of ratings a movie needs to be ranked for all users
+        :param genre: Optional genre to rank movies of all users in
+        :param year: Optional year to rank movies of all users in
         :return: list of top five movie average ratings
         """
-        query = self.db.query(Movie)
+        if self.columnar_ready:
+            if user_id is None:
+                return self.columnar.top_movies(k, min_votes, genre, year)
+            return self.columnar.user_top_ratings(user_id, 5)
 
-        if user_id is not None:
-            query = query.filter(Movie.user_id == user_id)
+        if user_id is None:
+            return self.get_top_movie_rankings(k, min_votes, genre, year)
 
-        return query.order_by(desc(Movie.avr_rating)).limit(5).all()
+        return self.get_user_ratings_page(user_id, limit=5)
 
-    def get_movie_for_one_user(self, movie_id: int, user_id: int) -> Movie:
+    def get_user_ratings_page(
+        self,
+        user_id: int,
+        limit: int,
+        after: Optional[tuple[int, int]] = None,
+    ) -> list[Row]:
+        """
+        Retrieve one page of a user's ratings, highest rating first, using keyset pagination on
+        (rating, movie id). Every page is a range scan of ix_ratings_user_rating, so its cost does
+        not depend on how deep into the user's history it is.
+
+        :param user_id: id of the user
+        :param limit: maximum number of ratings to return
+        :param after: Optional (rating, movie id) of the last rating of the previous page
+        :return: list of ratings of the user
+        """
+        query = select_movie_ratings().where(Rating.user_id == user_id)
+
+        if after is not None:
+            after_rating, after_movie_id = after
+            query = query.where(
+                Rating.rating <= after_rating,
+                or_(
+                    Rating.rating < after_rating,
+                    and_(
+                        Rating.rating == after_rating, Rating.movie_id > after_movie_id
+                    ),
+                ),
+            )
+
+        return self.db.execute(
+            query.order_by(desc(Rating.rating), Rating.movie_id).limit(limit)
+        ).all()
+
+    def get_top_movie_rankings(
+        self,
+        k: int = 5,
+        min_votes: int = 1,
+        genre: Optional[str] = None,
+        year: Optional[str] = None,
+    ) -> list[Row]:
+        """
+        Rank the top k distinct movies by average rating. The query walks the
+        ix_movie_rating_aggregates_ranking index in order and stops after k matching movies, so
+        it never sorts the ratings or aggregates tables.
+
+        :param k: number of movies to return
+        :param min_votes: minimum number of ratings a movie needs to be ranked
+        :param genre: Optional genre the movies must have (case insensitive)
+        :param year: Optional year the movies must be released in
+        :return: list of movies with their average rating and number of ratings
+        """
+        return self.db.execute(
+            select_movie_rankings(min_votes, genre, year).limit(k)
+        ).all()
+
+    def get_leaderboard(
+        self,
+        k: int = 5,
+        min_votes: int = 1,
+        genre: Optional[str] = None,
+        year: Optional[str] = None,
+        size: int = Settings.leaderboard_size,
+        stored_min_votes: int = Settings.leaderboard_min_votes,
+    ) -> Optional[list[Row]]:
+        """
+        Read the top k distinct movies by average rating from the leaderboard refreshed in the
+        background, in O(k) whatever the number of rated movies
+
+        :param k: number of movies to return
+        :param min_votes: minimum number of ratings a movie needs to be ranked
+        :param genre: Optional genre the movies must have (case insensitive)
+        :param year: Optional year the movies must be released in
+        :param size: number of movies stored per scope
+        :param stored_min_votes: minimum number of ratings of the stored movies
+        :return: list of movies with their average rating, number of ratings and refresh time,
+            None if the ranking is not in the leaderboard
+        """
+        return read_leaderboard(
+            self.db, k, min_votes, genre, year, size, stored_min_votes
+        )
+
+    def get_similar_movies(
+        self, movie_id: int, k: int, index: SimilarityIndex
+    ) -> list[SimilarRow]:
+        """
+        Read the most similar movies of a movie from the neighbor index, and their details from
+        the movies table
+
+        :param movie_id: id of the movie
+        :param k: number of movies to return
+        :param index: neighbor index
+        :return: list of movies with their cosine similarity, most similar first
+        """
+        return self._scored_movies(index.neighbors(movie_id, k))
+
+    def get_recommendations(
+        self, user_id: int, k: int, index: SimilarityIndex
+    ) -> list[SimilarRow]:
+        """
+        Recommend the movies most similar to the ones a user rated highly, from the neighbor
+        index. The user's ratings are one range scan of ix_ratings_user_rating.
+
+        :param user_id: id of the user
+        :param k: number of movies to return
+        :param index: neighbor index
+        :return: list of movies the user did not rate with their score, highest score first
+        """
+        ratings = self.db.execute(
+            select(Rating.movie_id, Rating.rating).where(Rating.user_id == user_id)
+        ).all()
+        return self._scored_movies(index.recommend(ratings, k))
+
+    def _scored_movies(self, scored: list[tuple[int, float]]) -> list[SimilarRow]:
+        """
+        Join scored movie ids with the movie details, in one query
+
+        :param scored: (movie id, score) of the movies, in order
+        :return: list of movies with their score, in the same order, without the movies
+            deleted since the index was built
+        """
+        if not scored:
+            return []
+        movies = {
+            row.id: row
+            for row in self.db.execute(
+                select(
+                    Movie.id, Movie.title, Movie.genre, Movie.year, Movie.runtime
+                ).where(Movie.id.in_([movie_id for movie_id, _ in scored]))
+            )
+        }
+        return [
+            SimilarRow(*movies[movie_id], score)
+            for movie_id, score in scored
+            if movie_id in movies
+        ]
+
+    def get_movie_for_one_user(self, movie_id: int, user_id: int) -> Optional[Row]:
         """
         Retrieve the ratings for a given movie from the database for one user only and return them to the
         user in JSON format
@@ -123,30 +771,478 @@ class Crud:
         :param user_id: user id of the movie to retrieve
         :return: movie with the given id and user id
         """
-        return (
-            self.db.query(Movie)
-            .filter(Movie.id == movie_id, Movie.user_id == user_id)
-            .first()
-        )
+        return self.get_movie_rating_by_unique_filter(movie_id, user_id)
 
     @staticmethod
+    @timed_serialization
     def create_movie_schema_list(
-        movie_data: List[Type[Movie]], in_list: Optional[bool] = False
-    ) -> List[MovieSchema | List[Movie]]:
+        movie_data: List[Row],
+        in_list: Optional[bool] = False,
+        schema: Type[BaseModel] = MovieSchema,
+        fields: Optional[Iterable[str]] = None,
+    ) -> List[BaseModel | dict]:
         """
         Update a list movie with the data from the database and return it to the user in MovieSchema format
 
         :param movie_data: list containing the movie data
         :param in_list: boolean to return the movie data as a list of dictionaries or MovieSchema
+        :param schema: schema to build, MovieSchema by default
+        :param fields: Optional fields to keep, all fields of the rows by default
         :return: list of movie data in MovieSchema format or list of dictionaries
         """
         all_movie_list = []
         if in_list:
             for movie in movie_data:
-                movie_dict = movie.__dict__
+                movie_dict = dict(movie._mapping)
                 all_movie_list.append(movie_dict)
             return all_movie_list
         for movie in movie_data:
-            movie_dict = movie.__dict__
-            all_movie_list.append(MovieSchema(**movie_dict))
+            movie_dict = movie._mapping
+            if fields is not None:
+                movie_dict = {field: movie_dict[field] for field in fields}
+            all_movie_list.append(schema(**movie_dict))
         return all_movie_list
+
+
+class AsyncCrud:
+    """
+    Async variant of Crud used by the API routes.
+
+    Every method runs the matching Crud method through AsyncSession.run_sync, so the queries go
+    through the async driver (asyncpg / aiosqlite) and never block the event loop while waiting
+    on the database.
+
+    Movie listings, user ratings and rankings are served from the query cache when it is enabled,
+    and every write evicts the cached results of the movies and users it changed. The top five
+    rankings skip both the cache and the database when the columnar engine is loaded, which every
+    write is applied to.
+    """
+
+    def __init__(
+        self,
+        db: AsyncSession,
+        cache: Optional[CacheBackend] = None,
+        columnar: Optional["ColumnarEngine"] = None,
+        leaderboard: Optional["LeaderboardRefresher"] = None,
+    ):
+        self.db = db
+        # Optional query cache of the application, every query runs when there is none
+        self.cache = cache
+        self.columnar = columnar
+        # Optional leaderboard refresher counting the rating writes
+        self.leaderboard = leaderboard
+
+    async def _run(self, method_name: str, *args: Any, **kwargs: Any) -> Any:
+        """
+        Run a Crud method on the sync session wrapped by the async session
+
+        :param method_name: name of the Crud method to run
+        :return: result of the Crud method
+        """
+        return await self.db.run_sync(
+            lambda session: getattr(Crud(session, self.columnar), method_name)(
+                *args, **kwargs
+            )
+        )
+
+    async def _run_cached(
+        self,
+        key: tuple,
+        tags: Callable[[list[Row]], Iterable],
+        method_name: str,
+        *args: Any,
+    ) -> list[Row]:
+        """
+        Run a Crud method returning rows through the query cache. Sessions on a read replica skip
+        the cache while the latest write may not have reached the replica yet, so rows older than
+        what the cache was invalidated for are never stored.
+
+        :param key: normalized query key
+        :param tags: function returning the invalidation tags of the rows
+        :param method_name: name of the Crud method to run
+        :return: rows returned by the Crud method, or their cached copy
+        """
+        if (
+            self.cache is None
+            or not self.cache.enabled
+            or await self._replica_may_lag()
+        ):
+            return await self._run(method_name, *args)
+
+        async def load() -> tuple[Row, ...]:
+            return tuple(await self._run(method_name, *args))
+
+        return list(await self.cache.get_or_load(key, load, tags))
+
+    async def _replica_may_lag(self) -> bool:
+        """
+        Check whether the session reads from a replica which may not have the latest writes
+
+        :return: True if the session is on a replica and the data changed within its max lag
+        """
+        if not self.db.info.get("replica"):
+            return False
+        version = await self.cache.data_version()
+        return (
+            version is None
+            or time() - version.modified_at < self.db.info["replica_max_lag"]
+        )
+
+    @staticmethod
+    def _ranking_tags(user_id: Optional[int], rows: list[Row]) -> list:
+        """
+        Invalidation tags of a ranking of all users or of the ratings of one user
+
+        :param user_id: id of the user, None for the ranking of all users
+        :param rows: rows of the ranking
+        :return: the leaderboard tag, or the tags of the user and of every rated movie
+        """
+        if user_id is None:
+            return [LEADERBOARD_TAG]
+        return [user_tag(user_id), *{movie_tag(row.id) for row in rows}]
+
+    def _apply_columnar(
+        self, changes: Iterable[tuple[int, int, Optional[int]]]
+    ) -> None:
+        """
+        Apply committed rating writes to the columnar engine, if there is one
+
+        :param changes: (user id, movie id, new rating) of every write, None for a deletion
+        """
+        if self.columnar is not None:
+            self.columnar.apply(changes)
+
+    async def _invalidate(
+        self, ratings: Iterable[tuple[int, int]], listings: bool
+    ) -> None:
+        """
+        Evict the cached results made stale by changed ratings
+
+        :param ratings: (user id, movie id) of every changed rating
+        :param listings: whether ratings were added or removed, which changes which ratings the
+            movie listings hold and not only their values
+        """
+        ratings = list(ratings)
+        if self.leaderboard is not None:
+            self.leaderboard.mark_changed(movie_id for _, movie_id in ratings)
+        tags = {LEADERBOARD_TAG, RATINGS_TAG}
+        for user_id, movie_id in ratings:
+            tags.update((user_tag(user_id), movie_tag(movie_id)))
+        if listings:
+            tags.add(MOVIE_LISTING_TAG)
+        if self.cache is not None:
+            await self.cache.invalidate(*tags)
+
+    async def get_movies_info(
+        self,
+        title: Optional[str] = None,
+        genre: Optional[str] = None,
+        year: Optional[str] = None,
+        mode: SearchMode = "contains",
+        limit: Optional[int] = None,
+        after: Optional[tuple] = None,
+        fields: Optional[Iterable[str]] = None,
+    ) -> list[Row]:
+        """
+        Get movies from the database that match the given filters (if any) and return them
+
+        :param title: title of the movie
+        :param genre: genre of the movie
+        :param year: year of the movie, matched exactly
+        :param mode: how title and genre are matched: contains, prefix or fuzzy
+        :param limit: Optional maximum number of movies to return
+        :param after: Optional sort key of the last movie of the previous page
+        :param fields: Optional MovieSchema fields to select, all fields by default
+        :return: list of movies that match the given filters
+        """
+        key = (
+            "movies",
+            title and title.lower(),
+            genre and genre.lower(),
+            year,
+            mode,
+            limit,
+            after,
+            fields and tuple(sorted(set(fields))),
+        )
+        return await self._run_cached(
+            key,
+            lambda rows: [MOVIE_LISTING_TAG, *{movie_tag(row.id) for row in rows}],
+            "get_movies_info",
+            title,
+            genre,
+            year,
+            mode,
+            limit,
+            after,
+            fields,
+        )
+
+    async def stream_movies_info(
+        self,
+        title: Optional[str] = None,
+        genre: Optional[str] = None,
+        year: Optional[str] = None,
+        mode: SearchMode = "contains",
+        fields: Optional[Iterable[str]] = None,
+        batch_size: int = 1000,
+    ) -> AsyncIterator[list[Row]]:
+        """
+        Stream the movies that match the given filters (if any) in batches, through a server side
+        cursor, so only one batch is held in memory at a time
+
+        :param title: title of the movie
+        :param genre: genre of the movie
+        :param year: year of the movie, matched exactly
+        :param mode: how title and genre are matched: contains, prefix or fuzzy
+        :param fields: Optional MovieSchema fields to select, all fields by default
+        :param batch_size: number of rows fetched from the cursor at a time
+        :return: async iterator of row batches
+        """
+        queries = await self._run(
+            "select_movies_info", title, genre, year, mode, fields=fields
+        )
+        for query in queries:
+            result = await self.db.stream(query.execution_options(yield_per=batch_size))
+            async for rows in result.partitions():
+                yield rows
+
+    async def get_movie_rating_by_unique_filter(
+        self, movie_id: int, user_id: int
+    ) -> Any:
+        """
+        Get a movie from the database by its movie id and user id
+
+        :param movie_id: movie id of the movie to retrieve
+        :param user_id: user id of the movie to retrieve
+        :return: movie with the given movie id or user id.
+        """
+        return await self._run("get_movie_rating_by_unique_filter", movie_id, user_id)
+
+    async def get_movie_average_rating(self, movie_id: int) -> Any:
+        """
+        Get the average rating of a movie
+
+        :param movie_id: id of the movie
+        :return: select average rating of the movie
+        """
+        return await self._run("get_movie_average_rating", movie_id)
+
+    async def update_movie_rating(
+        self, movie_id: int, user_id: int, rating: int
+    ) -> Optional[Row]:
+        """
+        Update the rating of a movie for a given user in the database
+
+        :param movie_id: id of the movie
+        :param user_id: id of the user
+        :param rating: rating of the movie
+        :return: updated movie rating
+        """
+        db_rating = await self._run("update_movie_rating", movie_id, user_id, rating)
+        if db_rating is not None:
+            self._apply_columnar([(user_id, movie_id, rating)])
+            await self._invalidate([(user_id, movie_id)], listings=False)
+        return db_rating
+
+    async def delete_movie_rating(self, movie_id: int, user_id: int) -> bool:
+        """
+        Delete the rating of a movie for a given user
+
+        :param movie_id: id of the movie
+        :param user_id: id of the user
+        :return: True if a rating was deleted
+        """
+        deleted = await self._run("delete_movie_rating", movie_id, user_id)
+        if deleted:
+            self._apply_columnar([(user_id, movie_id, None)])
+            await self._invalidate([(user_id, movie_id)], listings=True)
+        return deleted
+
+    async def bulk_upsert_ratings(
+        self, ratings: List[RatingInSchema], create: bool = True
+    ) -> dict[tuple[int, int], str]:
+        """
+        Insert or overwrite many ratings in one transaction
+
+        :param ratings: validated ratings to write
+        :param create: whether to create missing ratings, or only overwrite existing ones
+        :return: created, updated, unchanged, movie_not_found or rating_not_found by
+            (user id, movie id)
+        """
+        statuses = await self._run(
+            "bulk_upsert_ratings", ratings, BULK_BATCH_SIZE, create
+        )
+        changed = [
+            key for key, status in statuses.items() if status in ("created", "updated")
+        ]
+        if changed:
+            # Later ratings of the same movie and user overwrite the earlier ones
+            values = {
+                (rating.user_id, rating.movie_id): rating.rating for rating in ratings
+            }
+            self._apply_columnar(
+                (user_id, movie_id, values[user_id, movie_id])
+                for user_id, movie_id in changed
+            )
+            await self._invalidate(changed, listings="created" in statuses.values())
+        return statuses
+
+    async def get_top_five_movie_ratings(
+        self,
+        user_id: Optional[int] = None,
+        k: int = 5,
+        min_votes: int = 1,
+        genre: Optional[str] = None,
+        year: Optional[str] = None,
+    ) -> list[Row]:
+        """
+        Retrieve the top five movie average ratings from the database, optionally for one user
+
+        :param user_id: Optional user id to filter movies
+        :param k: number of movies to rank for all users
+        :param min_votes: minimum number of ratings a movie needs to be ranked for all users
+        :param genre: Optional genre to rank movies of all users in
+        :param year: Optional year to rank movies of all users in
+        :return: list of top five movie average ratings
+        """
+        if self.columnar is not None and self.columnar.ready:
+            # Answered from memory, without touching the session
+            if user_id is None:
+                return self.columnar.top_movies(k, min_votes, genre, year)
+            return self.columnar.user_top_ratings(user_id, 5)
+        if user_id is None:
+            key = ("rankings", k, max(min_votes, 1), genre and genre.lower(), year)
+        else:
+            key = ("user_ratings", user_id, 5, None)
+        return await self._run_cached(
+            key,
+            lambda rows: self._ranking_tags(user_id, rows),
+            "get_top_five_movie_ratings",
+            user_id,
+            k,
+            min_votes,
+            genre,
+            year,
+        )
+
+    async def get_user_ratings_page(
+        self,
+        user_id: int,
+        limit: int,
+        after: Optional[tuple[int, int]] = None,
+    ) -> list[Row]:
+        """
+        Retrieve one page of a user's ratings, highest rating first
+
+        :param user_id: id of the user
+        :param limit: maximum number of ratings to return
+        :param after: Optional (rating, movie id) of the last rating of the previous page
+        :return: list of ratings of the user
+        """
+        return await self._run_cached(
+            ("user_ratings", user_id, limit, after),
+            lambda rows: self._ranking_tags(user_id, rows),
+            "get_user_ratings_page",
+            user_id,
+            limit,
+            after,
+        )
+
+    async def get_top_movie_rankings(
+        self,
+        k: int = 5,
+        min_votes: int = 1,
+        genre: Optional[str] = None,
+        year: Optional[str] = None,
+    ) -> list[Row]:
+        """
+        Rank the top k distinct movies by average rating
+
+        :param k: number of movies to return
+        :param min_votes: minimum number of ratings a movie needs to be ranked
+        :param genre: Optional genre the movies must have
+        :param year: Optional year the movies must be released in
+        :return: list of movies with their average rating and number of ratings
+        """
+        return await self._run_cached(
+            ("rankings", k, max(min_votes, 1), genre and genre.lower(), year),
+            lambda rows: self._ranking_tags(None, rows),
+            "get_top_movie_rankings",
+            k,
+            min_votes,
+            genre,
+            year,
+        )
+
+    async def get_leaderboard(
+        self,
+        k: int = 5,
+        min_votes: int = 1,
+        genre: Optional[str] = None,
+        year: Optional[str] = None,
+    ) -> Optional[list[Row]]:
+        """
+        Read the top k distinct movies by average rating from the leaderboard. It is not cached,
+        the read is a short range scan and the leaderboard only changes when it is refreshed.
+
+        :param k: number of movies to return
+        :param min_votes: minimum number of ratings a movie needs to be ranked
+        :param genre: Optional genre the movies must have
+        :param year: Optional year the movies must be released in
+        :return: list of movies with their refresh time, None if the ranking is not stored or
+            the columnar engine ranks on request
+        """
+        if self.columnar is not None and self.columnar.ready:
+            return None
+        if self.leaderboard is None:
+            return await self._run("get_leaderboard", k, min_votes, genre, year)
+        return await self._run(
+            "get_leaderboard",
+            k,
+            min_votes,
+            genre,
+            year,
+            self.leaderboard.size,
+            self.leaderboard.min_votes,
+        )
+
+    async def get_similar_movies(
+        self, movie_id: int, k: int, index: SimilarityIndex
+    ) -> list[SimilarRow]:
+        """
+        Read the most similar movies of a movie from the neighbor index
+
+        :param movie_id: id of the movie
+        :param k: number of movies to return
+        :param index: neighbor index
+        :return: list of movies with their cosine similarity, most similar first
+        """
+        return await self._run("get_similar_movies", movie_id, k, index)
+
+    async def get_recommendations(
+        self, user_id: int, k: int, index: SimilarityIndex
+    ) -> list[SimilarRow]:
+        """
+        Recommend the movies most similar to the ones a user rated highly
+
+        :param user_id: id of the user
+        :param k: number of movies to return
+        :param index: neighbor index
+        :return: list of movies the user did not rate with their score, highest score first
+        """
+        return await self._run("get_recommendations", user_id, k, index)
+
+    async def get_movie_for_one_user(
+        self, movie_id: int, user_id: int
+    ) -> Optional[Row]:
+        """
+        Retrieve the ratings for a given movie from the database for one user only
+
+        :param movie_id: id of the movie to retrieve
+        :param user_id: user id of the movie to retrieve
+        :return: movie with the given id and user id
+        """
+        return await self._run("get_movie_for_one_user", movie_id, user_id)
+
+    create_movie_schema_list = staticmethod(Crud.create_movie_schema_list)
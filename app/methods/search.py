@@ -0,0 +1,284 @@
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Lock
+from typing import Iterator, Literal, Optional
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import (
+    ColumnElement,
+    Select,
+    and_,
+    case,
+    func,
+    literal,
+    or_,
+    select,
+    text,
+)
+from sqlalchemy.orm import Session
+
+from app.models.movie import CatalogVersion, Movie
+
+SearchMode = Literal["contains", "prefix", "fuzzy"]
+
+# Minimum trigram similarity for a fuzzy match, same as the pg_trgm default
+FUZZY_THRESHOLD = 0.3
+
+# Most movie ids inlined in one query by the n-gram search, the matches are queried in chunks
+NGRAM_CHUNK_SIZE = 1000
+
+# Movie columns the search can filter on
+SEARCH_FIELDS = {"title": Movie.title, "genre": Movie.genre}
+
+
+def trigrams(text: str) -> set[str]:
+    """
+    Split a lower case text into trigrams, padded like pg_trgm so the start and end of the text
+    count as well
+
+    :param text: lower case text
+    :return: set of trigrams
+    """
+    padded = f"  {text} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def similarity(query: str, text: str) -> float:
+    """
+    Trigram similarity of two lower case texts, the share of trigrams they have in common
+
+    :param query: lower case search text
+    :param text: lower case text to compare with
+    :return: similarity between 0 and 1
+    """
+    query_trigrams, text_trigrams = trigrams(query), trigrams(text)
+    return len(query_trigrams & text_trigrams) / len(query_trigrams | text_trigrams)
+
+
+class TrigramSearch:
+    """
+    Search backed by pg_trgm on Postgres. Every mode is served by the GIN indexes and matches are
+    ranked by their trigram similarity to the search text.
+    """
+
+    def apply(
+        self,
+        db: Session,
+        query: Select,
+        filters: dict,
+        mode: SearchMode,
+        after: Optional[tuple[float, int]] = None,
+        chunk_size: Optional[int] = None,
+    ) -> Iterator[tuple[Select, ColumnElement]]:
+        """
+        Filter a select statement by the given field filters and score the matches. Postgres
+        ranks every match in one statement, so the matches are never split in chunks.
+
+        :param db: database session
+        :param query: select statement of the movies table
+        :param filters: search text by field name
+        :param mode: contains, prefix or fuzzy matching
+        :param after: Optional (relevance, movie id) of the first movie that may be returned,
+            movies ranked before it are left out
+        :param chunk_size: unused
+        :return: the filtered select statement and its relevance score expression
+        """
+        score = literal(0.0)
+        for field, text in filters.items():
+            column = func.lower(SEARCH_FIELDS[field])
+            text = text.lower()
+            if mode == "contains":
+                query = query.where(column.contains(text, autoescape=True))
+            elif mode == "prefix":
+                query = query.where(column.startswith(text, autoescape=True))
+            else:
+                query = query.where(column.op("%")(text))
+            score = score + func.similarity(column, text)
+        if after is not None:
+            after_relevance, after_movie = after
+            query = query.where(
+                or_(
+                    score < after_relevance,
+                    and_(score == after_relevance, Movie.id >= after_movie),
+                )
+            )
+        return iter([(query, score)])
+
+
+class NgramIndex:
+    """
+    In-process trigram inverted index of the movie catalog, used where pg_trgm is not available.
+    The index is rebuilt when the catalog version changes.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.texts: dict[str, dict[int, str]] = {}
+        self.postings: dict[str, dict[str, set[int]]] = {}
+        self.lock = Lock()
+
+    def refresh(self, db: Session) -> None:
+        """
+        Rebuild the index if the catalog version changed since it was built
+
+        :param db: database session
+        """
+        version = db.execute(
+            select(CatalogVersion.epoch, CatalogVersion.version)
+        ).first()
+        # Without a version row every change goes unnoticed, so the index is always rebuilt
+        version = tuple(version) if version is not None else None
+        if version is not None and version == self.version:
+            return
+        # Read before taking the lock: under AsyncSession.run_sync a query hands the event loop
+        # over to other requests, which would block it on the lock while it is held
+        movies = db.execute(select(Movie.id, *SEARCH_FIELDS.values())).all()
+        with self.lock:
+            if version is not None and version == self.version:
+                return
+            texts = {field: {} for field in SEARCH_FIELDS}
+            postings = {field: defaultdict(set) for field in SEARCH_FIELDS}
+            for movie in movies:
+                for field in SEARCH_FIELDS:
+                    text = (getattr(movie, field) or "").lower()
+                    texts[field][movie.id] = text
+                    for trigram in trigrams(text):
+                        postings[field][trigram].add(movie.id)
+            self.texts, self.postings, self.version = texts, postings, version
+
+    def candidates(self, field: str, text: str, mode: SearchMode) -> set[int]:
+        """
+        Movie ids that share trigrams with the search text
+
+        :param field: field to search
+        :param text: lower case search text
+        :param mode: contains, prefix or fuzzy matching
+        :return: set of candidate movie ids
+        """
+        postings = self.postings[field]
+        if mode == "fuzzy":
+            return set().union(*(postings.get(t, ()) for t in trigrams(text)))
+        padded = f"  {text}" if mode == "prefix" else text
+        required = [padded[i : i + 3] for i in range(len(padded) - 2)]
+        if not required:
+            return set(self.texts[field])
+        return set.intersection(*(postings.get(t, set()) for t in required))
+
+    def search(self, filters: dict, mode: SearchMode) -> dict[int, float]:
+        """
+        Score the movies matching every field filter
+
+        :param filters: search text by field name
+        :param mode: contains, prefix or fuzzy matching
+        :return: relevance score by movie id
+        """
+        scores: Optional[dict[int, float]] = None
+        for field, text in filters.items():
+            text = text.lower()
+            texts = self.texts[field]
+            field_scores = {}
+            for movie_id in self.candidates(field, text, mode):
+                if scores is not None and movie_id not in scores:
+                    continue
+                score = similarity(text, texts[movie_id])
+                if (
+                    (mode == "contains" and text in texts[movie_id])
+                    or (mode == "prefix" and texts[movie_id].startswith(text))
+                    or (mode == "fuzzy" and score >= FUZZY_THRESHOLD)
+                ):
+                    field_scores[movie_id] = (scores or {}).get(movie_id, 0) + score
+            scores = field_scores
+        return scores or {}
+
+
+class NgramSearch:
+    """
+    Search backed by an NgramIndex per database engine
+    """
+
+    indexes: "WeakKeyDictionary[object, NgramIndex]" = WeakKeyDictionary()
+
+    def apply(
+        self,
+        db: Session,
+        query: Select,
+        filters: dict,
+        mode: SearchMode,
+        after: Optional[tuple[float, int]] = None,
+        chunk_size: Optional[int] = None,
+    ) -> Iterator[tuple[Select, ColumnElement]]:
+        """
+        Filter a select statement by the given field filters and score the matches. The matches
+        are ranked in process and their ids inlined in the statement, a chunk of them at a time,
+        so a search matching most of the catalog doesn't exceed the bind parameter limits.
+
+        :param db: database session
+        :param query: select statement of the movies table
+        :param filters: search text by field name
+        :param mode: contains, prefix or fuzzy matching
+        :param after: Optional (relevance, movie id) of the first movie that may be returned,
+            movies ranked before it are left out
+        :param chunk_size: Optional number of movies in the first chunk, later chunks double in
+            size up to NGRAM_CHUNK_SIZE
+        :return: iterator of the filtered select statement and its relevance score expression,
+            by chunk of matches in ranking order
+        """
+        index = self.indexes.setdefault(db.get_bind(), NgramIndex())
+        index.refresh(db)
+        ranked = sorted(
+            index.search(filters, mode).items(), key=lambda item: (-item[1], item[0])
+        )
+        if after is not None:
+            after_relevance, after_movie = after
+            start = bisect_left(
+                ranked,
+                (-after_relevance, after_movie),
+                key=lambda item: (-item[1], item[0]),
+            )
+            ranked = ranked[start:]
+        return self._chunks(query, ranked, chunk_size or NGRAM_CHUNK_SIZE)
+
+    @staticmethod
+    def _chunks(
+        query: Select, ranked: list[tuple[int, float]], size: int
+    ) -> Iterator[tuple[Select, ColumnElement]]:
+        """
+        Filter a select statement by consecutive chunks of ranked matches
+
+        :param query: select statement of the movies table
+        :param ranked: (movie id, relevance) of the matches, most relevant first
+        :param size: number of matches in the first chunk
+        :return: iterator of the filtered select statement and its relevance score expression
+        """
+        start = 0
+        while start < len(ranked):
+            size = min(size, NGRAM_CHUNK_SIZE)
+            scores = dict(ranked[start : start + size])
+            yield query.where(Movie.id.in_(scores)), case(scores, value=Movie.id)
+            start += size
+            size *= 2
+
+
+# Whether pg_trgm is installed, by database engine
+_has_pg_trgm: "WeakKeyDictionary[object, bool]" = WeakKeyDictionary()
+
+
+def get_search_backend(db: Session) -> TrigramSearch | NgramSearch:
+    """
+    Pick the search backend for the database the session is bound to
+
+    :param db: database session
+    :return: pg_trgm search on Postgres with pg_trgm installed, in-process n-gram index search
+        elsewhere
+    """
+    bind = db.get_bind()
+    if bind.dialect.name != "postgresql":
+        return NgramSearch()
+    if bind not in _has_pg_trgm:
+        _has_pg_trgm[bind] = (
+            db.execute(
+                text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            ).first()
+            is not None
+        )
+    return TrigramSearch() if _has_pg_trgm[bind] else NgramSearch()
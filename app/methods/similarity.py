@@ -0,0 +1,180 @@
+import mmap
+import os
+import struct
+from bisect import bisect_left
+from collections import namedtuple
+from threading import Lock
+from time import monotonic
+from typing import Iterable, Optional
+
+from app.schemas.base import SimilarMovieSchema
+from app.settings import Settings
+
+# Index file layout, little endian: header, then one section per array. Every movie has a row of
+# the same number of neighbors, most similar first, padded with movie id -1 and score 0.
+INDEX_MAGIC = b"MSIM"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct("<4sIII")  # magic, version, movies, neighbors per movie
+
+# Rows returned for similar and recommended movies, shaped like SimilarMovieSchema
+SimilarRow = namedtuple("SimilarRow", list(SimilarMovieSchema.model_fields))
+
+
+class IndexFormatError(Exception):
+    """
+    Raised when a file is not a neighbor index this version can read
+    """
+
+
+def index_sections(movies: int, neighbors: int) -> dict[str, tuple[int, int]]:
+    """
+    Offsets of the arrays of an index file. Sections are ordered so every array is aligned on its
+    item size.
+
+    :param movies: number of movies of the index
+    :param neighbors: number of neighbors per movie
+    :return: (offset, length in bytes) of the checksums (uint64 by movie, compared by incremental
+        builds), movie ids (int32, ascending), neighbor ids (int32) and scores (float32)
+    """
+    sections, offset = {}, INDEX_HEADER.size
+    for name, size in (
+        ("checksums", 8 * movies),
+        ("movie_ids", 4 * movies),
+        ("neighbor_ids", 4 * movies * neighbors),
+        ("scores", 4 * movies * neighbors),
+    ):
+        sections[name] = (offset, size)
+        offset += size
+    return sections
+
+
+class SimilarityIndex:
+    """
+    Read-only view of the neighbor index, memory-mapped so every worker shares the pages of the
+    file and a lookup only touches the rows it reads.
+
+    The file is opened on the first lookup. Builds replace it atomically, and the next lookup
+    after the reload interval maps the new file; lookups already running keep
+    reading the old one.
+    """
+
+    def __init__(
+        self,
+        path: str = Settings.similarity_index_path,
+        reload_interval: float = Settings.similarity_reload_interval,
+        min_rating: int = Settings.recommendation_min_rating,
+    ):
+        self.path = path
+        self.reload_interval = reload_interval
+        # Lowest rating of the movies recommendations are based on
+        self.min_rating = min_rating
+        self.file_id: Optional[tuple[int, int]] = None
+        self.checked_at: Optional[float] = None
+        self.movie_ids: Optional[memoryview] = None
+        self.neighbor_ids: Optional[memoryview] = None
+        self.scores: Optional[memoryview] = None
+        self.neighbors_per_movie = 0
+        self.lock = Lock()
+
+    @property
+    def ready(self) -> bool:
+        self.refresh()
+        return self.movie_ids is not None
+
+    def refresh(self) -> None:
+        """
+        Map the index file if it was replaced since it was last mapped, at most once per reload
+        interval
+        """
+        now = monotonic()
+        if self.checked_at is not None and now - self.checked_at < self.reload_interval:
+            return
+        with self.lock:
+            self.checked_at = now
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return
+            file_id = (stat.st_ino, stat.st_mtime_ns)
+            if file_id != self.file_id:
+                self.open()
+                self.file_id = file_id
+
+    def open(self) -> None:
+        """
+        Map the index file and check its header
+        """
+        with open(self.path, "rb") as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(mapped) < INDEX_HEADER.size:
+            raise IndexFormatError(f"{self.path} is not a neighbor index")
+        magic, version, movies, neighbors = INDEX_HEADER.unpack_from(mapped)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise IndexFormatError(
+                f"{self.path} is not a version {INDEX_VERSION} index"
+            )
+        sections = index_sections(movies, neighbors)
+        if len(mapped) != sum(sections["scores"]):
+            raise IndexFormatError(f"{self.path} is truncated")
+        view = memoryview(mapped)
+        arrays = {
+            name: view[offset : offset + size].cast("f" if name == "scores" else "i")
+            for name, (offset, size) in sections.items()
+            if name != "checksums"
+        }
+        self.neighbors_per_movie = neighbors
+        self.movie_ids = arrays["movie_ids"]
+        self.neighbor_ids = arrays["neighbor_ids"]
+        self.scores = arrays["scores"]
+
+    def neighbors(
+        self, movie_id: int, k: Optional[int] = None
+    ) -> list[tuple[int, float]]:
+        """
+        Look up the most similar movies of a movie, a binary search of the movie ids
+
+        :param movie_id: id of the movie
+        :param k: Optional number of neighbors to return, all stored neighbors by default
+        :return: (movie id, cosine similarity) of the neighbors, most similar first, empty if
+            the movie is not in the index
+        """
+        self.refresh()
+        movie_ids, neighbor_ids, scores = self.movie_ids, self.neighbor_ids, self.scores
+        if movie_ids is None:
+            return []
+        row = bisect_left(movie_ids, movie_id)
+        if row == len(movie_ids) or movie_ids[row] != movie_id:
+            return []
+        width = self.neighbors_per_movie
+        start = row * width
+        end = start + (width if k is None else min(width, k))
+        return [
+            (neighbor_id, score)
+            for neighbor_id, score in zip(neighbor_ids[start:end], scores[start:end])
+            if neighbor_id >= 0
+        ]
+
+    def recommend(
+        self, ratings: Iterable[tuple[int, int]], k: int
+    ) -> list[tuple[int, float]]:
+        """
+        Score the neighbors of the movies a user rated, item-based: a movie scores the sum of its
+        similarities to the rated movies, each weighted by the user's rating
+
+        :param ratings: (movie id, rating) of every rating of the user
+        :param k: number of movies to return
+        :return: (movie id, score) of the best scored movies the user did not rate, highest score
+            first
+        """
+        ratings = list(ratings)
+        rated = {movie_id for movie_id, _ in ratings}
+        scores: dict[int, float] = {}
+        for movie_id, rating in ratings:
+            if rating < self.min_rating:
+                continue
+            for neighbor_id, similarity in self.neighbors(movie_id):
+                if neighbor_id not in rated:
+                    scores[neighbor_id] = (
+                        scores.get(neighbor_id, 0.0) + similarity * rating
+                    )
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]
@@ -0,0 +1,31 @@
+from importlib import import_module
+from typing import Any
+
+from sqlalchemy import Table
+from sqlalchemy.orm import Session
+
+# Modules of the dialects that support INSERT ... ON CONFLICT, imported on first use so a worker
+# only loads the dialect of its database
+UPSERT_DIALECTS = {
+    "postgresql": "sqlalchemy.dialects.postgresql",
+    "sqlite": "sqlalchemy.dialects.sqlite",
+}
+
+
+def upsert_insert(db: Session | Any, table: Table | Any) -> Any:
+    """
+    Build an INSERT statement for the dialect of the given session or connection that supports
+    `on_conflict_do_update` and `on_conflict_do_nothing`
+
+    :param db: session or connection the statement will be executed on
+    :param table: table or model to insert into
+    :return: dialect specific insert statement
+    """
+    dialect_name = (
+        db.get_bind().dialect.name if isinstance(db, Session) else db.dialect.name
+    )
+    try:
+        module = UPSERT_DIALECTS[dialect_name]
+    except KeyError:
+        raise NotImplementedError(f"Upserts are not supported on {dialect_name}")
+    return import_module(module).insert(table)
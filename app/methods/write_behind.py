@@ -0,0 +1,481 @@
+import asyncio
+import fcntl
+import logging
+import os
+import re
+from itertools import count, islice
+from time import monotonic, perf_counter
+from typing import TYPE_CHECKING, Iterable, Optional
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.database import Database
+from app.instrumentation import WRITE_BEHIND_BATCH_RATINGS, WRITE_BEHIND_FLUSH_SECONDS
+from app.methods.leaderboard import SCHEMA_POLL_INTERVAL
+from app.methods.routes_class import AsyncCrud
+from app.schemas.base import RatingInSchema
+from app.settings import Settings
+
+if TYPE_CHECKING:
+    from app.methods.cache import CacheBackend
+    from app.methods.columnar import ColumnarEngine
+    from app.methods.leaderboard import LeaderboardRefresher
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait before flushing again after a failed flush
+WRITE_BEHIND_RETRY_INTERVAL = 1.0
+
+# Log file names, numbered by slot; a worker holds the lock file of its slot while it runs
+LOG_NAME = re.compile(r"ratings-(\d+)\.log")
+
+
+class WriteBufferFull(Exception):
+    """
+    Raised when a write waited too long for room in a full buffer
+    """
+
+
+def parse_log(path: str) -> list[tuple[int, int, int, int]]:
+    """
+    Read the writes of a log that were not flushed yet.
+
+    Lines are "w <sequence> <user id> <movie id> <rating>" for a write, and "c <sequence>" for a
+    checkpoint: every write up to the sequence is in the database. Reading stops at the first
+    line that can't be parsed, which is a line torn by a crash while it was written.
+
+    :param path: path of the log
+    :return: (sequence, user id, movie id, rating) of the writes after the last checkpoint, in
+        sequence order
+    """
+    writes, checkpoint = [], 0
+    try:
+        with open(path, "rb") as file:
+            for line in file:
+                fields = line.split()
+                try:
+                    if line.endswith(b"\n") and fields[0] == b"w" and len(fields) == 5:
+                        writes.append(tuple(int(field) for field in fields[1:]))
+                    elif (
+                        line.endswith(b"\n") and fields[0] == b"c" and len(fields) == 2
+                    ):
+                        checkpoint = int(fields[1])
+                    else:
+                        break
+                except (IndexError, ValueError):
+                    break
+    except FileNotFoundError:
+        return []
+    return [write for write in writes if write[0] > checkpoint]
+
+
+def try_lock(path: str) -> Optional[int]:
+    """
+    :param path: path of a lock file, created when missing
+    :return: descriptor of the lock file holding an exclusive lock on it, None if another
+        process (or another descriptor of this one) holds it
+    """
+    fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+class RatingLog:
+    """
+    Append-only write-ahead log of the rating writes a worker acknowledged but did not flush yet.
+
+    Each worker claims a numbered log by locking its lock file, which the system releases when
+    the worker dies, so a worker starting later claims the log of a crashed worker and replays
+    it. Appends go to the page cache and are made durable by one fsync shared by every write
+    waiting for it (group commit).
+    """
+
+    def __init__(self, directory: str = Settings.write_behind_log_dir):
+        self.directory = directory
+        self.path: Optional[str] = None
+        self.fd: Optional[int] = None
+        self.lock_fd: Optional[int] = None
+        self.size = 0
+        self.appended = 0
+        self.synced = 0
+        self.sync_task: Optional[asyncio.Future] = None
+
+    def open(self) -> list[tuple[int, int, int, int]]:
+        """
+        Claim a log, and take over the logs no running worker holds, e.g. when fewer workers run
+        than before. The writes still pending in them are rewritten to the claimed log,
+        renumbered from 1 in replay order.
+
+        :return: (sequence, user id, movie id, rating) of the writes to replay
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        for slot in count():
+            lock_fd = try_lock(os.path.join(self.directory, f"ratings-{slot}.lock"))
+            if lock_fd is not None:
+                break
+        self.lock_fd = lock_fd
+        self.path = os.path.join(self.directory, f"ratings-{slot}.log")
+        writes = parse_log(self.path)
+        adopted = []
+        for name in sorted(os.listdir(self.directory)):
+            match = LOG_NAME.fullmatch(name)
+            if match is None or int(match.group(1)) == slot:
+                continue
+            lock_path = os.path.join(self.directory, f"ratings-{match.group(1)}.lock")
+            other_lock_fd = try_lock(lock_path)
+            if other_lock_fd is not None:
+                other_path = os.path.join(self.directory, name)
+                writes.extend(parse_log(other_path))
+                adopted.append((other_path, other_lock_fd))
+        writes = [
+            (sequence, user_id, movie_id, rating)
+            for sequence, (_, user_id, movie_id, rating) in enumerate(writes, start=1)
+        ]
+        self.rewrite(f"w {' '.join(map(str, write))}" for write in writes)
+        # The adopted writes are durable in the claimed log before their logs are removed
+        for other_path, other_lock_fd in adopted:
+            os.unlink(other_path)
+            os.close(other_lock_fd)
+        return writes
+
+    def rewrite(self, lines: Iterable[str]) -> None:
+        """
+        Atomically replace the log with the given lines, made durable before the log is reopened
+
+        :param lines: lines of the new log, without their line feed
+        """
+        data = "".join(f"{line}\n" for line in lines).encode()
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.path)
+        directory_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self.size = len(data)
+        self.synced = self.appended
+
+    def append(self, line: str) -> int:
+        """
+        :param line: line to append, without its line feed
+        :return: number of the append, to wait for with sync
+        """
+        data = f"{line}\n".encode()
+        os.write(self.fd, data)
+        self.size += len(data)
+        self.appended += 1
+        return self.appended
+
+    async def sync(self, append_number: int) -> None:
+        """
+        Wait until an append is durable. A single fsync runs at a time, and covers every append
+        made before it started.
+
+        :param append_number: number of the append returned by append
+        """
+        while self.synced < append_number:
+            if self.sync_task is None:
+                self.sync_task = asyncio.ensure_future(self.fsync())
+            await asyncio.shield(self.sync_task)
+
+    async def fsync(self) -> None:
+        appended = self.appended
+        try:
+            await asyncio.to_thread(os.fsync, self.fd)
+            self.synced = max(self.synced, appended)
+        finally:
+            self.sync_task = None
+
+    def close(self) -> None:
+        """
+        Close the log and release its lock, the log is replayed by the next worker claiming it
+        """
+        for fd in (self.fd, self.lock_fd):
+            if fd is not None:
+                os.close(fd)
+        self.fd = self.lock_fd = None
+
+
+class RatingWriteBuffer:
+    """
+    Write-behind buffer of rating updates, run in the app lifespan.
+
+    A write is acknowledged once it is durable in the worker's log, and is written to the
+    database by a background flush, in batches of one transaction. Writes of the same rating are
+    coalesced until it is flushed, so only the last one reaches the database. Writes that were
+    not flushed when the worker stops are kept in the log and replayed when the next worker
+    starts, so a write may be applied twice, which is harmless since it sets an absolute value.
+    """
+
+    def __init__(
+        self,
+        directory: str = Settings.write_behind_log_dir,
+        flush_interval: float = Settings.write_behind_flush_interval,
+        max_batch: int = Settings.write_behind_max_batch,
+        max_pending: int = Settings.write_behind_max_pending,
+        enqueue_timeout: float = Settings.write_behind_enqueue_timeout,
+        log_max_bytes: int = Settings.write_behind_log_max_bytes,
+    ):
+        self.log = RatingLog(directory)
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.enqueue_timeout = enqueue_timeout
+        self.log_max_bytes = log_max_bytes
+        # (user id, movie id) -> (rating, sequence), in sequence order
+        self.pending: dict[tuple[int, int], tuple[int, int]] = {}
+        self.sequence = 0
+        self.database: Optional[Database] = None
+        self.columnar: Optional["ColumnarEngine"] = None
+        self.leaderboard: Optional["LeaderboardRefresher"] = None
+        self.cache: Optional["CacheBackend"] = None
+        self.wake = asyncio.Event()
+        self.space = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    @property
+    def checkpoint(self) -> int:
+        """
+        :return: sequence up to which every write is in the database
+        """
+        for _, sequence in self.pending.values():
+            return sequence - 1
+        return self.sequence
+
+    def add(self, user_id: int, movie_id: int, rating: int, sequence: int) -> None:
+        # Moved to the end, so the pending writes stay in sequence order
+        self.pending.pop((user_id, movie_id), None)
+        self.pending[(user_id, movie_id)] = (rating, sequence)
+
+    def recover(self) -> int:
+        """
+        Open the log, and buffer the writes it holds that were not flushed
+
+        :return: number of writes replayed
+        """
+        writes = self.log.open()
+        for sequence, user_id, movie_id, rating in writes:
+            self.add(user_id, movie_id, rating, sequence)
+        self.sequence = len(writes)
+        return len(writes)
+
+    async def write(self, user_id: int, movie_id: int, rating: int) -> int:
+        """
+        Buffer a rating update, returning once it is durable in the log
+
+        :param user_id: id of the user of the rating
+        :param movie_id: id of the movie of the rating
+        :param rating: new rating
+        :return: sequence of the write
+        :raises WriteBufferFull: if the buffer stayed full for the enqueue timeout
+        """
+        if (
+            user_id,
+            movie_id,
+        ) not in self.pending and len(self.pending) >= self.max_pending:
+            await self.wait_for_space()
+        self.sequence += 1
+        sequence = self.sequence
+        append_number = self.log.append(f"w {sequence} {user_id} {movie_id} {rating}")
+        self.add(user_id, movie_id, rating, sequence)
+        if len(self.pending) >= self.max_batch:
+            self.wake.set()
+        await self.log.sync(append_number)
+        return sequence
+
+    async def wait_for_space(self) -> None:
+        self.wake.set()
+        deadline = monotonic() + self.enqueue_timeout
+        while len(self.pending) >= self.max_pending:
+            self.space.clear()
+            try:
+                await asyncio.wait_for(
+                    self.space.wait(), max(deadline - monotonic(), 0)
+                )
+            except asyncio.TimeoutError:
+                raise WriteBufferFull(
+                    f"{len(self.pending)} rating writes are waiting to be flushed"
+                )
+
+    async def flush(self) -> int:
+        """
+        Write the oldest pending writes to the database in one transaction, then checkpoint the
+        log
+
+        :return: number of ratings written
+        """
+        async with self.flush_lock:
+            if not self.pending:
+                return 0
+            batch = {
+                key: self.pending.pop(key)
+                for key in list(islice(self.pending, self.max_batch))
+            }
+            start = perf_counter()
+            try:
+                async with self.database.AsyncSessionLocal() as session:
+                    statuses = await AsyncCrud(
+                        session,
+                        cache=self.cache,
+                        columnar=self.columnar,
+                        leaderboard=self.leaderboard,
+                    ).bulk_upsert_ratings(
+                        [
+                            RatingInSchema(
+                                user_id=user_id, movie_id=movie_id, rating=rating
+                            )
+                            for (user_id, movie_id), (rating, _) in batch.items()
+                        ],
+                        create=False,
+                    )
+            except BaseException:
+                # Writes made since the batch was taken are newer, and replace the batch's
+                restored = {
+                    key: value
+                    for key, value in batch.items()
+                    if key not in self.pending
+                }
+                self.pending = dict(
+                    sorted(
+                        (restored | self.pending).items(), key=lambda item: item[1][1]
+                    )
+                )
+                WRITE_BEHIND_FLUSH_SECONDS.observe(perf_counter() - start, "error")
+                raise
+            WRITE_BEHIND_FLUSH_SECONDS.observe(perf_counter() - start, "ok")
+            WRITE_BEHIND_BATCH_RATINGS.observe(len(batch))
+            dropped = [
+                key
+                for key, status in statuses.items()
+                if status in ("movie_not_found", "rating_not_found")
+            ]
+            if dropped:
+                logger.warning(
+                    "Dropped %d buffered rating writes of deleted ratings: %s",
+                    len(dropped),
+                    dropped[:10],
+                )
+            self.space.set()
+            self.log.append(f"c {self.checkpoint}")
+            if self.log.size > self.log_max_bytes:
+                # The running fsync must not outlive the descriptor of the replaced log
+                while self.log.sync_task is not None:
+                    await asyncio.shield(self.log.sync_task)
+                self.log.rewrite(
+                    f"w {sequence} {user_id} {movie_id} {rating}"
+                    for (user_id, movie_id), (rating, sequence) in self.pending.items()
+                )
+            return len(batch)
+
+    async def drain(self) -> None:
+        """
+        Flush every write buffered so far and make the checkpoint durable, before ratings are
+        written to the database without the buffer, so a replay of the log after a crash can't
+        overwrite them with older writes
+        """
+        sequence = self.sequence
+        while self.pending and self.checkpoint < sequence:
+            await self.flush()
+        await self.log.sync(self.log.appended)
+
+    async def run(self) -> None:
+        """
+        Flush the pending writes until cancelled, every flush interval once the first request
+        prepared the schema, and as soon as a batch is full
+        """
+        while not self.database.schema_ready:
+            await asyncio.sleep(SCHEMA_POLL_INTERVAL)
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            try:
+                await self.flush()
+                while len(self.pending) >= self.max_batch:
+                    await self.flush()
+            except (SQLAlchemyError, OSError) as error:
+                logger.warning("Flushing buffered rating writes failed: %s", error)
+                await asyncio.sleep(WRITE_BEHIND_RETRY_INTERVAL)
+
+    def start(
+        self,
+        database: Database,
+        columnar: Optional["ColumnarEngine"] = None,
+        leaderboard: Optional["LeaderboardRefresher"] = None,
+        cache: Optional["CacheBackend"] = None,
+    ) -> None:
+        """
+        Replay the log and start flushing in the background, in the running event loop
+
+        :param database: database of the application
+        :param columnar: Optional columnar engine the flushed writes are applied to
+        :param leaderboard: Optional leaderboard refresher the flushed writes are counted by
+        :param cache: Optional query cache the flushed writes invalidate
+        """
+        self.database = database
+        self.columnar = columnar
+        self.leaderboard = leaderboard
+        self.cache = cache
+        self.wake = asyncio.Event()
+        self.space = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+        replayed = self.recover()
+        if replayed:
+            logger.info("Replaying %d buffered rating writes", replayed)
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """
+        Stop the background flushes and flush the pending writes, the writes that can't be
+        flushed stay in the log
+        """
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        try:
+            while self.pending:
+                await self.flush()
+        except (SQLAlchemyError, OSError) as error:
+            logger.warning(
+                "%d buffered rating writes kept in %s: %s",
+                len(self.pending),
+                self.log.path,
+                error,
+            )
+        if self.log.sync_task is not None:
+            await self.log.sync(self.log.appended)
+        self.log.close()
+
+    def render(self) -> list[str]:
+        """
+        :return: lines of the buffer state in the Prometheus text format
+        """
+        return [
+            "# TYPE write_behind_pending gauge",
+            f"write_behind_pending {len(self.pending)}",
+            "# TYPE write_behind_log_bytes gauge",
+            f"write_behind_log_bytes {self.log.size}",
+        ]
@@ -1,21 +1,200 @@
-from sqlalchemy import Column, Integer, String
-from sqlalchemy.orm import declarative_base
+from uuid import uuid4
+
+from sqlalchemy import (
+    Column,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    event,
+    insert,
+    text,
+)
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import declarative_base, relationship
 
 Base = declarative_base()
 
 
 class Movie(Base):
     """
-    Movie model
+    Movie model, one row per movie in the catalog
     """
 
     __tablename__ = "movies"
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, index=True)
     title = Column(String, index=True)
     genre = Column(String)
-    rating = Column(Integer)
+    year = Column(String, index=True)
+    runtime = Column(String)
+
+    ratings = relationship("Rating", back_populates="movie")
+    aggregate = relationship(
+        "MovieRatingAggregate", back_populates="movie", uselist=False
+    )
+
+
+# pg_trgm GIN indexes serving the title and genre search (LIKE '%x%', LIKE 'x%' and similarity)
+TRIGRAM_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS ix_movies_title_trgm ON movies USING gin (lower(title) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_movies_genre_trgm ON movies USING gin (lower(genre) gin_trgm_ops)",
+)
+
+
+@event.listens_for(Movie.__table__, "after_create")
+def create_trigram_indexes(target, connection, **kwargs) -> None:
+    """
+    Create the pg_trgm indexes of the movies table on Postgres. They are skipped if the pg_trgm
+    extension is not available, the search then falls back to its in-process index.
+    """
+    if connection.dialect.name != "postgresql":
+        return
+    try:
+        with connection.begin_nested():
+            connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    except DBAPIError:
+        return
+    for ddl in TRIGRAM_INDEXES:
+        connection.execute(text(ddl))
+
+
+class CatalogVersion(Base):
+    """
+    Version of the movie catalog, a single row bumped by triggers on every change to the movies
+    table, so the processes holding a copy of the catalog (like the n-gram search index) can tell
+    it changed with a primary key lookup
+    """
+
+    __tablename__ = "catalog_versions"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    # Random token set when the table is created, telling the versions of a recreated table apart
+    epoch = Column(String, nullable=False)
+    version = Column(Integer, nullable=False, default=0)
+
+
+# Triggers bumping the catalog version, by dialect. Postgres bumps it once per statement, SQLite
+# (which only has row triggers) once per changed movie.
+CATALOG_VERSION_TRIGGERS = {
+    "postgresql": (
+        "CREATE OR REPLACE FUNCTION bump_catalog_version() RETURNS trigger LANGUAGE plpgsql AS "
+        "$$ BEGIN UPDATE catalog_versions SET version = version + 1; RETURN NULL; END $$",
+        "DROP TRIGGER IF EXISTS movies_catalog_version ON movies",
+        "CREATE TRIGGER movies_catalog_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE "
+        "ON movies FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version()",
+    ),
+    "sqlite": tuple(
+        f"CREATE TRIGGER IF NOT EXISTS movies_catalog_version_{operation.lower()} "
+        f"AFTER {operation} ON movies "
+        "BEGIN UPDATE catalog_versions SET version = version + 1; END"
+        for operation in ("INSERT", "UPDATE", "DELETE")
+    ),
+}
+
+# Statements removing the triggers, before the movies table they are on is renamed
+CATALOG_VERSION_DROP_TRIGGERS = {
+    "postgresql": ("DROP TRIGGER IF EXISTS movies_catalog_version ON movies",),
+    "sqlite": tuple(
+        f"DROP TRIGGER IF EXISTS movies_catalog_version_{operation}"
+        for operation in ("insert", "update", "delete")
+    ),
+}
+
+
+@event.listens_for(Base.metadata, "after_create")
+def create_catalog_version(target, connection, tables=(), **kwargs) -> None:
+    """
+    Insert the catalog version and create its triggers on the movies table, when create_all
+    created the version table. Both tables exist by then, whatever order they were created in.
+    """
+    if CatalogVersion.__table__ not in tables:
+        return
+    connection.execute(insert(CatalogVersion).values(id=1, epoch=uuid4().hex))
+    for ddl in CATALOG_VERSION_TRIGGERS.get(connection.dialect.name, ()):
+        connection.execute(text(ddl))
+
+
+class User(Base):
+    """
+    User model, one row per user that rated a movie
+    """
+
+    __tablename__ = "users"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+
+    ratings = relationship("Rating", back_populates="user")
+
+
+class Rating(Base):
+    """
+    Rating model, one row per (user, movie) rating
+    """
+
+    __tablename__ = "ratings"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    movie_id = Column(Integer, ForeignKey("movies.id"), primary_key=True)
+    rating = Column(Integer, nullable=False)
+
+    user = relationship("User", back_populates="ratings")
+    movie = relationship("Movie", back_populates="ratings")
+
+    __table_args__ = (
+        # Covers a user's ratings in rating order, for the top-K and keyset paginated reads
+        Index("ix_ratings_user_rating", user_id, rating.desc(), movie_id),
+        # Serves the movie ratings and their keyset pagination in (movie, user) order
+        Index("ix_ratings_movie_user", movie_id, user_id),
+    )
+
+
+class MovieRatingAggregate(Base):
+    """
+    Rating aggregate model, one row per rated movie holding the sum, count and average of its ratings
+    """
+
+    __tablename__ = "movie_rating_aggregates"
+
+    movie_id = Column(Integer, ForeignKey("movies.id"), primary_key=True)
+    rating_sum = Column(Integer, nullable=False, default=0)
+    rating_count = Column(Integer, nullable=False, default=0)
+    avr_rating = Column(Float, nullable=False, default=0)
+
+    movie = relationship("Movie", back_populates="aggregate")
+
+    __table_args__ = (
+        # Serves the top-K ranking in index order, ties broken by vote count then movie id
+        Index(
+            "ix_movie_rating_aggregates_ranking",
+            avr_rating.desc(),
+            rating_count.desc(),
+            movie_id,
+        ),
+    )
+
+
+class MovieLeaderboard(Base):
+    """
+    Leaderboard model, the top ranked movies of every scope (all movies, one genre or one year)
+    precomputed from the rating aggregates, with the movie columns copied so a ranking is read
+    from this table alone
+    """
+
+    __tablename__ = "movie_leaderboard"
+
+    scope = Column(String, primary_key=True)
+    scope_key = Column(String, primary_key=True)
+    position = Column(Integer, primary_key=True, autoincrement=False)
+    id = Column(Integer, nullable=False)
+    title = Column(String)
+    genre = Column(String)
     year = Column(String)
     runtime = Column(String)
-    avr_rating = Column(Integer)
+    avr_rating = Column(Float, nullable=False)
+    rating_count = Column(Integer, nullable=False)
+    # Number of movies stored for the scope, fewer than the leaderboard size if it holds all of them
+    scope_size = Column(Integer, nullable=False)
+    # Unix time of the refresh that wrote the scope
+    refreshed_at = Column(Float, nullable=False)
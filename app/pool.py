@@ -0,0 +1,112 @@
+from dataclasses import asdict, dataclass
+from threading import Lock
+from time import perf_counter
+from typing import Any, Optional
+
+from sqlalchemy import exc
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from app.settings import Settings
+
+
+@dataclass
+class PoolMetrics:
+    checkouts: int = 0
+    timeouts: int = 0
+    wait_seconds_total: float = 0.0
+    wait_seconds_max: float = 0.0
+
+
+class TimedPoolMixin:
+    """
+    Records how often and how long callers wait for a connection of a queue pool
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+        self.metrics_lock = Lock()
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            with self.metrics_lock:
+                self.metrics.timeouts += 1
+            raise
+        waited = perf_counter() - start
+        with self.metrics_lock:
+            self.metrics.checkouts += 1
+            self.metrics.wait_seconds_total += waited
+            self.metrics.wait_seconds_max = max(self.metrics.wait_seconds_max, waited)
+        return connection
+
+
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+# Timed variant of the queue pools dialects pick by default
+TIMED_POOLS = {
+    QueuePool: TimedQueuePool,
+    AsyncAdaptedQueuePool: TimedAsyncAdaptedQueuePool,
+}
+
+
+def pool_options(url: str, settings: Optional[Settings] = None) -> dict:
+    """
+    Engine pool arguments from the settings, SQLAlchemy's defaults unless set. Size, overflow and
+    timeout only apply to the queue pools used by server databases and SQLite files, which are
+    replaced by their timed variant.
+
+    :param url: database URL
+    :param settings: Optional settings, the defaults when not given
+    :return: keyword arguments for create_engine / create_async_engine
+    """
+    settings = settings or Settings()
+    options = {
+        "pool_pre_ping": settings.db_pool_pre_ping,
+        "pool_recycle": settings.db_pool_recycle,
+    }
+    db_url = make_url(url)
+    timed_pool = TIMED_POOLS.get(db_url.get_dialect().get_pool_class(db_url))
+    if timed_pool is not None:
+        options.update(
+            poolclass=timed_pool,
+            pool_size=settings.db_pool_size,
+            max_overflow=settings.db_max_overflow,
+            pool_timeout=settings.db_pool_timeout,
+        )
+    return options
+
+
+def pool_stats(name: str, engine: Engine | AsyncEngine) -> dict:
+    """
+    Current state of an engine's pool
+
+    :param name: name of the engine
+    :param engine: sync or async engine
+    :return: pool class, size, checked out and overflow connections and, for timed pools, the
+        number of checkouts, timeouts and the time spent waiting for a connection
+    """
+    pool = engine.pool
+    stats = {"engine": name, "pool_class": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=max(pool.overflow(), 0),
+            max_overflow=pool._max_overflow,
+        )
+    if isinstance(pool, TimedPoolMixin):
+        with pool.metrics_lock:
+            stats.update(asdict(pool.metrics))
+    return stats
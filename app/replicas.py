@@ -0,0 +1,222 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+from itertools import count
+from time import monotonic, time
+from typing import Callable, Iterable, Optional
+
+from fastapi import Request, Response
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+
+from app.pool import pool_options
+from app.settings import Settings
+
+# Cookie holding the Unix time until which a client reads from the primary
+READ_PRIMARY_COOKIE = "read_primary_until"
+
+
+@dataclass
+class Replica:
+    name: str
+    engine: AsyncEngine
+    sessionmaker: async_sessionmaker[AsyncSession]
+    healthy: bool = True
+    checked_at: Optional[float] = None
+
+
+class ReplicaRouter:
+    """
+    Routes the sessions of read-only requests to the healthy replicas in turn, and the sessions of
+    users who just wrote to the primary, so they read their own writes. Replicas are checked by a
+    background task in the app lifespan, requests only read the result of the last check.
+    """
+
+    def __init__(
+        self,
+        primary: async_sessionmaker[AsyncSession],
+        replicas: list[Replica],
+        check_interval: float = Settings.replica_health_check_interval,
+        max_lag: float = Settings.replica_max_lag,
+        clock: Callable[[], float] = monotonic,
+    ):
+        self.primary = primary
+        self.replicas = replicas
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self.clock = clock
+        self.turns = count()
+        # Unix time until which a user reads from the primary, by user id
+        self.recent_writers: dict[int, float] = {}
+        # (Unix time, user id) of the writes in the order they expire, to expire users lazily
+        self.expirations: deque[tuple[float, int]] = deque()
+        self.task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_urls(
+        cls,
+        primary: async_sessionmaker[AsyncSession],
+        urls: Iterable[str],
+        check_interval: float = Settings.replica_health_check_interval,
+        max_lag: float = Settings.replica_max_lag,
+        settings: Optional[Settings] = None,
+    ) -> "ReplicaRouter":
+        """
+        Create a router with an async engine per replica. Replica sessions carry the name of
+        their replica and the max lag in their info.
+
+        :param primary: session factory of the primary
+        :param urls: database URLs of the replicas, sync or async
+        :param check_interval: seconds between health checks of a replica
+        :param max_lag: longest expected replication lag in seconds
+        :param settings: Optional settings of the pools of the replicas
+        :return: replica router
+        """
+        from app.database import to_async_url
+
+        replicas = []
+        for index, url in enumerate(urls):
+            async_url = to_async_url(url)
+            engine = create_async_engine(async_url, **pool_options(async_url, settings))
+            replicas.append(
+                Replica(
+                    name=f"replica-{index}",
+                    engine=engine,
+                    sessionmaker=async_sessionmaker(
+                        bind=engine,
+                        autoflush=False,
+                        expire_on_commit=False,
+                        info={
+                            "replica": f"replica-{index}",
+                            "replica_max_lag": max_lag,
+                        },
+                    ),
+                )
+            )
+        return cls(primary, replicas, check_interval, max_lag)
+
+    async def check(self, replica: Replica) -> bool:
+        """
+        Check that a replica answers a query within the check interval and record the result
+
+        :param replica: replica to check
+        :return: True if the replica is healthy
+        """
+
+        async def select_one() -> None:
+            async with replica.engine.connect() as connection:
+                await connection.execute(text("SELECT 1"))
+
+        try:
+            await asyncio.wait_for(select_one(), self.check_interval)
+            replica.healthy = True
+        except (SQLAlchemyError, OSError, asyncio.TimeoutError):
+            replica.healthy = False
+        replica.checked_at = self.clock()
+        return replica.healthy
+
+    async def check_replicas(self) -> None:
+        """
+        Check every replica at once
+        """
+        await asyncio.gather(*(self.check(replica) for replica in self.replicas))
+
+    async def run(self) -> None:
+        """
+        Check the replicas every check interval until cancelled
+        """
+        while True:
+            await self.check_replicas()
+            await asyncio.sleep(self.check_interval)
+
+    def start(self) -> None:
+        """
+        Start checking the replicas in the background, in the running event loop
+        """
+        if self.replicas:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """
+        Stop the background checks, waiting for a running check to be cancelled
+        """
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    def pick(self) -> Optional[Replica]:
+        """
+        Pick the next replica found healthy by the last check, round robin
+
+        :return: healthy replica, None if there is none
+        """
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[next(self.turns) % len(self.replicas)]
+            if replica.healthy:
+                return replica
+        return None
+
+    def mark_write(self, user_ids: list[int], response: Response) -> None:
+        """
+        Send the reads of users who just wrote to the primary until the replicas caught up, both
+        by user id on this worker and by a cookie the client sends to every worker
+
+        :param user_ids: ids of the users whose ratings changed
+        :param response: response of the write, the cookie is set on
+        """
+        now = time()
+        until = now + self.max_lag
+        # Writes expire in the order they were marked, so only the expired ones are visited. A
+        # user who wrote again since keeps the later time.
+        while self.expirations and self.expirations[0][0] <= now:
+            expires, user_id = self.expirations.popleft()
+            if self.recent_writers.get(user_id) == expires:
+                del self.recent_writers[user_id]
+        for user_id in user_ids:
+            self.recent_writers[user_id] = until
+            self.expirations.append((until, user_id))
+        response.set_cookie(
+            READ_PRIMARY_COOKIE, f"{until:.3f}", max_age=int(self.max_lag) + 1
+        )
+
+    def reads_primary(self, request: Request) -> bool:
+        """
+        Check whether a request must read from the primary to see its user's own writes
+
+        :param request: incoming request
+        :return: True if the client or the user of the path wrote recently
+        """
+        now = time()
+        try:
+            if float(request.cookies.get(READ_PRIMARY_COOKIE, 0)) > now:
+                return True
+        except ValueError:
+            pass
+        user_id = request.path_params.get("user_id")
+        try:
+            return self.recent_writers.get(int(user_id), 0) > now
+        except (TypeError, ValueError):
+            return False
+
+    async def sessionmaker_for(self, request: Request) -> async_sessionmaker:
+        """
+        Get the session factory a read-only request should use
+
+        :param request: incoming request
+        :return: session factory of a healthy replica, or of the primary
+        """
+        if not self.replicas or self.reads_primary(request):
+            return self.primary
+        replica = self.pick()
+        return self.primary if replica is None else replica.sessionmaker
@@ -0,0 +1,24 @@
+from fastapi import APIRouter, Depends
+
+from app.database import get_query_cache
+from app.methods.cache import CacheBackend
+from app.schemas.base import CacheStatsSchema
+from app.schemas.responses import CacheStatsResponse
+
+router = APIRouter()
+
+
+@router.get("/cache/stats", response_model=CacheStatsResponse)
+async def get_cache_stats(
+    query_cache: CacheBackend = Depends(get_query_cache),
+) -> CacheStatsResponse:
+    """
+    Get endpoint for the hit, miss, eviction and invalidation counts of the query cache. Counts are kept by
+    every worker, the size of a shared cache is the number of results stored for all workers.
+    """
+    return CacheStatsResponse(
+        message="Query cache statistics",
+        backend=query_cache.name,
+        enabled=query_cache.enabled,
+        data=CacheStatsSchema(**await query_cache.get_stats()),
+    )
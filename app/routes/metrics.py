@@ -0,0 +1,51 @@
+from fastapi import APIRouter, Depends
+from fastapi.responses import PlainTextResponse
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.database import get_engines, get_write_buffer
+from app.instrumentation import render_metrics, render_pool_stats
+from app.pool import pool_stats
+from app.schemas.base import PoolStatsSchema
+from app.schemas.responses import PoolStatsResponse
+
+router = APIRouter()
+
+# Routes served outside the API prefix, where metrics scrapers look for them
+exposition_router = APIRouter()
+
+PROMETHEUS_MEDIA_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@router.get("/metrics/pool", response_model=PoolStatsResponse)
+async def get_pool_stats(
+    engines: dict[str, Engine | AsyncEngine] = Depends(get_engines),
+) -> PoolStatsResponse:
+    """
+    Get endpoint for the connection pools of this worker: their size, checked out and overflow connections,
+    and how many checkouts had to wait or timed out waiting for a connection
+    """
+    return PoolStatsResponse(
+        message="Connection pool statistics",
+        data=[
+            PoolStatsSchema(**pool_stats(name, engine))
+            for name, engine in engines.items()
+        ],
+    )
+
+
+@exposition_router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics(
+    engines: dict[str, Engine | AsyncEngine] = Depends(get_engines),
+    write_buffer=Depends(get_write_buffer),
+) -> PlainTextResponse:
+    """
+    Get endpoint for the metrics of this worker in the Prometheus text format: latency, SQL statement
+    count, database time and serialization time of the requests by route, statement durations by
+    engine, the state of the connection pools, and of the rating write buffer when enabled
+    """
+    pools = [pool_stats(name, engine) for name, engine in engines.items()]
+    lines = render_pool_stats(pools)
+    if write_buffer is not None:
+        lines.extend(write_buffer.render())
+    return PlainTextResponse(render_metrics(lines), media_type=PROMETHEUS_MEDIA_TYPE)
@@ -1,37 +1,183 @@
-from typing import Union
+from typing import Optional, Union
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.exc import OperationalError, ProgrammingError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
-from app.database import get_db_session
-from app.methods.routes_class import Crud
-from app.schemas.responses import MovieResponse
+from app.database import (
+    get_query_cache,
+    get_read_db_session,
+    get_read_db_sessionmaker,
+    get_similarity_index,
+)
+from app.methods.cache import RATINGS_TAG, CacheBackend
+from app.methods.export import (
+    EXPORT_MEDIA_TYPES,
+    ExportFormat,
+    encode_csv,
+    encode_ndjson,
+)
+from app.methods.fast_json import json_response, rows_to_dicts
+from app.methods.http_cache import conditional_get
+from app.methods.pagination import (
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    decode_cursor,
+    encode_cursor,
+)
+from app.methods.routes_class import AsyncCrud
+from app.methods.search import SearchMode
+from app.methods.similarity import SimilarityIndex
+from app.schemas.base import MovieFieldsSchema, MovieSchema, SimilarMovieSchema
+from app.schemas.responses import MovieResponse, SimilarMovieResponse
 
 router = APIRouter()
 
 
-@router.get("/movies", response_model=MovieResponse)
+@router.get(
+    "/movies",
+    response_model=MovieResponse,
+    response_model_exclude_unset=True,
+    dependencies=[Depends(conditional_get("movies", tags=[RATINGS_TAG]))],
+)
 async def pull_movie_info(
+    response: Response,
     title: str = None,
     genre: str = None,
     year: str = None,
-    db: Session = Depends(get_db_session),
+    mode: SearchMode = "contains",
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: str = None,
+    fields: str = None,
+    db: AsyncSession = Depends(get_read_db_session),
+    query_cache: CacheBackend = Depends(get_query_cache),
 ) -> Union[HTTPException, MovieResponse]:
     """
     Get movie information from the database that matches the given filters (if any) and return it to the
-    user in JSON format
+    user in JSON format. Title and genre are matched by substring, prefix or fuzzily depending on `mode`,
+    the most relevant matches first. Results are paginated with the `next_cursor` of the previous page
+    passed as `after`, and `fields` (comma separated) limits the fields returned for every movie.
     """
     try:
-        movie_crud: Crud = Crud(db)
-        db_movie = movie_crud.get_movies_info(title, genre, year)
+        searching = title is not None or genre is not None
+        try:
+            after_key = decode_cursor(
+                after, (float, int, int) if searching else (int, int)
+            )
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Bad request: Invalid cursor")
+        field_list = list(MovieSchema.model_fields)
+        if fields is not None:
+            field_list = [field.strip() for field in fields.split(",") if field.strip()]
+            unknown_fields = set(field_list) - set(MovieSchema.model_fields)
+            if unknown_fields or not field_list:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Bad request: Unknown fields: {', '.join(sorted(unknown_fields))}",
+                )
+        movie_crud: AsyncCrud = AsyncCrud(db, cache=query_cache)
+        db_movie = await movie_crud.get_movies_info(
+            title, genre, year, mode, limit + 1, after_key, field_list
+        )
         if (db_movie is None) or (db_movie == []):
             raise HTTPException(
                 status_code=404, detail="Not Found: Unable to find movie in Database"
             )
-        final_movie_list = movie_crud.create_movie_schema_list(db_movie)
-        return MovieResponse(
-            message="Movie data retrieved from database", data=final_movie_list
+        next_cursor = None
+        if len(db_movie) > limit:
+            db_movie = db_movie[:limit]
+            last_movie = db_movie[-1]
+            next_cursor = encode_cursor(
+                *((last_movie.relevance,) if searching else ()),
+                last_movie.id,
+                last_movie.user_id,
+            )
+        return json_response(
+            {
+                "message": "Movie data retrieved from database",
+                "data": rows_to_dicts(db_movie, MovieFieldsSchema, field_list),
+                "next_cursor": next_cursor,
+            },
+            response,
+        )
+    except OperationalError:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Bad request: Connection to Database could not be established",
+        )
+    except ProgrammingError:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Bad request: Movies table does not exist in Database",
+        )
+
+
+@router.get("/movies/export")
+async def export_movie_info(
+    title: str = None,
+    genre: str = None,
+    year: str = None,
+    mode: SearchMode = "contains",
+    format: ExportFormat = "ndjson",
+    session_factory: async_sessionmaker[AsyncSession] = Depends(
+        get_read_db_sessionmaker
+    ),
+) -> StreamingResponse:
+    """
+    Export every movie rating that matches the given filters (if any) as NDJSON or CSV. Rows are streamed
+    from a server side cursor as they are read, so the export never has to fit in memory.
+    """
+
+    async def export_rows():
+        async with session_factory() as db:
+            movie_crud: AsyncCrud = AsyncCrud(db)
+            header = True
+            async for rows in movie_crud.stream_movies_info(title, genre, year, mode):
+                if format == "csv":
+                    yield encode_csv(rows, MovieSchema, header=header)
+                    header = False
+                else:
+                    yield encode_ndjson(rows, MovieSchema)
+
+    return StreamingResponse(
+        export_rows(),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="movies.{format}"'},
+    )
+
+
+@router.get("/movies/{movie_id}/similar", response_model=SimilarMovieResponse)
+async def get_similar_movies(
+    movie_id: int,
+    response: Response,
+    k: int = Query(10, ge=1),
+    db: AsyncSession = Depends(get_read_db_session),
+    index: Optional[SimilarityIndex] = Depends(get_similarity_index),
+) -> Union[HTTPException, SimilarMovieResponse]:
+    """
+    Get the k movies most similar to a movie, by cosine similarity of their ratings. Neighbors are read
+    from the precomputed index, so the request only looks up their details in the database. At most the
+    number of neighbors stored per movie by the index build are returned.
+    """
+    try:
+        if index is None or not index.ready:
+            raise HTTPException(
+                status_code=503,
+                detail="Service Unavailable: Similarity index has not been built",
+            )
+        movie_crud: AsyncCrud = AsyncCrud(db)
+        db_movie = await movie_crud.get_similar_movies(movie_id, k, index)
+        if not db_movie:
+            raise HTTPException(
+                status_code=404, detail="Not Found: No similar movie found"
+            )
+        return json_response(
+            {
+                "message": f"Movies similar to {movie_id} retrieved from the similarity index",
+                "data": rows_to_dicts(db_movie, SimilarMovieSchema),
+            },
+            response,
         )
     except OperationalError:
         raise HTTPException(
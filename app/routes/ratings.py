@@ -1,39 +1,112 @@
-from typing import Union
+from collections import Counter
+from time import time
+from typing import Optional, Union
 
-from fastapi import APIRouter, Depends, HTTPException
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from pydantic import TypeAdapter, ValidationError
 from sqlalchemy.exc import OperationalError, ProgrammingError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.database import get_db_session
-from app.methods.routes_class import Crud
-from app.schemas.base import MovieSchema
-from app.schemas.responses import RatingResponse, UpdateRatingResponse
+from app.database import (
+    get_columnar_engine,
+    get_db_session,
+    get_leaderboard_refresher,
+    get_query_cache,
+    get_read_db_session,
+    get_replica_router,
+    get_similarity_index,
+    get_write_buffer,
+)
+from app.methods.cache import LEADERBOARD_TAG, RATINGS_TAG, CacheBackend
+from app.methods.fast_json import json_response, rows_to_dicts
+from app.methods.http_cache import conditional_get
+from app.methods.leaderboard import LEADERBOARD_AGE_HEADER
+from app.methods.pagination import (
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    decode_cursor,
+    encode_cursor,
+)
+from app.methods.routes_class import AsyncCrud
+from app.methods.similarity import SimilarityIndex
+from app.methods.write_behind import RatingWriteBuffer, WriteBufferFull
+from app.replicas import ReplicaRouter
+from app.schemas.base import (
+    MovieRankingSchema,
+    MovieSchema,
+    RatingInSchema,
+    SimilarMovieSchema,
+)
+from app.schemas.responses import (
+    AcceptedRatingResponse,
+    BulkRatingResponse,
+    RankingResponse,
+    RatingPageResponse,
+    RatingResponse,
+    SimilarMovieResponse,
+    UpdateRatingResponse,
+)
 
 router = APIRouter()
 
+# Largest number of movies the top-K ranking returns in one response
+MAX_TOP_K = 100
+
+# Largest number of ratings accepted by one bulk request
+MAX_BULK_RATINGS = 100_000
+
+# Validates every item of a bulk request in one pass
+BULK_RATINGS_ADAPTER = TypeAdapter(list[RatingInSchema])
+
 
-@router.get("/movies/top_five/total_user", response_model=RatingResponse)
+@router.get(
+    "/movies/top_five/total_user",
+    response_model=RankingResponse,
+    dependencies=[
+        Depends(conditional_get("top_five_total_user", tags=[LEADERBOARD_TAG]))
+    ],
+)
 async def get_top_movies_all_users(
-    db: Session = Depends(get_db_session),
-) -> Union[HTTPException, RatingResponse]:
+    response: Response,
+    k: int = Query(5, ge=1, le=MAX_TOP_K),
+    min_votes: int = Query(1, ge=1),
+    genre: str = None,
+    year: str = None,
+    db: AsyncSession = Depends(get_read_db_session),
+    columnar=Depends(get_columnar_engine),
+    leaderboard=Depends(get_leaderboard_refresher),
+    query_cache: CacheBackend = Depends(get_query_cache),
+) -> Union[HTTPException, RankingResponse]:
     """
-    Get endpoint for movies to pull movie data from the database for all users and return the top 5 movies
+    Get endpoint for movies to pull movie data from the database for all users and return the top k
+    distinct movies by average rating, optionally with a minimum number of ratings and a genre/year.
+    Rankings are served from the leaderboard refreshed in the background when it holds them, the
+    X-Leaderboard-Age header gives the seconds since they were refreshed (0 when computed on request).
     """
     try:
-        movie_crud: Crud = Crud(db)
-        db_movie = movie_crud.get_top_five_movie_ratings()
+        movie_crud: AsyncCrud = AsyncCrud(
+            db, cache=query_cache, columnar=columnar, leaderboard=leaderboard
+        )
+        db_movie = await movie_crud.get_leaderboard(k, min_votes, genre, year)
+        if db_movie is None:
+            age = 0.0
+            db_movie = await movie_crud.get_top_five_movie_ratings(
+                k=k, min_votes=min_votes, genre=genre, year=year
+            )
+        else:
+            age = max(time() - db_movie[0].refreshed_at, 0.0)
+        response.headers[LEADERBOARD_AGE_HEADER] = f"{age:.1f}"
         if (db_movie is None) or (db_movie == []):
             raise HTTPException(
                 status_code=404, detail="Not Found: No movie found in Database"
             )
-        final_movie_list = movie_crud.create_movie_schema_list(db_movie, in_list=True)
-        sort_top_five_movies = sorted(
-            final_movie_list, key=lambda m: (m["avr_rating"], m["title"].lower())
-        )
-        sort_top_five_movies = sort_top_five_movies[::-1]
-        return RatingResponse(
-            message="Top five average rated movies for all users retrieved from database",
-            data=sort_top_five_movies,
+        return json_response(
+            {
+                "message": "Top five average rated movies for all users retrieved from database",
+                "data": rows_to_dicts(db_movie, MovieRankingSchema),
+            },
+            response,
         )
     except OperationalError:
         raise HTTPException(
@@ -47,26 +120,82 @@ async def get_top_movies_all_users(
         )
 
 
-@router.get("/movies/top_five/{user_id}", response_model=RatingResponse)
+@router.get(
+    "/movies/top_five/{user_id}",
+    response_model=RatingResponse,
+    dependencies=[Depends(conditional_get("top_five_user", tags=[RATINGS_TAG]))],
+)
 async def get_top_movies_one_user(
-    user_id: int, db: Session = Depends(get_db_session)
+    user_id: int,
+    response: Response,
+    db: AsyncSession = Depends(get_read_db_session),
+    columnar=Depends(get_columnar_engine),
+    query_cache: CacheBackend = Depends(get_query_cache),
 ) -> Union[HTTPException, RatingResponse]:
     """
     Get endpoint for movies to get all movies from the database with their average rating for one user
     """
     try:
-        movie_crud: Crud = Crud(db)
-        db_movie = movie_crud.get_top_five_movie_ratings(user_id=user_id)
+        movie_crud: AsyncCrud = AsyncCrud(db, cache=query_cache, columnar=columnar)
+        db_movie = await movie_crud.get_top_five_movie_ratings(user_id=user_id)
         if (db_movie is None) or (db_movie == []):
             raise HTTPException(status_code=404, detail="No user found in Database")
-        final_movie_list = movie_crud.create_movie_schema_list(db_movie, in_list=True)
-        sort_top_five_movies = sorted(
-            final_movie_list, key=lambda m: (m["avr_rating"], m["title"].lower())
+        return json_response(
+            {
+                "message": f"Top five average rated movies for {user_id} retrieved from database",
+                "data": rows_to_dicts(db_movie, MovieSchema),
+            },
+            response,
         )
-        sort_top_five_movies = sort_top_five_movies[::-1]
-        return RatingResponse(
-            message=f"Top five average rated movies for {user_id} retrieved from database",
-            data=sort_top_five_movies,
+    except OperationalError:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Internal Server Error: Connection to Database could not be established",
+        )
+    except ProgrammingError:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Internal Server Error: Movies table does not exist in Database",
+        )
+
+
+@router.get(
+    "/users/{user_id}/ratings",
+    response_model=RatingPageResponse,
+    dependencies=[Depends(conditional_get("user_ratings", tags=[RATINGS_TAG]))],
+)
+async def get_user_ratings(
+    user_id: int,
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: str = None,
+    db: AsyncSession = Depends(get_read_db_session),
+    query_cache: CacheBackend = Depends(get_query_cache),
+) -> Union[HTTPException, RatingPageResponse]:
+    """
+    Get endpoint for all ratings of one user, highest rating first, paginated with the `next_cursor`
+    of the previous page passed as `after`
+    """
+    try:
+        try:
+            after_key = decode_cursor(after, (int, int))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Bad request: Invalid cursor")
+        movie_crud: AsyncCrud = AsyncCrud(db, cache=query_cache)
+        db_movie = await movie_crud.get_user_ratings_page(user_id, limit + 1, after_key)
+        if after_key is None and db_movie == []:
+            raise HTTPException(status_code=404, detail="No user found in Database")
+        next_cursor = None
+        if len(db_movie) > limit:
+            db_movie = db_movie[:limit]
+            next_cursor = encode_cursor(db_movie[-1].rating, db_movie[-1].id)
+        return json_response(
+            {
+                "message": f"Ratings for {user_id} retrieved from database",
+                "data": rows_to_dicts(db_movie, MovieSchema),
+                "next_cursor": next_cursor,
+            },
+            response,
         )
     except OperationalError:
         raise HTTPException(
@@ -80,29 +209,263 @@ async def get_top_movies_one_user(
         )
 
 
+@router.get("/users/{user_id}/recommendations", response_model=SimilarMovieResponse)
+async def get_user_recommendations(
+    user_id: int,
+    response: Response,
+    k: int = Query(10, ge=1, le=MAX_TOP_K),
+    db: AsyncSession = Depends(get_read_db_session),
+    index: Optional[SimilarityIndex] = Depends(get_similarity_index),
+) -> Union[HTTPException, SimilarMovieResponse]:
+    """
+    Get endpoint for the k movies a user did not rate that are most similar to the movies they rated
+    highly, scored from the precomputed neighbors of every rated movie
+    """
+    try:
+        if index is None or not index.ready:
+            raise HTTPException(
+                status_code=503,
+                detail="Service Unavailable: Similarity index has not been built",
+            )
+        movie_crud: AsyncCrud = AsyncCrud(db)
+        db_movie = await movie_crud.get_recommendations(user_id, k, index)
+        if not db_movie:
+            raise HTTPException(
+                status_code=404, detail="No recommendation found for user"
+            )
+        return json_response(
+            {
+                "message": f"Recommendations for {user_id} retrieved from the similarity index",
+                "data": rows_to_dicts(db_movie, SimilarMovieSchema),
+            },
+            response,
+        )
+    except OperationalError:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Internal Server Error: Connection to Database could not be established",
+        )
+    except ProgrammingError:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Internal Server Error: Movies table does not exist in Database",
+        )
+
+
+@router.post("/movies/user_rating/bulk", response_model=BulkRatingResponse)
+async def bulk_update_movie_ratings(
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_db_session),
+    replicas: ReplicaRouter = Depends(get_replica_router),
+    columnar=Depends(get_columnar_engine),
+    leaderboard=Depends(get_leaderboard_refresher),
+    write_buffer: Optional[RatingWriteBuffer] = Depends(get_write_buffer),
+    query_cache: CacheBackend = Depends(get_query_cache),
+) -> Union[HTTPException, BulkRatingResponse]:
+    """
+    Post endpoint to create or update many ratings at once. The body is a JSON array, or NDJSON with the
+    `application/x-ndjson` content type, of {"user_id", "movie_id", "rating"} objects. Every item gets its
+    own result, invalid items don't stop the others from being written. Items are validated in one pass,
+    and one by one only when some are invalid, to report them.
+    """
+    try:
+        items = parse_bulk_body(
+            await request.body(), request.headers.get("content-type", "")
+        )
+        if len(items) > MAX_BULK_RATINGS:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Too many ratings: at most {MAX_BULK_RATINGS} per request",
+            )
+
+        results, valid_ratings = {}, {}
+        try:
+            valid_ratings = dict(enumerate(BULK_RATINGS_ADAPTER.validate_python(items)))
+        except ValidationError:
+            for index, item in enumerate(items):
+                try:
+                    valid_ratings[index] = RatingInSchema.model_validate(item)
+                except ValidationError as error:
+                    results[index] = bulk_result(
+                        index,
+                        status="failed",
+                        detail="; ".join(
+                            f"{'.'.join(map(str, e['loc'])) or 'item'}: {e['msg']}"
+                            for e in error.errors()
+                        ),
+                    )
+
+        if write_buffer is not None:
+            # Bulk writes go to the database directly, after the older buffered writes
+            await write_buffer.drain()
+        movie_crud: AsyncCrud = AsyncCrud(
+            db, cache=query_cache, columnar=columnar, leaderboard=leaderboard
+        )
+        statuses = await movie_crud.bulk_upsert_ratings(list(valid_ratings.values()))
+        last_index = {
+            (rating.user_id, rating.movie_id): index
+            for index, rating in valid_ratings.items()
+        }
+        for index, rating in valid_ratings.items():
+            key = (rating.user_id, rating.movie_id)
+            status = statuses[key] if last_index[key] == index else "superseded"
+            if status == "movie_not_found":
+                results[index] = bulk_result(
+                    index, *key, "failed", "No movie found in Database"
+                )
+            else:
+                results[index] = bulk_result(index, *key, status)
+
+        results = [results[index] for index in range(len(items))]
+        counts = Counter(result["status"] for result in results)
+        written = {
+            result["user_id"]
+            for result in results
+            if result["status"] in ("created", "updated")
+        }
+        if written:
+            replicas.mark_write(sorted(written), response)
+        return json_response(
+            {
+                "message": "Ratings written to database",
+                "created": counts["created"],
+                "updated": counts["updated"],
+                "failed": counts["failed"],
+                "results": results,
+            },
+            response,
+        )
+    except OperationalError:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Internal Server Error: Connection to Database could not be established",
+        )
+    except ProgrammingError:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Internal Server Error: Movies table does not exist in Database",
+        )
+
+
+def bulk_result(
+    index: int,
+    user_id: Optional[int] = None,
+    movie_id: Optional[int] = None,
+    status: str = "failed",
+    detail: Optional[str] = None,
+) -> dict:
+    """
+    :return: result of one item of a bulk request, shaped like BulkRatingResultSchema
+    """
+    return {
+        "index": index,
+        "user_id": user_id,
+        "movie_id": movie_id,
+        "status": status,
+        "detail": detail,
+    }
+
+
+def parse_bulk_body(body: bytes, content_type: str) -> list:
+    """
+    Parse the body of a bulk request, a JSON array or NDJSON, with orjson
+
+    :param body: raw request body
+    :param content_type: content type header of the request
+    :return: list of items of the body
+    """
+    try:
+        if content_type.startswith("application/x-ndjson"):
+            return [orjson.loads(line) for line in body.splitlines() if line.strip()]
+        items = orjson.loads(body)
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail="Bad request: Body must be a JSON array or NDJSON"
+        )
+    if not isinstance(items, list):
+        raise HTTPException(
+            status_code=400, detail="Bad request: Body must be a JSON array or NDJSON"
+        )
+    return items
+
+
+async def buffer_movie_rating(
+    movie_crud: AsyncCrud,
+    write_buffer: RatingWriteBuffer,
+    replicas: ReplicaRouter,
+    response: Response,
+    user_id: int,
+    movie_id: int,
+    rating: int,
+) -> Response:
+    """
+    Log a rating update in the write buffer, once the rating is known to exist
+
+    :return: 202 response echoing the accepted update
+    """
+    if await movie_crud.get_movie_rating_by_unique_filter(movie_id, user_id) is None:
+        raise HTTPException(status_code=404, detail="No user found in Database")
+    try:
+        await write_buffer.write(user_id, movie_id, rating)
+    except WriteBufferFull:
+        raise HTTPException(
+            status_code=503,
+            detail="Service Unavailable: Too many rating updates are waiting to be written",
+            headers={"Retry-After": "1"},
+        )
+    replicas.mark_write([user_id], response)
+    return json_response(
+        {
+            "message": f"Rating value change accepted for USER-ID: {user_id} and MOVIE-ID: {movie_id}",
+            "data": {"user_id": user_id, "movie_id": movie_id, "rating": rating},
+        },
+        response,
+        status_code=202,
+    )
+
+
 @router.put(
     "/movies/user_rating/{user_id}/{movie_id}/{rating}",
     response_model=UpdateRatingResponse,
+    responses={202: {"model": AcceptedRatingResponse}},
 )
 async def update_movie_rating(
-    user_id: int, movie_id: int, rating: int, db: Session = Depends(get_db_session)
+    user_id: int,
+    movie_id: int,
+    rating: int,
+    response: Response,
+    db: AsyncSession = Depends(get_db_session),
+    replicas: ReplicaRouter = Depends(get_replica_router),
+    columnar=Depends(get_columnar_engine),
+    write_buffer: Optional[RatingWriteBuffer] = Depends(get_write_buffer),
+    leaderboard=Depends(get_leaderboard_refresher),
+    query_cache: CacheBackend = Depends(get_query_cache),
 ) -> Union[HTTPException, UpdateRatingResponse]:
     """
-    Put endpoint for movies to update the rating of a movie for a specific user
+    Put endpoint for movies to update the rating of a movie for a specific user. With the rating
+    write buffer enabled, the update is answered with 202 once it is logged, and written to the
+    database by the next flush.
     """
     try:
-        movie_crud: Crud = Crud(db)
+        movie_crud: AsyncCrud = AsyncCrud(
+            db, cache=query_cache, columnar=columnar, leaderboard=leaderboard
+        )
         if rating < 1 or rating > 5:
             raise HTTPException(
                 status_code=400, detail="Rating must be between 1 and 5"
             )
-        user = movie_crud.get_movie_for_one_user(movie_id, user_id)
-        if user is None:
+        if write_buffer is not None:
+            return await buffer_movie_rating(
+                movie_crud, write_buffer, replicas, response, user_id, movie_id, rating
+            )
+        rating_result = await movie_crud.update_movie_rating(movie_id, user_id, rating)
+        if rating_result is None:
             raise HTTPException(status_code=404, detail="No user found in Database")
-        rating_result = movie_crud.update_movie_rating(user.id, user.user_id, rating)
+        replicas.mark_write([user_id], response)
         return UpdateRatingResponse(
             message=f"Rating value has changed for USER-ID: {user_id} and MOVIE-ID: {movie_id}",
-            data=MovieSchema(**rating_result.__dict__),
+            data=MovieSchema(**rating_result._mapping),
         )
     except OperationalError:
         raise HTTPException(
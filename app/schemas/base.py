@@ -1,4 +1,6 @@
-from pydantic import BaseModel
+from typing import Optional
+
+from pydantic import BaseModel, Field
 
 EXAMPLE_JSON = {
     "id": 1,
@@ -23,3 +25,134 @@ class MovieSchema(BaseModel):
     avr_rating: int
 
     model_config = {"json_schema_extra": {"example": EXAMPLE_JSON}}
+
+
+class MovieFieldsSchema(BaseModel):
+    """
+    MovieSchema where every field is optional, for responses that only hold the requested fields
+    """
+
+    id: Optional[int] = None
+    user_id: Optional[int] = None
+    title: Optional[str] = None
+    genre: Optional[str] = None
+    year: Optional[int] = None
+    runtime: Optional[str] = None
+    rating: Optional[int] = None
+    avr_rating: Optional[int] = None
+
+    model_config = {"json_schema_extra": {"example": EXAMPLE_JSON}}
+
+
+EXAMPLE_RANKING_JSON = {
+    "id": 1,
+    "title": "Inception",
+    "genre": "Sci-Fi",
+    "year": 2010,
+    "runtime": "148 min",
+    "avr_rating": 4.5,
+    "rating_count": 2,
+}
+
+
+class MovieRankingSchema(BaseModel):
+    id: int
+    title: str
+    genre: str
+    year: int
+    runtime: str
+    avr_rating: float
+    rating_count: int
+
+    model_config = {"json_schema_extra": {"example": EXAMPLE_RANKING_JSON}}
+
+
+EXAMPLE_SIMILAR_JSON = {
+    "id": 2,
+    "title": "Interstellar",
+    "genre": "Sci-Fi",
+    "year": 2014,
+    "runtime": "169 min",
+    "score": 0.82,
+}
+
+
+class SimilarMovieSchema(BaseModel):
+    id: int
+    title: str
+    genre: str
+    year: int
+    runtime: str
+    score: float
+
+    model_config = {"json_schema_extra": {"example": EXAMPLE_SIMILAR_JSON}}
+
+
+class RatingInSchema(BaseModel):
+    user_id: int
+    movie_id: int
+    rating: int = Field(ge=1, le=5)
+
+    model_config = {
+        "json_schema_extra": {"example": {"user_id": 1, "movie_id": 1, "rating": 5}}
+    }
+
+
+class BulkRatingResultSchema(BaseModel):
+    index: int
+    user_id: Optional[int] = None
+    movie_id: Optional[int] = None
+    status: str
+    detail: Optional[str] = None
+
+
+EXAMPLE_CACHE_STATS_JSON = {
+    "hits": 120,
+    "misses": 30,
+    "evictions": 0,
+    "expirations": 4,
+    "invalidations": 6,
+    "size": 20,
+}
+
+
+class CacheStatsSchema(BaseModel):
+    hits: int
+    misses: int
+    evictions: int
+    expirations: int
+    invalidations: int
+    size: int
+
+    model_config = {"json_schema_extra": {"example": EXAMPLE_CACHE_STATS_JSON}}
+
+
+EXAMPLE_POOL_STATS_JSON = {
+    "engine": "async",
+    "pool_class": "TimedAsyncAdaptedQueuePool",
+    "size": 5,
+    "checked_in": 3,
+    "checked_out": 2,
+    "overflow": 0,
+    "max_overflow": 10,
+    "checkouts": 1520,
+    "timeouts": 0,
+    "wait_seconds_total": 0.042,
+    "wait_seconds_max": 0.003,
+}
+
+
+class PoolStatsSchema(BaseModel):
+    engine: str
+    pool_class: str
+    size: Optional[int] = None
+    checked_in: Optional[int] = None
+    checked_out: Optional[int] = None
+    overflow: Optional[int] = None
+    max_overflow: Optional[int] = None
+    checkouts: Optional[int] = None
+    timeouts: Optional[int] = None
+    wait_seconds_total: Optional[float] = None
+    wait_seconds_max: Optional[float] = None
+
+    model_config = {"json_schema_extra": {"example": EXAMPLE_POOL_STATS_JSON}}
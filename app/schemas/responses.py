@@ -2,18 +2,34 @@ from typing import List, Optional
 
 from pydantic import BaseModel
 
-from app.schemas.base import EXAMPLE_JSON, MovieSchema
+from app.schemas.base import (
+    EXAMPLE_CACHE_STATS_JSON,
+    EXAMPLE_JSON,
+    EXAMPLE_POOL_STATS_JSON,
+    EXAMPLE_RANKING_JSON,
+    EXAMPLE_SIMILAR_JSON,
+    BulkRatingResultSchema,
+    CacheStatsSchema,
+    MovieFieldsSchema,
+    MovieRankingSchema,
+    MovieSchema,
+    PoolStatsSchema,
+    RatingInSchema,
+    SimilarMovieSchema,
+)
 
 
 class MovieResponse(BaseModel):
     message: str
-    data: Optional[List[MovieSchema]] = None
+    data: Optional[List[MovieFieldsSchema]] = None
+    next_cursor: Optional[str] = None
 
     model_config = {
         "json_schema_extra": {
             "example": {
                 "message": "Movie data retrieved from database",
                 "data": [EXAMPLE_JSON],
+                "next_cursor": "MSwx",
             }
         }
     }
@@ -33,6 +49,50 @@ class RatingResponse(BaseModel):
     }
 
 
+class RatingPageResponse(BaseModel):
+    message: str
+    data: Optional[List[MovieSchema]] = None
+    next_cursor: Optional[str] = None
+
+    model_config = {
+        "json_schema_extra": {
+            "example": {
+                "message": f"Ratings for {EXAMPLE_JSON['user_id']} retrieved from database",
+                "data": [EXAMPLE_JSON],
+                "next_cursor": "NSwx",
+            }
+        }
+    }
+
+
+class RankingResponse(BaseModel):
+    message: str
+    data: Optional[List[MovieRankingSchema]] = None
+
+    model_config = {
+        "json_schema_extra": {
+            "example": {
+                "message": "Top five average rated movies for all users retrieved from database",
+                "data": [EXAMPLE_RANKING_JSON],
+            }
+        }
+    }
+
+
+class SimilarMovieResponse(BaseModel):
+    message: str
+    data: Optional[List[SimilarMovieSchema]] = None
+
+    model_config = {
+        "json_schema_extra": {
+            "example": {
+                "message": f"Movies similar to {EXAMPLE_JSON['id']} retrieved from the similarity index",
+                "data": [EXAMPLE_SIMILAR_JSON],
+            }
+        }
+    }
+
+
 class UpdateRatingResponse(BaseModel):
     message: str
     data: MovieSchema
@@ -45,3 +105,82 @@ class UpdateRatingResponse(BaseModel):
             }
         }
     }
+
+
+class AcceptedRatingResponse(BaseModel):
+    message: str
+    data: RatingInSchema
+
+    model_config = {
+        "json_schema_extra": {
+            "example": {
+                "message": f"Rating value change accepted for USER-ID: {EXAMPLE_JSON['user_id']} and MOVIE-ID: {EXAMPLE_JSON['id']}",
+                "data": {
+                    "user_id": EXAMPLE_JSON["user_id"],
+                    "movie_id": EXAMPLE_JSON["id"],
+                    "rating": EXAMPLE_JSON["rating"],
+                },
+            }
+        }
+    }
+
+
+class BulkRatingResponse(BaseModel):
+    message: str
+    created: int
+    updated: int
+    failed: int
+    results: List[BulkRatingResultSchema]
+
+    model_config = {
+        "json_schema_extra": {
+            "example": {
+                "message": "Ratings written to database",
+                "created": 1,
+                "updated": 0,
+                "failed": 1,
+                "results": [
+                    {"index": 0, "user_id": 1, "movie_id": 1, "status": "created"},
+                    {
+                        "index": 1,
+                        "user_id": 1,
+                        "movie_id": 999,
+                        "status": "failed",
+                        "detail": "No movie found in Database",
+                    },
+                ],
+            }
+        }
+    }
+
+
+class CacheStatsResponse(BaseModel):
+    message: str
+    backend: str
+    enabled: bool
+    data: CacheStatsSchema
+
+    model_config = {
+        "json_schema_extra": {
+            "example": {
+                "message": "Query cache statistics",
+                "backend": "redis",
+                "enabled": True,
+                "data": EXAMPLE_CACHE_STATS_JSON,
+            }
+        }
+    }
+
+
+class PoolStatsResponse(BaseModel):
+    message: str
+    data: List[PoolStatsSchema]
+
+    model_config = {
+        "json_schema_extra": {
+            "example": {
+                "message": "Connection pool statistics",
+                "data": [EXAMPLE_POOL_STATS_JSON],
+            }
+        }
+    }
@@ -0,0 +1,128 @@
+"""
+Production server: uvicorn with one worker process per core when the query cache is shared, the
+fastest event loop and HTTP parser installed, and a graceful drain on shutdown.
+
+Usage:
+    python -m app.server
+    python -m app.server --workers 4 --port 8080
+"""
+
+import argparse
+import logging
+import os
+from importlib.util import find_spec
+from typing import Optional
+
+import uvicorn
+
+from app.settings import Settings
+
+# Logged with the messages of the server
+logger = logging.getLogger("uvicorn.error")
+
+# Import string of the application, imported by every worker on its own
+APP = "main:app"
+
+
+def default_workers(settings: Settings) -> int:
+    """
+    Without a shared query cache (see app.methods.cache) every worker keeps its own cache, data
+    version, columnar engine and n-gram index, so only a single worker may run.
+
+    :param settings: settings of the server
+    :return: WEB_CONCURRENCY, or the number of cores the process may run on (which honours CPU
+        affinity, unlike the number of cores of the machine) when the query cache is shared, a
+        single worker otherwise
+    """
+    if settings.server_workers:
+        return settings.server_workers
+    if not settings.query_cache_url:
+        return 1
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def event_loop() -> str:
+    """
+    :return: uvloop when installed, asyncio otherwise
+    """
+    return "uvloop" if find_spec("uvloop") is not None else "asyncio"
+
+
+def http_protocol() -> str:
+    """
+    :return: the httptools parser when installed, h11 otherwise
+    """
+    return "httptools" if find_spec("httptools") is not None else "h11"
+
+
+def server_config(
+    settings: Settings,
+    host: Optional[str] = None,
+    port: Optional[int] = None,
+    workers: Optional[int] = None,
+) -> uvicorn.Config:
+    """
+    Configure the server. The application is passed as an import string, so the supervisor never
+    imports it: every worker is a fresh process that imports the application and creates its own
+    engines in the lifespan, and no connection is shared between workers.
+
+    :param settings: settings of the server
+    :param host: Optional interface to listen on, the one of the settings by default
+    :param port: Optional port to listen on, the one of the settings by default
+    :param workers: Optional number of worker processes, see default_workers
+    :return: uvicorn config
+    """
+    return uvicorn.Config(
+        APP,
+        host=host or settings.server_host,
+        port=port or settings.server_port,
+        workers=workers or default_workers(settings),
+        loop=event_loop(),
+        http=http_protocol(),
+        backlog=settings.server_backlog,
+        timeout_keep_alive=settings.server_keep_alive,
+        timeout_graceful_shutdown=settings.server_graceful_timeout,
+        limit_concurrency=settings.server_limit_concurrency,
+        access_log=settings.server_access_log,
+    )
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    settings = Settings.from_env()
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default=settings.server_host)
+    parser.add_argument("--port", type=int, default=settings.server_port)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="worker processes, one per core by default when QUERY_CACHE_URL is set",
+    )
+    args = parser.parse_args(argv)
+
+    config = server_config(settings, args.host, args.port, args.workers)
+    if config.workers > 1 and not settings.query_cache_url:
+        parser.error(
+            f"{config.workers} workers need a shared query cache, set QUERY_CACHE_URL"
+        )
+    server = uvicorn.Server(config)
+    logger.info(
+        "Serving %s with %d workers (%s, %s)",
+        APP,
+        config.workers,
+        config.loop,
+        config.http,
+    )
+    if config.workers > 1:
+        # Workers are spawned, not forked: they import the application after the socket is bound
+        from uvicorn.supervisors import Multiprocess
+
+        sock = config.bind_socket()
+        Multiprocess(config, target=server.run, sockets=[sock]).run()
+    else:
+        server.run()
+
+
+if __name__ == "__main__":
+    main()
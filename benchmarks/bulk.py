@@ -0,0 +1,132 @@
+"""
+Ratings per second of the bulk rating endpoint (POST /movies/user_rating/bulk) for bodies of 10k to
+100k ratings, sent to the ASGI application in process: body parsing, validation, the upserts and
+the response encoding.
+
+    python -m benchmarks.bulk --url sqlite:///bench.db --sizes 10000,50000,100000 --repeat 3
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from pathlib import Path
+
+import httpx
+import orjson
+from sqlalchemy import create_engine, select
+
+from app.factory import create_app
+from app.models.movie import Movie, User
+from app.settings import Settings
+from benchmarks.results import save_results
+
+BULK_PATH = "/api/v1/movies/user_rating/bulk"
+
+
+def make_bodies(
+    url: str, sizes: list[int], repeat: int, rng: random.Random
+) -> dict[int, list[bytes]]:
+    """
+    :param url: database the application writes, to draw existing user and movie ids from
+    :return: JSON array bodies of random ratings of existing users and movies, by size
+    """
+    engine = create_engine(url)
+    with engine.connect() as connection:
+        user_ids = connection.scalars(select(User.id).limit(100_000)).all()
+        movie_ids = connection.scalars(select(Movie.id).limit(100_000)).all()
+    engine.dispose()
+    if not user_ids or not movie_ids:
+        raise SystemExit(
+            "No users or movies found, load data with benchmarks.data first"
+        )
+    return {
+        size: [
+            orjson.dumps(
+                [
+                    {
+                        "user_id": rng.choice(user_ids),
+                        "movie_id": rng.choice(movie_ids),
+                        "rating": rng.randint(1, 5),
+                    }
+                    for _ in range(size)
+                ]
+            )
+            for _ in range(repeat)
+        ]
+        for size in sizes
+    }
+
+
+async def run(url: str, sizes: list[int], repeat: int, seed: int = 0) -> dict:
+    """
+    :param url: database loaded by benchmarks.data, the ratings sent are written to it
+    :param sizes: numbers of ratings per request
+    :param repeat: requests sent per size, each with different ratings
+    :param seed: seed of the ratings
+    :return: best and median ratings per second, and the created and updated counts, by size
+    """
+    bodies = make_bodies(url, sizes, repeat, random.Random(seed))
+    app = create_app(Settings(database_url=url, schema="skip"))
+    transport = httpx.ASGITransport(app=app)
+    results = {}
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://benchmark", timeout=600
+        ) as client:
+            for size, size_bodies in bodies.items():
+                rates, created, updated = [], 0, 0
+                for body in size_bodies:
+                    start = time.perf_counter()
+                    response = await client.post(
+                        BULK_PATH,
+                        content=body,
+                        headers={"content-type": "application/json"},
+                    )
+                    seconds = time.perf_counter() - start
+                    response.raise_for_status()
+                    content = response.json()
+                    created += content["created"]
+                    updated += content["updated"]
+                    rates.append(size / seconds)
+                rates.sort()
+                results[f"bulk_{size}"] = {
+                    "ratings_per_second": round(rates[-1], 1),
+                    "median_ratings_per_second": round(rates[len(rates) // 2], 1),
+                    "created": created,
+                    "updated": updated,
+                }
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--url", required=True, help="database loaded by benchmarks.data"
+    )
+    parser.add_argument(
+        "--sizes",
+        default="10000,50000,100000",
+        help="comma separated numbers of ratings per request",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file to write the results to")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    results = asyncio.run(run(args.url, sizes, args.repeat, args.seed))
+    for name, metrics in results.items():
+        print(
+            f"{name:>12}: {metrics['ratings_per_second']:12,.0f} ratings/s  "
+            f"(median {metrics['median_ratings_per_second']:,.0f})"
+        )
+    params = {"sizes": sizes, "repeat": args.repeat, "seed": args.seed}
+    path = save_results(
+        "bulk", args.url, params, results, args.output and Path(args.output)
+    )
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Micro-benchmarks of every Crud method against a database loaded by benchmarks.data: latency
+percentiles and SQL statements per call, with parameters drawn from the loaded data.
+
+    python -m benchmarks.crud --url sqlite:///bench.db --repeat 200
+"""
+
+import argparse
+import random
+import time
+from pathlib import Path
+from typing import Callable
+
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import Session
+
+from app.instrumentation import RequestStats, instrument_engine, request_stats
+from app.methods.routes_class import Crud
+from app.models.movie import Movie, Rating, User
+from app.schemas.base import RatingInSchema
+from benchmarks.results import percentiles, save_results
+
+
+class Sample:
+    """
+    Ids and titles of the loaded data to draw benchmark parameters from
+    """
+
+    def __init__(self, db: Session, rng: random.Random, size: int = 1000):
+        self.rng = rng
+        users = db.scalar(select(func.max(User.id))) or 0
+        movies = db.scalar(select(func.max(Movie.id))) or 0
+        self.ratings = db.execute(
+            select(Rating.user_id, Rating.movie_id)
+            .where(
+                Rating.user_id.in_(rng.sample(range(1, users + 1), min(size, users)))
+            )
+            .order_by(Rating.user_id, Rating.movie_id)
+        ).all()
+        self.titles = db.scalars(
+            select(Movie.title)
+            .where(Movie.id.in_(rng.sample(range(1, movies + 1), min(size, movies))))
+            .order_by(Movie.id)
+        ).all()
+
+    def rating(self) -> tuple[int, int]:
+        """
+        :return: (user id, movie id) of an existing rating
+        """
+        return tuple(self.rng.choice(self.ratings))
+
+    def title_word(self) -> str:
+        return self.rng.choice(self.rng.choice(self.titles).split())
+
+
+def cases(sample: Sample) -> dict[str, Callable[[Crud], object]]:
+    """
+    :return: a call of a Crud method with fresh parameters, by case name
+    """
+    rng = sample.rng
+
+    def update(crud: Crud):
+        user_id, movie_id = sample.rating()
+        return crud.update_movie_rating(movie_id, user_id, rng.randint(1, 5))
+
+    def bulk_upsert(crud: Crud):
+        return crud.bulk_upsert_ratings(
+            [
+                RatingInSchema(
+                    user_id=user_id, movie_id=movie_id, rating=rng.randint(1, 5)
+                )
+                for user_id, movie_id in rng.sample(sample.ratings, 100)
+            ]
+        )
+
+    return {
+        "get_movies_info": lambda crud: crud.get_movies_info(limit=50),
+        "get_movies_info_contains": lambda crud: crud.get_movies_info(
+            title=sample.title_word(), limit=50
+        ),
+        "get_movies_info_prefix": lambda crud: crud.get_movies_info(
+            title=sample.title_word(), mode="prefix", limit=50
+        ),
+        "get_movies_info_fuzzy": lambda crud: crud.get_movies_info(
+            title=sample.title_word(), mode="fuzzy", limit=50
+        ),
+        "get_movie_rating_by_unique_filter": lambda crud: (
+            crud.get_movie_rating_by_unique_filter(*reversed(sample.rating()))
+        ),
+        "get_movie_average_rating": lambda crud: crud.get_movie_average_rating(
+            sample.rating()[1]
+        ),
+        "get_top_five_movie_ratings_user": lambda crud: crud.get_top_five_movie_ratings(
+            user_id=sample.rating()[0]
+        ),
+        "get_top_movie_rankings": lambda crud: crud.get_top_movie_rankings(
+            k=10, min_votes=10
+        ),
+        "get_user_ratings_page": lambda crud: crud.get_user_ratings_page(
+            sample.rating()[0], limit=50
+        ),
+        "update_movie_rating": update,
+        "bulk_upsert_ratings_100": bulk_upsert,
+    }
+
+
+def run(url: str, repeat: int, seed: int = 0, only: tuple[str, ...] = ()) -> dict:
+    """
+    :param url: database loaded by benchmarks.data
+    :param repeat: number of calls of every case
+    :param seed: seed of the parameters drawn from the data
+    :param only: Optional names of the cases to run
+    :return: latency percentiles and statements per call, by case
+    """
+    engine = create_engine(url)
+    instrument_engine("benchmark", engine)
+    results = {}
+    with Session(engine) as db:
+        sample = Sample(db, random.Random(seed))
+        db.rollback()
+        crud = Crud(db)
+        for name, call in cases(sample).items():
+            if only and name not in only:
+                continue
+            call(crud)  # warm up the statement cache and the database cache
+            db.rollback()
+            samples, stats = [], RequestStats()
+            token = request_stats.set(stats)
+            try:
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    call(crud)
+                    samples.append(time.perf_counter() - start)
+                    # End the read transaction so every call starts from the same state
+                    db.rollback()
+            finally:
+                request_stats.reset(token)
+            results[name] = {
+                **percentiles(samples),
+                "queries_per_call": round(stats.queries / repeat, 2),
+            }
+    engine.dispose()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", required=True)
+    parser.add_argument("--repeat", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--case", action="append", default=[], help="case to run")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    args = parser.parse_args()
+
+    results = run(args.url, args.repeat, args.seed, tuple(args.case))
+    for name, metrics in results.items():
+        print(
+            f"{name:>34}: p50 {metrics['p50_ms']:8.2f} ms  p95 {metrics['p95_ms']:8.2f} ms  "
+            f"p99 {metrics['p99_ms']:8.2f} ms  {metrics['queries_per_call']:5.1f} queries"
+        )
+    path = save_results(
+        "crud",
+        args.url,
+        {"repeat": args.repeat, "seed": args.seed},
+        results,
+        args.output and Path(args.output),
+    )
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Generate a synthetic movie ratings dataset of realistic shape and bulk load it into a database.
+
+Movie popularity follows a Zipf law, so a few movies get most of the ratings, and the number of
+ratings per user is log-normal, so most users rate a handful of movies and a few rate hundreds.
+Every movie has a quality and every user a bias, ratings are their sum plus noise rounded into
+1..5, which gives the usual skew towards 3 and 4 stars.
+
+    python -m benchmarks.data --url sqlite:///bench.db --users 1000000 --movies 50000 \\
+        --ratings 20000000 --reset
+"""
+
+import argparse
+import bisect
+import itertools
+import random
+import time
+from dataclasses import asdict, dataclass
+from typing import Iterator
+
+from sqlalchemy import Engine, create_engine, func, insert, select, text
+from sqlalchemy.orm import Session
+
+from app.methods.aggregates import rebuild_rating_aggregates
+from app.models.movie import Base, Movie, Rating, User
+
+# Rows inserted per statement
+BATCH_SIZE = 10_000
+
+GENRES = ("Drama", "Comedy", "Action", "Thriller", "Romance", "Sci-Fi", "Horror")
+GENRE_WEIGHTS = (30, 25, 15, 10, 8, 7, 5)
+ADJECTIVES = ("Silent", "Broken", "Last", "Golden", "Hidden", "Dark", "Lost", "Wild")
+NOUNS = ("River", "Empire", "Night", "Garden", "Promise", "Storm", "Road", "Kingdom")
+
+
+@dataclass
+class DatasetSpec:
+    users: int = 10_000
+    movies: int = 2_000
+    ratings: int = 200_000
+    zipf_exponent: float = 1.0
+    seed: int = 42
+
+
+def movie_rows(spec: DatasetSpec, rng: random.Random) -> Iterator[dict]:
+    """
+    :return: a row per movie, titles searchable by word
+    """
+    for movie_id in range(1, spec.movies + 1):
+        yield {
+            "id": movie_id,
+            "title": f"{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} {movie_id}",
+            "genre": rng.choices(GENRES, GENRE_WEIGHTS)[0],
+            # Recent years are more frequent
+            "year": str(2024 - min(int(rng.expovariate(1 / 15)), 74)),
+            "runtime": f"{rng.randint(80, 180)} min",
+        }
+
+
+def ratings_per_user(spec: DatasetSpec, rng: random.Random) -> list[int]:
+    """
+    :return: number of ratings of every user, log-normal and summing to about spec.ratings
+    """
+    weights = [rng.lognormvariate(0, 1.2) for _ in range(spec.users)]
+    scale = spec.ratings / sum(weights)
+    limit = max(spec.movies // 2, 1)
+    return [min(max(round(weight * scale), 1), limit) for weight in weights]
+
+
+def rating_rows(spec: DatasetSpec, rng: random.Random) -> Iterator[dict]:
+    """
+    :return: a row per rating, each (user, movie) pair at most once
+    """
+    movie_ids = list(range(1, spec.movies + 1))
+    rng.shuffle(movie_ids)
+    # Popularity by rank, the shuffled ids decide which movie gets which rank
+    cum_weights = list(
+        itertools.accumulate(
+            1 / (rank**spec.zipf_exponent) for rank in range(1, spec.movies + 1)
+        )
+    )
+    total_weight = cum_weights[-1]
+    quality = {
+        movie_id: min(max(rng.gauss(3.4, 0.6), 1.5), 4.8) for movie_id in movie_ids
+    }
+
+    for user_id, count in enumerate(ratings_per_user(spec, rng), start=1):
+        bias = rng.gauss(0, 0.4)
+        rated = set()
+        while len(rated) < count:
+            index = bisect.bisect_left(cum_weights, rng.random() * total_weight)
+            rated.add(movie_ids[min(index, spec.movies - 1)])
+        for movie_id in rated:
+            rating = round(quality[movie_id] + bias + rng.gauss(0, 0.8))
+            yield {
+                "user_id": user_id,
+                "movie_id": movie_id,
+                "rating": min(max(rating, 1), 5),
+            }
+
+
+def batches(rows: Iterator[dict], size: int = BATCH_SIZE) -> Iterator[list[dict]]:
+    while batch := list(itertools.islice(rows, size)):
+        yield batch
+
+
+def load(engine: Engine, spec: DatasetSpec, reset: bool = False) -> dict:
+    """
+    Generate the dataset and insert it in batches, then build the rating aggregates
+
+    :param engine: engine of the target database
+    :param spec: size and shape of the dataset
+    :param reset: drop and recreate the tables first, otherwise they must be empty
+    :return: number of rows of each table and the load time
+    """
+    if reset:
+        Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    rng = random.Random(spec.seed)
+    start = time.perf_counter()
+
+    with Session(engine) as db:
+        if db.scalar(select(func.count()).select_from(Movie)):
+            raise SystemExit("Movies table is not empty, pass --reset to replace it")
+        for table, rows in (
+            (Movie, movie_rows(spec, rng)),
+            (User, ({"id": user_id} for user_id in range(1, spec.users + 1))),
+            (Rating, rating_rows(spec, rng)),
+        ):
+            for batch in batches(rows):
+                db.connection().execute(insert(table.__table__), batch)
+        aggregates = rebuild_rating_aggregates(db)
+        db.commit()
+        ratings = db.scalar(select(func.count()).select_from(Rating))
+
+    if engine.dialect.name == "postgresql":
+        with engine.connect() as connection:
+            connection.execution_options(isolation_level="AUTOCOMMIT").execute(
+                text("ANALYZE")
+            )
+
+    seconds = time.perf_counter() - start
+    return {
+        "movies": spec.movies,
+        "users": spec.users,
+        "ratings": ratings,
+        "aggregates": aggregates,
+        "seconds": round(seconds, 3),
+        "ratings_per_second": round(ratings / seconds),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--url", required=True, help="database to load, e.g. sqlite:///bench.db"
+    )
+    defaults = DatasetSpec()
+    for name, value in asdict(defaults).items():
+        parser.add_argument(
+            f"--{name.replace('_', '-')}", type=type(value), default=value
+        )
+    parser.add_argument("--reset", action="store_true", help="drop the tables first")
+    args = parser.parse_args()
+
+    spec = DatasetSpec(**{name: getattr(args, name) for name in asdict(defaults)})
+    engine = create_engine(args.url)
+    summary = load(engine, spec, args.reset)
+    engine.dispose()
+    print(
+        f"Loaded {summary['movies']:,} movies, {summary['users']:,} users and "
+        f"{summary['ratings']:,} ratings in {summary['seconds']:.1f} s "
+        f"({summary['ratings_per_second']:,} ratings/s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
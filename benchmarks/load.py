@@ -0,0 +1,241 @@
+"""
+End-to-end load driver of the API: concurrent clients send a weighted mix of requests to the
+ASGI application in process (or to a running server with --base-url) and the throughput, latency
+percentiles and SQL statements per request are reported by scenario.
+
+    python -m benchmarks.load --url sqlite:///bench.db --requests 5000 --concurrency 16
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+import httpx
+from sqlalchemy import create_engine, func, select
+
+from app.factory import create_app
+from app.instrumentation import REQUEST_QUERIES
+from app.models.movie import Movie, Rating
+from app.settings import Settings
+from benchmarks.results import percentiles, save_results
+
+# Share of the requests of every scenario
+SCENARIO_WEIGHTS = {
+    "list_movies": 30,
+    "search_title": 15,
+    "top_five_all_users": 15,
+    "top_five_user": 15,
+    "user_ratings": 15,
+    "update_rating": 10,
+}
+
+# Route template of every scenario, to read its statement counts from the request metrics
+SCENARIO_ROUTES = {
+    "list_movies": ("GET", "/api/v1/movies"),
+    "search_title": ("GET", "/api/v1/movies"),
+    "top_five_all_users": ("GET", "/api/v1/movies/top_five/total_user"),
+    "top_five_user": ("GET", "/api/v1/movies/top_five/{user_id}"),
+    "user_ratings": ("GET", "/api/v1/users/{user_id}/ratings"),
+    "update_rating": (
+        "PUT",
+        "/api/v1/movies/user_rating/{user_id}/{movie_id}/{rating}",
+    ),
+}
+
+
+def scenarios(url: str, rng: random.Random, size: int = 1000) -> dict[str, Callable]:
+    """
+    :param url: database the application reads, to draw existing ids and titles from
+    :return: function returning the (method, path) of a new request, by scenario
+    """
+    engine = create_engine(url)
+    with engine.connect() as connection:
+        ratings = connection.execute(
+            select(Rating.user_id, Rating.movie_id)
+            .order_by(Rating.user_id, Rating.movie_id)
+            .limit(size * 10)
+        ).all()
+        titles = connection.scalars(select(Movie.title).limit(size)).all()
+        if not ratings:
+            raise SystemExit("No ratings found, load data with benchmarks.data first")
+        count = connection.scalar(select(func.count()).select_from(Rating))
+    engine.dispose()
+    words = sorted({word for title in titles for word in title.split()})
+    print(f"Drawing requests from {len(ratings):,} of {count:,} ratings")
+
+    def rating():
+        return rng.choice(ratings)
+
+    return {
+        "list_movies": lambda: ("GET", "/api/v1/movies?limit=50"),
+        "search_title": lambda: ("GET", f"/api/v1/movies?title={rng.choice(words)}"),
+        "top_five_all_users": lambda: (
+            "GET",
+            "/api/v1/movies/top_five/total_user?k=10",
+        ),
+        "top_five_user": lambda: ("GET", f"/api/v1/movies/top_five/{rating()[0]}"),
+        "user_ratings": lambda: ("GET", f"/api/v1/users/{rating()[0]}/ratings"),
+        "update_rating": lambda: (
+            "PUT",
+            "/api/v1/movies/user_rating/{}/{}/{}".format(*rating(), rng.randint(1, 5)),
+        ),
+    }
+
+
+def query_counts() -> dict[tuple, tuple[float, int]]:
+    """
+    :return: sum and count of the statements per request, by (method, route)
+    """
+    with REQUEST_QUERIES.lock:
+        return {
+            labels: (values[-1], sum(values[:-1]))
+            for labels, values in REQUEST_QUERIES.series.items()
+        }
+
+
+async def drive(
+    client: httpx.AsyncClient,
+    make_request: dict[str, Callable],
+    requests: int,
+    concurrency: int,
+    rng: random.Random,
+) -> tuple[dict[str, list[float]], dict[str, int], float]:
+    """
+    Send the requests from concurrent clients
+
+    :return: latencies and error counts by scenario, and the wall time of the run
+    """
+    names = rng.choices(
+        list(SCENARIO_WEIGHTS), weights=list(SCENARIO_WEIGHTS.values()), k=requests
+    )
+    plan = iter([(name, make_request[name]()) for name in names])
+    latencies = {name: [] for name in SCENARIO_WEIGHTS}
+    errors = {name: 0 for name in SCENARIO_WEIGHTS}
+
+    async def worker():
+        for name, (method, path) in plan:
+            start = time.perf_counter()
+            response = await client.request(method, path)
+            latencies[name].append(time.perf_counter() - start)
+            # Not found answers are expected for filters matching nothing
+            if response.status_code >= 400 and response.status_code != 404:
+                errors[name] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - start
+
+
+async def run(
+    url: str,
+    requests: int,
+    concurrency: int,
+    seed: int = 0,
+    cache: bool = True,
+    base_url: Optional[str] = None,
+) -> dict:
+    """
+    :param url: database loaded by benchmarks.data
+    :param requests: number of requests to send
+    :param concurrency: number of concurrent clients
+    :param seed: seed of the request mix and parameters
+    :param cache: whether the query cache of the application is enabled
+    :param base_url: Optional URL of a running server to load instead of the app in process
+    :return: metrics of the whole run and of every scenario
+    """
+    rng = random.Random(seed)
+    make_request = scenarios(url, rng)
+    if base_url is not None:
+        async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+            latencies, errors, seconds = await drive(
+                client, make_request, requests, concurrency, rng
+            )
+        before = after = {}
+    else:
+        app = create_app(
+            Settings(database_url=url, schema="skip", query_cache_enabled=cache)
+        )
+        transport = httpx.ASGITransport(app=app)
+        async with app.router.lifespan_context(app):
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://benchmark"
+            ) as client:
+                before = query_counts()
+                latencies, errors, seconds = await drive(
+                    client, make_request, requests, concurrency, rng
+                )
+                after = query_counts()
+
+    results = {
+        "total": {
+            "requests_per_second": round(requests / seconds, 1),
+            **percentiles([value for values in latencies.values() for value in values]),
+            "errors": sum(errors.values()),
+        }
+    }
+    for name, samples in latencies.items():
+        results[name] = {**percentiles(samples), "errors": errors[name]}
+    # Statement counts are per route, scenarios sharing a route report the same average
+    for name, route in SCENARIO_ROUTES.items():
+        queries, count = after.get(route, (0, 0))
+        old_queries, old_count = before.get(route, (0, 0))
+        if count > old_count:
+            results[name]["queries_per_request"] = round(
+                (queries - old_queries) / (count - old_count), 2
+            )
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--url", required=True, help="database loaded by benchmarks.data"
+    )
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--no-cache", action="store_true", help="disable the query cache"
+    )
+    parser.add_argument(
+        "--base-url", help="load a running server instead, e.g. http://localhost:8000"
+    )
+    parser.add_argument("--output", help="JSON file to write the results to")
+    args = parser.parse_args()
+
+    results = asyncio.run(
+        run(
+            args.url,
+            args.requests,
+            args.concurrency,
+            args.seed,
+            not args.no_cache,
+            args.base_url,
+        )
+    )
+    print(f"{results['total']['requests_per_second']:,.1f} requests/s")
+    for name, metrics in results.items():
+        queries = metrics.get("queries_per_request")
+        print(
+            f"{name:>20}: p50 {metrics['p50_ms']:8.2f} ms  p95 {metrics['p95_ms']:8.2f} ms  "
+            f"p99 {metrics['p99_ms']:8.2f} ms  {metrics['errors']} errors"
+            + (f"  {queries:.1f} queries" if queries is not None else "")
+        )
+    params = {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "seed": args.seed,
+        "cache": not args.no_cache,
+        "base_url": args.base_url,
+    }
+    path = save_results(
+        "load", args.url, params, results, args.output and Path(args.output)
+    )
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Store benchmark results as JSON and compare two runs.
+
+    python -m benchmarks.results benchmarks/results/crud-old.json benchmarks/results/crud-new.json
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import time
+from pathlib import Path
+from typing import Optional, Sequence
+
+from sqlalchemy.engine import make_url
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+# Metrics where a higher value is better, every other metric is a duration or a count
+HIGHER_IS_BETTER = (
+    "requests_per_second",
+    "ratings_per_second",
+    "median_ratings_per_second",
+)
+
+
+def percentiles(samples: Sequence[float]) -> dict:
+    """
+    :param samples: durations in seconds
+    :return: count, mean, p50, p95, p99 and max in milliseconds
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return {"count": 0}
+
+    def rank(fraction: float) -> float:
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)] * 1000
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50_ms": round(rank(0.50), 3),
+        "p95_ms": round(rank(0.95), 3),
+        "p99_ms": round(rank(0.99), 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(
+    name: str,
+    url: str,
+    params: dict,
+    results: dict,
+    output: Optional[Path] = None,
+) -> Path:
+    """
+    Write the results of a run with what is needed to compare it with other runs
+
+    :param name: name of the benchmark
+    :param url: database URL the benchmark ran against, stored without its password
+    :param params: parameters of the run
+    :param results: results by case
+    :param output: Optional file to write, benchmarks/results/<name>-<time>.json by default
+    :return: path of the written file
+    """
+    if output is None:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        output = RESULTS_DIR / f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    document = {
+        "benchmark": name,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.platform(),
+        "database": make_url(url).render_as_string(hide_password=True),
+        "params": params,
+        "results": results,
+    }
+    output.write_text(json.dumps(document, indent=2))
+    return output
+
+
+def compare(old: dict, new: dict) -> list[str]:
+    """
+    :param old: results document of the baseline run
+    :param new: results document of the run to compare
+    :return: a line per metric of every case found in both runs, with the relative change
+    """
+    lines = []
+    for case, new_metrics in new["results"].items():
+        old_metrics = old["results"].get(case)
+        if old_metrics is None:
+            continue
+        lines.append(case)
+        for metric, new_value in new_metrics.items():
+            old_value = old_metrics.get(metric)
+            if metric == "count" or not old_value or not isinstance(new_value, float):
+                continue
+            change = (new_value - old_value) / old_value * 100
+            better = (change > 0) == (metric in HIGHER_IS_BETTER)
+            verdict = "" if abs(change) < 5 else (" better" if better else " worse")
+            lines.append(
+                f"  {metric:>20}: {old_value:>12,.3f} -> {new_value:>12,.3f} "
+                f"({change:+.1f}%){verdict}"
+            )
+    return lines
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("old", type=Path)
+    parser.add_argument("new", type=Path)
+    args = parser.parse_args()
+    old, new = (json.loads(path.read_text()) for path in (args.old, args.new))
+    print(f"{old['benchmark']}: {old['git_commit']} -> {new['git_commit']}")
+    print("\n".join(compare(old, new)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Rows per second of the GET /movies response body, built through the response schemas as FastAPI
+does for a route returning a MovieResponse, and through the direct orjson path the routes use.
+
+    python -m benchmarks.serialization --rows 20000 --repeat 5
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from typing import Callable, Sequence
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+from sqlalchemy import Row, create_engine, insert
+from sqlalchemy.orm import Session
+
+from app.methods.fast_json import json_response, rows_to_dicts
+from app.methods.routes_class import Crud, select_movie_ratings
+from app.models.movie import Base, Movie, MovieRatingAggregate, Rating, User
+from app.schemas.base import MovieFieldsSchema, MovieSchema
+from app.schemas.responses import MovieResponse
+
+MESSAGE = "Movie data retrieved from database"
+
+
+def make_rows(count: int) -> list[Row]:
+    """
+    Select generated ratings from an in-memory SQLite database
+
+    :param count: number of ratings
+    :return: rows in MovieSchema shape
+    """
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    movies = max(count // 10, 1)
+    with Session(engine) as db:
+        db.execute(
+            insert(Movie),
+            [
+                {
+                    "id": movie_id,
+                    "title": f"Movie {movie_id}",
+                    "genre": random.choice(["Drama", "Comedy", "Sci-Fi"]),
+                    "year": str(random.randint(1950, 2024)),
+                    "runtime": f"{random.randint(80, 180)} min",
+                }
+                for movie_id in range(movies)
+            ],
+        )
+        db.execute(insert(User), [{"id": user_id} for user_id in range(10)])
+        db.execute(
+            insert(Rating),
+            [
+                {
+                    "user_id": index % 10,
+                    "movie_id": index // 10,
+                    "rating": random.randint(1, 5),
+                }
+                for index in range(count)
+            ],
+        )
+        db.execute(
+            insert(MovieRatingAggregate),
+            [
+                {
+                    "movie_id": movie_id,
+                    "rating_sum": 30,
+                    "rating_count": 10,
+                    "avr_rating": 3.0,
+                }
+                for movie_id in range(movies)
+            ],
+        )
+        return db.execute(select_movie_ratings()).all()
+
+
+async def schema_path(rows: Sequence[Row], field) -> bytes:
+    """
+    Build the body like the routes did before: a schema per row, the response schema, then the
+    validation and serialization FastAPI runs for the response model
+    """
+    movies = Crud.create_movie_schema_list(rows, schema=MovieFieldsSchema)
+    content = await serialize_response(
+        field=field,
+        response_content=MovieResponse(message=MESSAGE, data=movies),
+        exclude_unset=True,
+        is_coroutine=True,
+    )
+    return JSONResponse(content).body
+
+
+async def direct_path(rows: Sequence[Row], field) -> bytes:
+    """
+    Build the body like the routes do now: dictionaries straight from the rows, encoded by orjson
+    """
+    return json_response(
+        {"message": MESSAGE, "data": rows_to_dicts(rows, MovieSchema)}
+    ).body
+
+
+async def measure(
+    build: Callable, rows: Sequence[Row], field, repeat: int
+) -> tuple[float, int]:
+    """
+    :return: best rows per second over the runs, and the body size
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = await build(rows, field)
+        best = min(best, time.perf_counter() - start)
+    return len(rows) / best, len(body)
+
+
+async def run(count: int, repeat: int) -> None:
+    rows = make_rows(count)
+    field = create_response_field(name="Response_pull_movie_info", type_=MovieResponse)
+    results = {}
+    for name, build in (("schema", schema_path), ("direct", direct_path)):
+        results[name] = await measure(build, rows, field, repeat)
+        rows_per_second, size = results[name]
+        print(f"{name:>8}: {rows_per_second:12,.0f} rows/s  ({size:,} bytes)")
+    print(f" speedup: {results['direct'][0] / results['schema'][0]:.1f}x")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=20_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(run(args.rows, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+Throughput of the production server (python -m app.server) against the single process
+development server (uvicorn main:app --reload): each setup is started on a database loaded by
+benchmarks.data and loaded with the request mix of benchmarks.load by concurrent client processes.
+
+    python -m benchmarks.server --url sqlite:///bench.db --requests 20000 --concurrency 32
+"""
+
+import argparse
+import asyncio
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import httpx
+
+from app.server import default_workers
+from app.settings import Settings
+from benchmarks import load
+from benchmarks.results import save_results
+
+# Seconds to wait for a server to answer after it was started, and to exit after SIGTERM
+START_TIMEOUT = 60
+STOP_TIMEOUT = 60
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def server_commands(port: int, workers: int) -> dict[str, list[str]]:
+    """
+    :return: command line of every setup, by name
+    """
+    address = ["--host", "127.0.0.1", "--port", str(port)]
+    return {
+        "single_reload": [sys.executable, "-m", "uvicorn", "main:app", *address]
+        + ["--reload"],
+        f"workers_{workers}": [sys.executable, "-m", "app.server", *address]
+        + ["--workers", str(workers)],
+    }
+
+
+def start_server(command: list[str], url: str, base_url: str) -> subprocess.Popen:
+    """
+    Start a server and wait until it answers
+
+    :param command: command line of the server
+    :param url: database the server reads
+    :param base_url: URL the server answers on
+    :return: server process
+    """
+    env = {**os.environ, "DATABASE_URI": url, "DB_SCHEMA": "skip"}
+    env.pop("ASYNC_DATABASE_URI", None)
+    # In a session of its own, so its workers are stopped with it
+    process = subprocess.Popen(
+        command,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"{' '.join(command)} exited with {process.returncode}")
+        try:
+            if httpx.get(f"{base_url}/metrics").status_code == 200:
+                return process
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    stop_server(process)
+    raise SystemExit(f"{' '.join(command)} did not start in {START_TIMEOUT} s")
+
+
+def stop_server(process: subprocess.Popen) -> None:
+    """
+    Stop a server the way a container runtime does, SIGTERM then SIGKILL after a timeout, and
+    kill the workers a supervisor left behind
+    """
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(STOP_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def drive_client(
+    url: str, base_url: str, requests: int, concurrency: int, seed: int
+) -> dict:
+    """
+    Load the server from one client process
+
+    :return: metrics of the run of the client, see benchmarks.load.run
+    """
+    return asyncio.run(load.run(url, requests, concurrency, seed, base_url=base_url))
+
+
+def measure(
+    url: str, base_url: str, requests: int, concurrency: int, clients: int, seed: int
+) -> dict:
+    """
+    Load the server from concurrent client processes, each sending its share of the requests
+    with its share of the concurrency
+
+    :return: requests per second of all clients, their median p50, worst p95 and p99, and errors
+    """
+    with ProcessPoolExecutor(clients) as pool:
+        runs = [
+            run["total"]
+            for run in pool.map(
+                drive_client,
+                [url] * clients,
+                [base_url] * clients,
+                [requests // clients] * clients,
+                [max(concurrency // clients, 1)] * clients,
+                [seed + client for client in range(clients)],
+            )
+        ]
+    return {
+        "requests_per_second": round(
+            sum(run["requests_per_second"] for run in runs), 1
+        ),
+        "p50_ms": statistics.median(run["p50_ms"] for run in runs),
+        "p95_ms": max(run["p95_ms"] for run in runs),
+        "p99_ms": max(run["p99_ms"] for run in runs),
+        "errors": sum(run["errors"] for run in runs),
+    }
+
+
+def run(
+    url: str,
+    requests: int,
+    concurrency: int,
+    workers: int,
+    clients: int,
+    seed: int = 0,
+    only: tuple[str, ...] = (),
+) -> dict:
+    """
+    :param url: database loaded by benchmarks.data
+    :param requests: number of requests sent to every setup
+    :param concurrency: number of concurrent requests
+    :param workers: number of workers of the production server
+    :param clients: number of client processes
+    :param seed: seed of the request mix and parameters
+    :param only: Optional names of the setups to run
+    :return: throughput and latency percentiles by setup
+    """
+    results = {}
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    for name, command in server_commands(port, workers).items():
+        if only and name not in only:
+            continue
+        process = start_server(command, url, base_url)
+        try:
+            # Warm up the workers: connection pools, statement caches, the search index
+            measure(url, base_url, requests // 10, concurrency, clients, seed)
+            results[name] = measure(url, base_url, requests, concurrency, clients, seed)
+        finally:
+            stop_server(process)
+    return results
+
+
+def main() -> None:
+    workers = default_workers(Settings.from_env())
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--url", required=True, help="database loaded by benchmarks.data"
+    )
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=workers)
+    parser.add_argument(
+        "--clients",
+        type=int,
+        default=workers,
+        help="client processes, so the client is not the bottleneck",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--setup", action="append", default=[], help="setup to run")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    args = parser.parse_args()
+
+    results = run(
+        args.url,
+        args.requests,
+        args.concurrency,
+        args.workers,
+        args.clients,
+        args.seed,
+        tuple(args.setup),
+    )
+    for name, metrics in results.items():
+        print(
+            f"{name:>14}: {metrics['requests_per_second']:9,.1f} requests/s  "
+            f"p50 {metrics['p50_ms']:8.2f} ms  p99 {metrics['p99_ms']:8.2f} ms  "
+            f"{metrics['errors']} errors"
+        )
+    params = {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "workers": args.workers,
+        "clients": args.clients,
+        "seed": args.seed,
+    }
+    path = save_results(
+        "server", args.url, params, results, args.output and Path(args.output)
+    )
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,3 @@
-from fastapi import FastAPI
+from app.factory import create_app
 
-from app.routes.movie import router as movie_router
-from app.routes.ratings import router as rating_router
-
-app = FastAPI()
-
-app.include_router(movie_router, prefix="/api/v1")
-app.include_router(rating_router, prefix="/api/v1")
+app = create_app()
@@ -5,19 +5,41 @@ from typing import Any, Generator
 import pytest
 from fastapi import FastAPI
 from fastapi.testclient import TestClient
-from sqlalchemy import StaticPool, create_engine
+from sqlalchemy import NullPool, StaticPool, create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
-from app.database import get_db_session
-from app.models.movie import Base, Movie
+from app.database import (
+    get_db_session,
+    get_db_sessionmaker,
+    get_engines,
+    get_replica_router,
+    to_async_url,
+)
+from app.instrumentation import MetricsMiddleware, instrument_engine
+from app.methods.cache import MemoryCacheBackend
+from app.models.movie import Base, Movie, MovieRatingAggregate, Rating, User
+from app.replicas import ReplicaRouter
+from app.routes.cache import router as cache_router
+from app.routes.metrics import exposition_router
+from app.routes.metrics import router as metrics_router
 from app.routes.movie import router as movie_router
 from app.routes.ratings import router as rating_router
+from app.settings import Settings
 
 
 def start_application():
     app = FastAPI()
     app.include_router(movie_router)
     app.include_router(rating_router)
+    app.include_router(cache_router)
+    app.include_router(metrics_router)
+    app.include_router(exposition_router)
+    app.add_middleware(MetricsMiddleware)
+    app.state.settings = Settings(database_url=TEST_DATABASE_URL)
+    # Switched off, so tests always see the database and mocked Crud methods. Tests of the cache
+    # switch it back on.
+    app.state.query_cache = MemoryCacheBackend(enabled=False)
     return app
 
 
@@ -34,6 +56,17 @@ TestingSessionLocal = sessionmaker(
     expire_on_commit=False, autocommit=False, autoflush=False, bind=engine
 )
 
+# Async engine used by the routes, pointing at the same test database (asyncpg / aiosqlite).
+# Every TestClient runs its own event loop, so connections must not be pooled between tests.
+async_engine = create_async_engine(to_async_url(TEST_DATABASE_URL), poolclass=NullPool)
+
+TestingAsyncSessionLocal = async_sessionmaker(
+    bind=async_engine, autoflush=False, expire_on_commit=False
+)
+
+instrument_engine("sync", engine)
+instrument_engine("async", async_engine)
+
 
 @pytest.fixture()
 def app() -> Generator[FastAPI, Any, None]:
@@ -48,14 +81,13 @@ def app() -> Generator[FastAPI, Any, None]:
 
 @pytest.fixture()
 def db_session():
-    """Create a new database session with a rollback at the end of the test."""
-    connection = engine.connect()
-    transaction = connection.begin()
-    session = TestingSessionLocal(bind=connection)
+    """
+    Create a new database session used to seed the test database. Data is committed so the async
+    sessions used by the routes can see it, the `app` fixture drops the tables at the end of the test.
+    """
+    session = TestingSessionLocal()
     yield session
     session.close()
-    transaction.rollback()
-    connection.close()
 
 
 @pytest.fixture()
@@ -63,50 +95,69 @@ def client(
     app: FastAPI, db_session: TestingSessionLocal
 ) -> Generator[TestClient, Any, None]:
     """
-    Create a new FastAPI TestClient that uses the `db_session` fixture to override
-    the `get_db_session` dependency that is injected into routes.
+    Create a new FastAPI TestClient that overrides the `get_db_session` dependency that is
+    injected into routes with an async session bound to the test database.
     """
 
-    def _get_test_db():
-        try:
-            yield db_session
-        finally:
-            db_session.close()
+    async def _get_test_db():
+        async with TestingAsyncSessionLocal() as session:
+            yield session
 
     app.dependency_overrides[get_db_session] = _get_test_db
+    app.dependency_overrides[get_db_sessionmaker] = lambda: TestingAsyncSessionLocal
+    # Reads go to the test database too, tests of the replicas override the router again
+    replica_router = ReplicaRouter(TestingAsyncSessionLocal, [])
+    app.dependency_overrides[get_replica_router] = lambda: replica_router
+    app.dependency_overrides[get_engines] = lambda: {
+        "sync": engine,
+        "async": async_engine,
+    }
     with TestClient(app) as client:
         yield client
 
 
+def create_mock_rating(movie_id: int, user: User, title: str) -> Rating:
+    """
+    Create a rating for a new movie, together with the movie and its rating aggregate
+    """
+    rating = random.randint(1, 5)
+    return Rating(
+        user=user,
+        rating=rating,
+        movie=Movie(
+            id=movie_id,
+            title=title,
+            genre="Mock Movie Genre",
+            year=str(random.randint(2000, 2021)),
+            runtime=f"{random.randint(90, 180)} min",
+            aggregate=MovieRatingAggregate(
+                rating_sum=rating, rating_count=1, avr_rating=rating
+            ),
+        ),
+    )
+
+
 @pytest.fixture()
 def create_single_mock_movie():
-    mock_movie = Movie(
-        id=random.randint(1, 5),
-        user_id=random.randint(1, 5),
+    mock_movie = create_mock_rating(
+        movie_id=random.randint(1, 5),
+        user=User(id=random.randint(1, 5)),
         title="Mock Movie Title",
-        genre="Mock Movie Genre",
-        year=random.randint(2000, 2021),
-        runtime=f"{random.randint(90, 180)} min",
-        rating=random.randint(1, 5),
-        avr_rating=random.randint(1, 5),
     )
     return mock_movie
 
 
 @pytest.fixture()
 def create_mock_movie_list():
+    mock_users = {}
     mock_movie_list = []
     for i in range(5):
+        user_id = random.randint(1, 5)
         mock_movie_list.append(
-            Movie(
-                id=i,
-                user_id=random.randint(1, 5),
+            create_mock_rating(
+                movie_id=i,
+                user=mock_users.setdefault(user_id, User(id=user_id)),
                 title=f"Mock Movie Title {i}",
-                genre="Mock Movie Genre",
-                year=random.randint(2000, 2021),
-                runtime=f"{random.randint(90, 180)} min",
-                rating=random.randint(1, 5),
-                avr_rating=random.randint(1, 5),
             )
         )
     return mock_movie_list
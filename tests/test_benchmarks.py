@@ -0,0 +1,133 @@
+import asyncio
+import json
+import random
+
+import pytest
+from sqlalchemy import create_engine, func, select
+
+from app.models.movie import Rating
+from benchmarks import crud, data, load, plans
+from benchmarks.results import compare, percentiles, save_results
+from tests.conftest import TEST_DATABASE_URL
+
+
+class TestBenchmarks:
+    @pytest.fixture()
+    def bench_url(self, tmp_path):
+        url = f"sqlite:///{tmp_path / 'bench.db'}"
+        engine = create_engine(url)
+        summary = data.load(engine, data.DatasetSpec(users=50, movies=20, ratings=400))
+        engine.dispose()
+        assert summary["aggregates"] <= 20
+        return url
+
+    def test_dataset_is_reproducible(self):
+        spec = data.DatasetSpec(users=30, movies=10, ratings=100, seed=7)
+        first, second = (
+            list(data.rating_rows(spec, random.Random(spec.seed))) for _ in range(2)
+        )
+        assert first == second
+        pairs = [(row["user_id"], row["movie_id"]) for row in first]
+        assert len(pairs) == len(set(pairs))
+        assert all(1 <= row["rating"] <= 5 for row in first)
+
+    def test_crud_and_load(self, bench_url, tmp_path):
+        crud_results = crud.run(bench_url, repeat=3)
+        assert all(metrics["count"] == 3 for metrics in crud_results.values())
+        assert crud_results["get_top_movie_rankings"]["queries_per_call"] >= 1
+
+        load_results = asyncio.run(load.run(bench_url, requests=30, concurrency=2))
+        assert load_results["total"]["count"] == 30
+        assert load_results["total"]["errors"] == 0
+
+        path = save_results(
+            "load", bench_url, {"requests": 30}, load_results, tmp_path / "load.json"
+        )
+        document = json.loads(path.read_text())
+        assert document["results"] == load_results
+        assert "total" in compare(document, document)
+
+    def test_percentiles(self):
+        result = percentiles([i / 1000 for i in range(1, 101)])
+        assert (result["count"], result["p50_ms"], result["max_ms"]) == (100, 51, 100)
+
+    def test_query_plans(self, bench_url):
+        engine = create_engine(bench_url)
+        count_ratings = select(func.count()).select_from(Rating)
+        with engine.connect() as connection:
+            ratings = connection.scalar(count_ratings)
+
+        results = plans.run(bench_url)
+        assert {"get_movies_info", "get_leaderboard", "delete_movie_rating"} <= set(
+            results
+        )
+        assert all(result["statements"] for result in results.values())
+        assert not any(result["regressions"] for result in results.values())
+        # Writes are explained in transactions that are rolled back
+        with engine.connect() as connection:
+            assert connection.scalar(count_ratings) == ratings
+        engine.dispose()
+
+        # Searching by title scans the movies table
+        results = plans.run(
+            bench_url, seq_scan_rows=0, only=("get_movies_info_contains",)
+        )
+        assert "Seq Scan on movies reads 20 rows" in (
+            results["get_movies_info_contains"]["regressions"]
+        )
+
+    def test_postgres_plan_nodes(self):
+        plan = {
+            "Node Type": "Limit",
+            "Plan Rows": 5,
+            "Actual Rows": 5,
+            "Actual Loops": 1,
+            "Plans": [
+                {
+                    "Node Type": "Sort",
+                    "Plan Rows": 900,
+                    "Actual Rows": 5,
+                    "Actual Loops": 1,
+                    "Plans": [
+                        {
+                            "Node Type": "Seq Scan",
+                            "Relation Name": "ratings",
+                            "Plan Rows": 1000,
+                            "Actual Rows": 800,
+                            "Actual Loops": 2,
+                            "Rows Removed by Filter": 200,
+                            "Shared Hit Blocks": 7,
+                            "Shared Read Blocks": 3,
+                        }
+                    ],
+                }
+            ],
+        }
+        nodes = list(plans.postgres_nodes(plan))
+        assert [(node["node"], node["rows_read"]) for node in nodes] == [
+            ("Limit", 5),
+            ("Sort", 1600),
+            ("Seq Scan", 2000),
+        ]
+        assert nodes[2]["shared_hit_blocks"] == 7
+        assert [
+            plans.describe(violation)
+            for violation in plans.violations(nodes, 1000, 1000)
+        ] == ["Sort reads 1,600 rows", "Seq Scan on ratings reads 2,000 rows"]
+
+    @pytest.mark.skipif(
+        not TEST_DATABASE_URL.startswith("postgresql"), reason="needs Postgres"
+    )
+    def test_postgres_query_plans(self, app):
+        engine = create_engine(TEST_DATABASE_URL)
+        data.load(engine, data.DatasetSpec(users=50, movies=20, ratings=400))
+        engine.dispose()
+        results = plans.run(TEST_DATABASE_URL)
+        assert not any(result["regressions"] for result in results.values())
+        nodes = [
+            node
+            for plan in results["get_top_movie_rankings"]["statements"]
+            for node in plan["nodes"]
+        ]
+        assert all(node["actual_rows"] is not None for node in nodes)
+        assert any(node["shared_hit_blocks"] for node in nodes)
@@ -0,0 +1,122 @@
+import json
+from threading import Thread
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from app.methods.aggregates import check_rating_aggregates
+from app.methods.routes_class import Crud
+from app.models.movie import MovieRatingAggregate
+from app.schemas.base import RatingInSchema
+from app.schemas.responses import BulkRatingResponse
+from tests.conftest import TEST_DATABASE_URL
+
+
+class TestBulkRatings:
+    def test_bulk_update_movie_ratings(
+        self, db_session, client, create_mock_movie_list
+    ):
+        db_session.add_all(create_mock_movie_list)
+        db_session.commit()
+        existing = create_mock_movie_list[0]
+
+        response = client.post(
+            "/movies/user_rating/bulk",
+            json=[
+                {"user_id": 100, "movie_id": 1, "rating": 2},
+                {"user_id": 100, "movie_id": 1, "rating": 4},
+                {"user_id": 101, "movie_id": 1, "rating": 5},
+                {"user_id": existing.user_id, "movie_id": 0, "rating": 6},
+                {"user_id": existing.user_id, "movie_id": 0, "rating": "x"},
+                {"user_id": 100, "movie_id": 999, "rating": 3},
+                {"user_id": existing.user_id, "movie_id": 0, "rating": 1},
+            ],
+        )
+        assert response.status_code == 200
+        body = response.json()
+        assert [result["status"] for result in body["results"]] == [
+            "superseded",
+            "created",
+            "created",
+            "failed",
+            "failed",
+            "failed",
+            "unchanged" if existing.rating == 1 else "updated",
+        ]
+        assert body["results"][5]["detail"] == "No movie found in Database"
+        assert body["results"][3]["detail"].startswith("rating: ")
+        assert body["created"] == 2 and body["failed"] == 3
+        assert BulkRatingResponse.model_validate(body).model_dump() == body
+
+        db_session.expire_all()
+        aggregate = db_session.get(MovieRatingAggregate, 1)
+        assert aggregate.rating_count == 3
+        assert aggregate.rating_sum == create_mock_movie_list[1].rating + 4 + 5
+        assert check_rating_aggregates(db_session) == []
+
+    def test_bulk_update_movie_ratings_ndjson(
+        self, db_session, client, create_mock_movie_list
+    ):
+        db_session.add_all(create_mock_movie_list)
+        db_session.commit()
+
+        body = "\n".join(
+            json.dumps({"user_id": 100, "movie_id": movie_id, "rating": 3})
+            for movie_id in range(5)
+        )
+        response = client.post(
+            "/movies/user_rating/bulk",
+            content=body,
+            headers={"content-type": "application/x-ndjson"},
+        )
+        assert response.status_code == 200
+        assert response.json()["created"] == 5
+        assert check_rating_aggregates(db_session) == []
+
+    @pytest.mark.skipif(
+        not TEST_DATABASE_URL.startswith("postgresql"), reason="needs row locks"
+    )
+    def test_concurrent_bulk_creates_count_once(
+        self, app, db_session, create_mock_movie_list
+    ):
+        db_session.add_all(create_mock_movie_list)
+        db_session.commit()
+
+        engine = create_engine(TEST_DATABASE_URL)
+        results = []
+        try:
+            with Session(engine) as first, Session(engine) as second:
+                assert Crud(first)._upsert_rating_batch({(100, 1): 4}) == {
+                    (100, 1): "created"
+                }
+                thread = Thread(
+                    target=lambda: results.append(
+                        Crud(second).bulk_upsert_ratings(
+                            [RatingInSchema(user_id=100, movie_id=1, rating=2)]
+                        )
+                    ),
+                    daemon=True,
+                )
+                thread.start()
+                # The second insert waits for the first one to commit
+                thread.join(1)
+                assert thread.is_alive()
+                first.commit()
+                thread.join(10)
+        finally:
+            engine.dispose()
+
+        assert results == [{(100, 1): "updated"}]
+        db_session.expire_all()
+        aggregate = db_session.get(MovieRatingAggregate, 1)
+        assert aggregate.rating_count == 2
+        assert aggregate.rating_sum == create_mock_movie_list[1].rating + 2
+        assert check_rating_aggregates(db_session) == []
+
+    def test_bulk_update_movie_ratings_bad_body(self, client):
+        response = client.post("/movies/user_rating/bulk", json={"user_id": 1})
+        assert response.status_code == 400
+        assert response.json() == {
+            "detail": "Bad request: Body must be a JSON array or NDJSON"
+        }
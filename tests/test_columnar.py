@@ -0,0 +1,204 @@
+import asyncio
+import random
+
+import pytest
+
+from app.database import Database
+from app.methods.aggregates import rebuild_rating_aggregates
+from app.methods.routes_class import AsyncCrud, Crud
+from app.models.movie import Movie, Rating, User
+from app.schemas.base import RatingInSchema
+from app.settings import Settings
+from tests.conftest import TEST_DATABASE_URL
+
+np = pytest.importorskip("numpy")
+from app.methods.columnar import (  # noqa: E402
+    ColumnarEngine,
+    build_matrix,
+    load_matrix,
+    merge_matrix,
+)
+
+GENRES = ("Drama", "Comedy", "Action")
+
+
+class TestColumnarEngine:
+    @pytest.fixture()
+    def rated_movies(self, app, db_session):
+        rng = random.Random(7)
+        db_session.add_all(
+            Movie(
+                id=movie_id,
+                title=f"Movie {movie_id}",
+                genre=rng.choice(GENRES),
+                year=str(rng.randint(2000, 2003)),
+                runtime="100 min",
+            )
+            for movie_id in range(1, 31)
+        )
+        db_session.add_all(User(id=user_id) for user_id in range(1, 41))
+        db_session.add_all(
+            Rating(user_id=user_id, movie_id=movie_id, rating=rng.randint(1, 5))
+            for user_id in range(1, 41)
+            for movie_id in rng.sample(range(1, 31), rng.randint(1, 12))
+        )
+        db_session.flush()
+        rebuild_rating_aggregates(db_session)
+        db_session.commit()
+
+    @pytest.fixture()
+    def engine(self, db_session, rated_movies):
+        engine = ColumnarEngine()
+        engine.install(load_matrix(db_session, batch_size=50))
+        return engine
+
+    def assert_same_answers(self, db_session, engine):
+        crud = Crud(db_session)
+        for args in [
+            (5, 1, None, None),
+            (30, 1, None, None),
+            (5, 3, None, None),
+            (5, 1, "drama", None),
+            (3, 2, None, "2001"),
+            (5, 1, "Comedy", "2002"),
+            (5, 1, "Western", None),
+        ]:
+            # Postgres computes the stored averages in numeric, so they may differ in the last bit
+            rows = engine.top_movies(*args)
+            expected = crud.get_top_movie_rankings(*args)
+            assert [row[:-2] + row[-1:] for row in rows] == [
+                tuple(row[:-2] + row[-1:]) for row in expected
+            ]
+            assert [row.avr_rating for row in rows] == pytest.approx(
+                [row.avr_rating for row in expected]
+            )
+        for user_id in range(1, 43):
+            assert engine.user_top_ratings(user_id) == [
+                tuple(row) for row in crud.get_user_ratings_page(user_id, 5)
+            ]
+        for movie_id in range(1, 31):
+            assert engine.movie_average(movie_id) == pytest.approx(
+                crud.get_movie_average_rating(movie_id)
+            )
+
+    def test_answers_like_sql(self, db_session, engine):
+        assert engine.matrix.size == db_session.query(Rating).count()
+        self.assert_same_answers(db_session, engine)
+
+        crud = Crud(db_session, engine)
+        assert crud.get_top_five_movie_ratings(k=3) == engine.top_movies(3)
+        assert crud.get_movie_average_rating(1) == engine.movie_average(1)
+        assert crud.get_top_five_movie_ratings(user_id=1) == engine.user_top_ratings(1)
+
+        # The async Crud answers from the engine without touching its session
+        async_crud = AsyncCrud(None, columnar=engine)
+        assert asyncio.run(
+            async_crud.get_top_five_movie_ratings(k=3)
+        ) == engine.top_movies(3)
+        assert asyncio.run(
+            async_crud.get_top_five_movie_ratings(user_id=1)
+        ) == engine.user_top_ratings(1)
+
+    def test_writes_are_applied_and_merged(self, db_session, engine):
+        crud = Crud(db_session)
+        changes = [(1, 1, 5), (1, 2, 1), (41, 3, 4), (42, 4, 2)]
+        crud.bulk_upsert_ratings(
+            [
+                RatingInSchema(user_id=user_id, movie_id=movie_id, rating=rating)
+                for user_id, movie_id, rating in changes
+            ]
+        )
+        deleted = db_session.query(Rating).filter(Rating.user_id == 2).first()
+        assert crud.delete_movie_rating(deleted.movie_id, 2)
+
+        engine.apply(changes + [(2, deleted.movie_id, None)])
+        self.assert_same_answers(db_session, engine)
+
+        changed = {
+            (user_id, movie_id): rating
+            for user_id, ratings in engine.pending.items()
+            for movie_id, (rating, _) in ratings.items()
+        }
+        engine.install(merge_matrix(engine.matrix, changed), engine.last_sequence)
+        assert engine.pending_count == 0
+        self.assert_same_answers(db_session, engine)
+
+        reloaded = ColumnarEngine()
+        reloaded.install(load_matrix(db_session))
+        for name in ("user_ids", "user_indptr", "user_movies", "movie_users"):
+            assert np.array_equal(
+                getattr(engine.matrix, name), getattr(reloaded.matrix, name)
+            )
+
+    def test_writes_after_a_snapshot_are_kept(self, db_session, engine):
+        engine.apply([(1, 1, 5)])
+        since = engine.last_sequence
+        engine.apply([(1, 2, 4)])
+        # A matrix loaded between the two writes only includes the first one
+        engine.install(merge_matrix(engine.matrix, {(1, 1): 5}), since)
+        assert engine.pending == {1: {2: (4, since + 1)}}
+        assert engine.rating(1, 1) == 5 and engine.rating(1, 2) == 4
+
+    def test_bytes_per_rating(self):
+        rng = np.random.default_rng(0)
+        users, movies, per_user = 20_000, 2_000, 25
+        user_ids = np.repeat(np.arange(1, users + 1), per_user)
+        movie_ids = np.concatenate(
+            [rng.choice(movies, per_user, replace=False) + 1 for _ in range(users)]
+        )
+        catalog = [
+            (movie_id, f"Movie {movie_id}", "Drama", "2000", "90 min")
+            for movie_id in range(1, movies + 1)
+        ]
+        engine = ColumnarEngine()
+        engine.install(
+            build_matrix(
+                user_ids, movie_ids, rng.integers(1, 6, len(user_ids)), catalog
+            )
+        )
+        assert engine.matrix.size == users * per_user
+        assert engine.bytes_per_rating < 12
+
+    def test_routes_use_the_engine(self, app, client, db_session, engine):
+        app.state.columnar = engine
+        response = client.get("/movies/top_five/total_user?k=3")
+        assert response.status_code == 200
+        assert [movie["id"] for movie in response.json()["data"]] == [
+            row.id for row in engine.top_movies(3)
+        ]
+
+        best = engine.user_top_ratings(1)[0]
+        low = 1 if best.rating > 1 else 2
+        assert client.put(f"/movies/user_rating/1/{best.id}/{low}").status_code == 200
+        assert engine.rating(1, best.id) == low
+        response = client.get("/movies/top_five/1")
+        assert response.json()["data"] == [
+            row._asdict() | {"year": int(row.year)}
+            for row in engine.user_top_ratings(1)
+        ]
+
+    def test_loads_in_the_background(self, rated_movies):
+        async def load_in_background():
+            database = Database(Settings(database_url=TEST_DATABASE_URL, schema="skip"))
+            engine = ColumnarEngine(merge_threshold=1)
+            engine.start(database)
+            try:
+                for _ in range(200):
+                    if engine.ready:
+                        break
+                    await asyncio.sleep(0.01)
+                assert engine.ready
+                # Reaching the threshold merges the write into a new matrix
+                matrix = engine.matrix
+                engine.apply([(1, 1, 5)])
+                for _ in range(200):
+                    if engine.matrix is not matrix:
+                        break
+                    await asyncio.sleep(0.01)
+                assert engine.pending_count == 0
+                assert engine.rating(1, 1) == 5
+            finally:
+                await engine.stop()
+                await database.dispose()
+
+        asyncio.run(load_in_background())
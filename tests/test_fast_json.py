@@ -0,0 +1,50 @@
+from decimal import Decimal
+
+import orjson
+from fastapi import Response
+
+from app.methods.fast_json import json_response, rows_to_dicts
+from app.methods.routes_class import Crud, select_movie_ratings
+from app.schemas.base import MovieFieldsSchema, MovieSchema
+from app.schemas.responses import MovieResponse
+
+
+class TestFastJson:
+    def test_rows_match_the_response_schema(
+        self, app, db_session, create_mock_movie_list
+    ):
+        db_session.add_all(create_mock_movie_list)
+        db_session.commit()
+        rows = db_session.execute(select_movie_ratings()).all()
+
+        expected = MovieResponse(
+            message="Movie data retrieved from database",
+            data=Crud.create_movie_schema_list(rows, schema=MovieFieldsSchema),
+        ).model_dump(mode="json", exclude_unset=True)
+        response = json_response(
+            {
+                "message": "Movie data retrieved from database",
+                "data": rows_to_dicts(rows, MovieSchema),
+            }
+        )
+        assert orjson.loads(response.body) == expected
+        assert all(isinstance(movie["year"], int) for movie in expected["data"])
+
+    def test_fields_keep_the_schema_order(
+        self, app, db_session, create_single_mock_movie
+    ):
+        db_session.add(create_single_mock_movie)
+        db_session.commit()
+        rows = db_session.execute(select_movie_ratings(["title", "id"])).all()
+
+        assert [
+            list(movie) for movie in rows_to_dicts(rows, MovieSchema, ["title", "id"])
+        ] == [["id", "title"]]
+
+    def test_json_response_keeps_headers(self):
+        headers = Response(headers={"ETag": 'W/"1"'}).headers
+        response = json_response({"value": Decimal("1.5")}, Response(headers=headers))
+        assert response.body == b'{"value":1.5}'
+        assert response.headers["etag"] == 'W/"1"'
+        assert response.headers["content-type"] == "application/json"
+        assert response.headers["content-length"] == str(len(response.body))
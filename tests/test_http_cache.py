@@ -0,0 +1,172 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from unittest.mock import patch
+
+import pytest
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+
+from app.database import Database
+from app.methods.cache import MemoryCacheBackend
+from app.methods.http_cache import conditional_get
+from app.methods.leaderboard import LeaderboardRefresher
+from app.settings import Settings
+from tests.conftest import TEST_DATABASE_URL
+
+
+class TestConditionalRequests:
+    @pytest.fixture(autouse=True)
+    def shared_query_cache(self, app):
+        """
+        Let the in-memory query cache stand in for a shared one, validators are only sent when
+        every worker sees the same data version
+        """
+        app.state.query_cache.shared = True
+
+    def test_per_process_cache_sends_no_validators(
+        self, db_session, app, client, create_mock_movie_list
+    ):
+        app.state.query_cache.shared = False
+        db_session.add_all(create_mock_movie_list)
+        db_session.commit()
+
+        response = client.get("/movies", headers={"If-None-Match": "*"})
+        assert response.status_code == 200
+        assert "etag" not in response.headers
+        assert "last-modified" not in response.headers
+
+    def test_read_endpoints_send_validators(
+        self, db_session, client, create_mock_movie_list
+    ):
+        db_session.add_all(create_mock_movie_list)
+        db_session.commit()
+        user_id = create_mock_movie_list[0].user_id
+
+        for url in [
+            "/movies",
+            "/movies/top_five/total_user",
+            f"/movies/top_five/{user_id}",
+            f"/users/{user_id}/ratings",
+        ]:
+            response = client.get(url)
+            assert response.status_code == 200
+            assert response.headers["etag"].startswith('W/"')
+            assert response.headers["cache-control"] == "no-cache"
+            assert "last-modified" in response.headers
+
+    def test_matching_etag_returns_304_without_querying(
+        self, db_session, client, create_mock_movie_list
+    ):
+        db_session.add_all(create_mock_movie_list)
+        db_session.commit()
+        etag = client.get("/movies/top_five/total_user").headers["etag"]
+
+        with patch(
+            "app.methods.routes_class.Crud.get_top_five_movie_ratings"
+        ) as mock_get_top_five_movie_ratings:
+            response = client.get(
+                "/movies/top_five/total_user",
+                headers={"If-None-Match": f'"other", {etag}'},
+            )
+        assert response.status_code == 304
+        assert response.content == b""
+        assert response.headers["etag"] == etag
+        mock_get_top_five_movie_ratings.assert_not_called()
+
+    def test_rating_update_changes_the_etag(
+        self, db_session, client, create_mock_movie_list
+    ):
+        db_session.add_all(create_mock_movie_list)
+        db_session.commit()
+        rating = create_mock_movie_list[0]
+        etag = client.get("/movies/top_five/total_user").headers["etag"]
+
+        response = client.put(
+            f"/movies/user_rating/{rating.user_id}/{rating.movie_id}/{rating.rating % 5 + 1}"
+        )
+        assert response.status_code == 200
+
+        response = client.get(
+            "/movies/top_five/total_user", headers={"If-None-Match": etag}
+        )
+        assert response.status_code == 200
+        assert response.headers["etag"] != etag
+
+    def test_unchanged_leaderboard_refresh_keeps_the_etags(
+        self, db_session, app, client, create_mock_movie_list
+    ):
+        db_session.add_all(create_mock_movie_list)
+        db_session.commit()
+        refresher = LeaderboardRefresher(cache=app.state.query_cache)
+
+        async def refresh():
+            database = Database(Settings(database_url=TEST_DATABASE_URL, schema="skip"))
+            try:
+                return await refresher.refresh(database, full=True)
+            finally:
+                await database.dispose()
+
+        urls = ["/movies", "/movies/top_five/total_user"]
+        before = [client.get(url).headers["etag"] for url in urls]
+        assert asyncio.run(refresh())
+        after = [client.get(url).headers["etag"] for url in urls]
+        # A refresh changing the rankings only changes the version of the rankings
+        assert after[0] == before[0]
+        assert after[1] != before[1]
+
+        assert not asyncio.run(refresh())
+        for url, etag in zip(urls, after):
+            response = client.get(url, headers={"If-None-Match": etag})
+            assert response.status_code == 304
+
+    def test_if_modified_since(self, db_session, client, create_mock_movie_list):
+        db_session.add_all(create_mock_movie_list)
+        db_session.commit()
+        last_modified = client.get("/movies").headers["last-modified"]
+        earlier = format_datetime(
+            datetime.now(timezone.utc) - timedelta(days=1), usegmt=True
+        )
+        later = format_datetime(
+            datetime.now(timezone.utc) + timedelta(days=1), usegmt=True
+        )
+
+        assert (
+            client.get("/movies", headers={"If-Modified-Since": later}).status_code
+            == 304
+        )
+        assert (
+            client.get("/movies", headers={"If-Modified-Since": earlier}).status_code
+            == 200
+        )
+        assert (
+            client.get(
+                "/movies", headers={"If-Modified-Since": "not a date"}
+            ).status_code
+            == 200
+        )
+        # If-None-Match takes precedence over If-Modified-Since
+        response = client.get(
+            "/movies",
+            headers={"If-Modified-Since": last_modified, "If-None-Match": '"other"'},
+        )
+        assert response.status_code == 200
+
+    def test_cache_control_is_configurable_per_route(self, monkeypatch):
+        monkeypatch.setenv("CACHE_CONTROL_SLOW", "public, max-age=60")
+        app = FastAPI()
+        app.state.settings = Settings.from_env(env_file=None)
+        app.state.query_cache = MemoryCacheBackend()
+        app.state.query_cache.shared = True
+
+        @app.get("/slow", dependencies=[Depends(conditional_get("slow"))])
+        async def slow():
+            return {}
+
+        @app.get("/fast", dependencies=[Depends(conditional_get("fast", "private"))])
+        async def fast():
+            return {}
+
+        with TestClient(app) as client:
+            assert client.get("/slow").headers["cache-control"] == "public, max-age=60"
+            assert client.get("/fast").headers["cache-control"] == "private"
@@ -0,0 +1,94 @@
+import logging
+
+import pytest
+
+from app.instrumentation import HISTOGRAMS, Histogram, MetricsMiddleware
+
+
+@pytest.fixture(autouse=True)
+def clear_histograms():
+    for histogram in HISTOGRAMS:
+        histogram.clear()
+
+
+def metric(body: str, name: str) -> float:
+    """
+    :return: value of the sample named `name` (with its labels) in a Prometheus text body
+    """
+    for line in body.splitlines():
+        if line.startswith(f"{name} "):
+            return float(line.rsplit(" ", 1)[1])
+    raise AssertionError(f"{name} not found in:\n{body}")
+
+
+class TestInstrumentation:
+    def test_histogram_render(self):
+        histogram = Histogram("latency", "Latency", ("route",), (0.1, 1))
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value, "/movies")
+        assert histogram.render() == [
+            "# HELP latency Latency",
+            "# TYPE latency histogram",
+            'latency_bucket{route="/movies",le="0.1"} 1',
+            'latency_bucket{route="/movies",le="1"} 2',
+            'latency_bucket{route="/movies",le="+Inf"} 3',
+            'latency_sum{route="/movies"} 5.55',
+            'latency_count{route="/movies"} 3',
+        ]
+
+    def test_requests_are_recorded_by_route(
+        self, db_session, client, create_mock_movie_list
+    ):
+        db_session.add_all(create_mock_movie_list)
+        db_session.commit()
+        assert client.get("/movies").status_code == 200
+        assert client.get("/movies/top_five/9999").status_code == 404
+        assert client.get("/no/such/route").status_code == 404
+
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        body = response.text
+        movies = 'method="GET",route="/movies"'
+        assert (
+            metric(
+                body, f'http_request_duration_seconds_count{{{movies},status="200"}}'
+            )
+            == 1
+        )
+        assert metric(body, f"http_request_db_queries_sum{{{movies}}}") == 1
+        assert metric(body, f"http_request_db_seconds_sum{{{movies}}}") > 0
+        assert metric(body, f"http_request_serialization_seconds_sum{{{movies}}}") > 0
+        assert (
+            metric(
+                body,
+                'http_request_duration_seconds_count{method="GET",'
+                'route="/movies/top_five/{user_id}",status="404"}',
+            )
+            == 1
+        )
+        assert 'route="unmatched",status="404"' in body
+        assert metric(body, 'db_query_duration_seconds_count{engine="async"}') >= 2
+        assert 'db_pool_info{engine="async",pool_class="NullPool"} 1' in body
+
+    def test_slow_requests_are_logged_with_their_statements(
+        self, db_session, client, create_mock_movie_list, monkeypatch, caplog
+    ):
+        db_session.add_all(create_mock_movie_list)
+        db_session.commit()
+        middleware = client.app.middleware_stack
+        while not isinstance(middleware, MetricsMiddleware):
+            middleware = middleware.app
+        monkeypatch.setattr(middleware, "slow_request_seconds", 0)
+
+        with caplog.at_level(logging.WARNING, logger="app.instrumentation"):
+            response = client.put("/movies/user_rating/9999/1/3")
+        assert response.status_code == 404
+
+        [record] = caplog.records
+        message = record.getMessage()
+        assert message.startswith(
+            "Slow request PUT /movies/user_rating/9999/1/3 -> 404"
+        )
+        assert "UPDATE" in message
+        assert "1x" in message
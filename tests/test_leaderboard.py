@@ -0,0 +1,179 @@
+import asyncio
+
+import pytest
+from sqlalchemy import func, select
+
+from app.database import Database
+from app.methods.cache import LEADERBOARD_TAG, MemoryCacheBackend
+from app.methods.leaderboard import (
+    LEADERBOARD_AGE_HEADER,
+    LeaderboardRefresher,
+    read_leaderboard,
+    refresh_leaderboard,
+)
+from app.methods.routes_class import Crud
+from app.models.movie import MovieLeaderboard
+from app.settings import Settings
+from tests.conftest import TEST_DATABASE_URL
+
+
+class TestLeaderboard:
+    @pytest.fixture()
+    def rated_movies(self, app, db_session, create_mock_movie_list):
+        db_session.add_all(create_mock_movie_list)
+        db_session.commit()
+        return create_mock_movie_list
+
+    def ranking(self, rows):
+        return [(row.id, row.avr_rating, row.rating_count) for row in rows]
+
+    def test_serves_the_refreshed_ranking(self, client, db_session, rated_movies):
+        response = client.get("/movies/top_five/total_user?k=3")
+        assert response.status_code == 200
+        assert response.headers[LEADERBOARD_AGE_HEADER] == "0.0"
+        live = response.json()["data"]
+
+        refresh_leaderboard(db_session, clock=lambda: 1000.0)
+        rows = read_leaderboard(db_session, 3)
+        assert [row.refreshed_at for row in rows] == [1000.0] * 3
+        assert self.ranking(rows) == self.ranking(
+            Crud(db_session).get_top_movie_rankings(k=3)
+        )
+
+        response = client.get("/movies/top_five/total_user?k=3")
+        assert response.status_code == 200
+        assert float(response.headers[LEADERBOARD_AGE_HEADER]) > 0
+        assert response.json()["data"] == live
+
+    def test_scopes(self, db_session, rated_movies):
+        refresh_leaderboard(db_session)
+        movie = rated_movies[0].movie
+
+        by_year = read_leaderboard(db_session, 5, year=movie.year)
+        assert movie.id in [row.id for row in by_year]
+        assert len(read_leaderboard(db_session, 5, genre=movie.genre.upper())) == 5
+        # Combined filters and fewer votes than stored are ranked on request
+        assert read_leaderboard(db_session, 5, genre=movie.genre, year="1990") is None
+        assert read_leaderboard(db_session, 5, min_votes=0) is None
+        assert read_leaderboard(db_session, 5, year="1990") is None
+        # Every movie of the scope is stored, so a ranking holding less than k is complete
+        assert len(read_leaderboard(db_session, 10)) == 5
+
+    def test_incremental_refresh(self, db_session, rated_movies):
+        refresh_leaderboard(db_session, clock=lambda: 1000.0)
+        rating = rated_movies[-1]
+        old_rating, new_rating = rating.rating, 1 if rating.rating > 1 else 5
+        Crud(db_session).update_movie_rating(
+            rating.movie_id, rating.user_id, new_rating
+        )
+
+        stale = {row.id: row.avr_rating for row in read_leaderboard(db_session, 5)}
+        assert stale[rating.movie_id] == old_rating
+
+        refresh_leaderboard(db_session, [rating.movie_id], clock=lambda: 2000.0)
+        rows = read_leaderboard(db_session, 5)
+        assert {row.id: row.avr_rating for row in rows}[rating.movie_id] == new_rating
+        assert self.ranking(rows) == self.ranking(
+            Crud(db_session).get_top_movie_rankings(k=5)
+        )
+        # Scopes of other movies keep their refresh time
+        other_years = {row.movie.year for row in rated_movies} - {rating.movie.year}
+        for year in other_years:
+            assert read_leaderboard(db_session, 1, year=year)[0].refreshed_at == 1000.0
+
+    def test_refresh_reports_changes(self, db_session, rated_movies):
+        assert refresh_leaderboard(db_session, clock=lambda: 1000.0)
+        assert not refresh_leaderboard(db_session, clock=lambda: 2000.0)
+        # The unchanged rankings are marked as refreshed all the same
+        assert read_leaderboard(db_session, 1)[0].refreshed_at == 2000.0
+
+        rating = rated_movies[-1]
+        Crud(db_session).update_movie_rating(
+            rating.movie_id, rating.user_id, 1 if rating.rating > 1 else 5
+        )
+        assert refresh_leaderboard(db_session, [rating.movie_id])
+
+    def test_full_refresh_removes_stale_scopes(self, db_session, rated_movies):
+        refresh_leaderboard(db_session, clock=lambda: 1000.0)
+        for rating in rated_movies:
+            rating.movie.genre = "Renamed"
+        db_session.commit()
+
+        refresh_leaderboard(db_session, clock=lambda: 2000.0)
+        assert read_leaderboard(db_session, 1, genre="Mock Movie Genre") is None
+        assert len(read_leaderboard(db_session, 5, genre="Renamed")) == 5
+        assert db_session.scalar(
+            select(func.min(MovieLeaderboard.refreshed_at))
+        ) == pytest.approx(2000.0)
+
+    def test_refresher(self, db_session, rated_movies):
+        rating = rated_movies[-1]
+        old_rating, new_rating = rating.rating, 1 if rating.rating > 1 else 5
+
+        def stored_rating():
+            db_session.rollback()
+            rows = read_leaderboard(db_session, 5)
+            return rows and {row.id: row.avr_rating for row in rows}[rating.movie_id]
+
+        async def wait_for(value):
+            for _ in range(200):
+                if stored_rating() == value:
+                    return True
+                await asyncio.sleep(0.01)
+            return False
+
+        async def refresh_in_background():
+            database = Database(Settings(database_url=TEST_DATABASE_URL, schema="skip"))
+            refresher = LeaderboardRefresher(interval=3600, write_threshold=1)
+            refresher.start(database)
+            try:
+                # Full refresh on start
+                assert await wait_for(old_rating)
+                Crud(db_session).update_movie_rating(
+                    rating.movie_id, rating.user_id, new_rating
+                )
+                # The write threshold wakes the refresher up before the next interval
+                refresher.mark_changed([rating.movie_id])
+                assert await wait_for(new_rating)
+            finally:
+                await refresher.stop()
+                await database.dispose()
+            assert not refresher.running
+
+        asyncio.run(refresh_in_background())
+
+    def test_refresh_evicts_cached_rankings(self, rated_movies):
+        cache = MemoryCacheBackend(enabled=True)
+        refresher = LeaderboardRefresher(cache=cache)
+
+        async def refresh():
+            database = Database(Settings(database_url=TEST_DATABASE_URL, schema="skip"))
+            try:
+                await cache.set(
+                    ("rankings",), [], [LEADERBOARD_TAG], await cache.token()
+                )
+                before = await cache.data_version(LEADERBOARD_TAG)
+                assert await refresher.refresh(database, full=True)
+                after = await cache.data_version(LEADERBOARD_TAG)
+                evicted = await cache.get(("rankings",))
+                await cache.set(
+                    ("rankings",), [], [LEADERBOARD_TAG], await cache.token()
+                )
+                assert not await refresher.refresh(database, full=True)
+                return (
+                    before,
+                    after,
+                    evicted,
+                    await cache.data_version(LEADERBOARD_TAG),
+                    await cache.get(("rankings",)),
+                )
+            finally:
+                await database.dispose()
+
+        before, after, evicted, unchanged, cached = asyncio.run(refresh())
+        # Conditional requests of the rankings see the refresh as a change
+        assert after.tag != before.tag
+        assert evicted == (False, None)
+        # A refresh which stored the same rankings keeps the cached ones
+        assert unchanged.tag == after.tag
+        assert cached == (True, [])
@@ -1,7 +1,13 @@
+import csv
+import io
+import json
 from unittest.mock import patch
 
+import pytest
 from sqlalchemy.exc import OperationalError, ProgrammingError
 
+from app.schemas.base import MovieSchema
+
 
 class TestMovieRoutes:
     def test_get_movies_with_no_movies_in_database(self, client):
@@ -23,6 +29,55 @@ class TestMovieRoutes:
         assert response.json()["message"] == "Movie data retrieved from database"
         assert response.json()["data"][0]["title"] == "Mock Movie Title"
 
+    @pytest.mark.parametrize("params", [{}, {"title": "mock"}])
+    def test_get_movies_pages(self, db_session, client, create_mock_movie_list, params):
+        db_session.add_all(create_mock_movie_list)
+        db_session.commit()
+
+        pages, after = [], None
+        while True:
+            page_params = {**params, "limit": 2}
+            if after is not None:
+                page_params["after"] = after
+            response = client.get("/movies", params=page_params)
+            assert response.status_code == 200
+            pages.append([movie["id"] for movie in response.json()["data"]])
+            after = response.json()["next_cursor"]
+            if after is None:
+                break
+
+        assert [len(page) for page in pages] == [2, 2, 1]
+        assert sorted(sum(pages, [])) == [0, 1, 2, 3, 4]
+
+    def test_get_movies_with_fields(self, db_session, client, create_single_mock_movie):
+        db_session.add(create_single_mock_movie)
+        db_session.commit()
+
+        response = client.get("/movies", params={"fields": "title,rating"})
+        assert response.status_code == 200
+        assert response.json()["data"] == [
+            {
+                "title": "Mock Movie Title",
+                "rating": create_single_mock_movie.rating,
+            }
+        ]
+
+    @pytest.mark.parametrize(
+        "params, detail",
+        [
+            ({"fields": "title,secret"}, "Bad request: Unknown fields: secret"),
+            ({"after": "not-a-cursor"}, "Bad request: Invalid cursor"),
+        ],
+    )
+    def test_get_movies_with_bad_parameters(self, client, params, detail):
+        response = client.get("/movies", params=params)
+        assert response.status_code == 400
+        assert response.json() == {"detail": detail}
+
+    def test_get_movies_limit_is_capped(self, client):
+        response = client.get("/movies", params={"limit": 501})
+        assert response.status_code == 422
+
     @patch("app.methods.routes_class.Crud.get_movies_info")
     def test_get_movies_with_bad_request(self, mock_get_movies_info, client):
         mock_get_movies_info.side_effect = OperationalError(
@@ -44,3 +99,25 @@ class TestMovieRoutes:
         assert response.json() == {
             "detail": "Bad request: Movies table does not exist in Database"
         }
+
+    def test_export_movies_as_ndjson(self, db_session, client, create_mock_movie_list):
+        db_session.add_all(create_mock_movie_list)
+        db_session.commit()
+
+        response = client.get("/movies/export", params={"title": "title 3"})
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        assert [line["id"] for line in lines] == [3]
+        assert list(lines[0]) == list(MovieSchema.model_fields)
+        assert isinstance(lines[0]["year"], int)
+
+    def test_export_movies_as_csv(self, db_session, client, create_mock_movie_list):
+        db_session.add_all(create_mock_movie_list)
+        db_session.commit()
+
+        response = client.get("/movies/export", params={"format": "csv"})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/csv")
+        rows = list(csv.DictReader(io.StringIO(response.text)))
+        assert sorted(int(row["id"]) for row in rows) == [0, 1, 2, 3, 4]
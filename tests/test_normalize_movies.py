@@ -0,0 +1,92 @@
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine, select
+from sqlalchemy.orm import Session
+
+from app.commands.normalize_movies import backfill, migrate_schema
+from app.models.movie import Movie, MovieRatingAggregate, Rating, User
+
+LEGACY_ROWS = [
+    (1, 1, "Inception", 5),
+    (2, 2, "Inception", 3),
+    (3, 1, "Heat", 4),
+    (4, 3, "Heat", 2),
+    (5, 1, "Inception", 1),
+    (6, 2, "Alien", 4),
+]
+
+
+def create_legacy_movies_table(engine):
+    legacy = Table(
+        "movies",
+        MetaData(),
+        Column("id", Integer, primary_key=True, index=True),
+        Column("user_id", Integer, index=True),
+        Column("title", String, index=True),
+        Column("genre", String),
+        Column("rating", Integer),
+        Column("year", String),
+        Column("runtime", String),
+        Column("avr_rating", Integer),
+    )
+    legacy.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(
+            legacy.insert(),
+            [
+                {
+                    "id": movie_id,
+                    "user_id": user_id,
+                    "title": title,
+                    "genre": "Mock Movie Genre",
+                    "rating": rating,
+                    "year": "2010",
+                    "runtime": "120 min",
+                    "avr_rating": rating,
+                }
+                for movie_id, user_id, title, rating in LEGACY_ROWS
+            ],
+        )
+
+
+class TestNormalizeMovies:
+    def test_backfill_legacy_movies_table(self, tmp_path):
+        engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+        create_legacy_movies_table(engine)
+
+        assert migrate_schema(engine) is True
+        assert backfill(engine, batch_size=4) == len(LEGACY_ROWS)
+
+        with Session(engine) as db:
+            movies = dict(db.execute(select(Movie.title, Movie.id)).all())
+            assert movies == {"Inception": 1, "Heat": 3, "Alien": 6}
+            assert db.scalar(select(User.id).order_by(User.id.desc())) == 3
+            ratings = db.execute(
+                select(Rating.user_id, Rating.movie_id, Rating.rating)
+            ).all()
+            # User 1 rated Inception twice, the latest rating wins
+            assert sorted(ratings) == [
+                (1, 1, 1),
+                (1, 3, 4),
+                (2, 1, 3),
+                (2, 6, 4),
+                (3, 3, 2),
+            ]
+            aggregate = db.get(MovieRatingAggregate, 1)
+            assert (aggregate.rating_sum, aggregate.rating_count) == (4, 2)
+            assert aggregate.avr_rating == 2
+
+    def test_migrate_schema_without_legacy_table(self, tmp_path):
+        engine = create_engine(f"sqlite:///{tmp_path / 'empty.db'}")
+        assert migrate_schema(engine) is False
+        assert migrate_schema(engine) is False
+
+    def test_backfill_resumes_after_id(self, tmp_path):
+        engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+        create_legacy_movies_table(engine)
+        migrate_schema(engine)
+
+        assert backfill(engine, batch_size=2, after_id=4) == 2
+        with Session(engine) as db:
+            ratings = db.execute(
+                select(Rating.user_id, Rating.movie_id, Rating.rating)
+            ).all()
+            assert sorted(ratings) == [(1, 5, 1), (2, 6, 4)]
@@ -0,0 +1,88 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, exc, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app.database import get_db_session, get_replica_router, to_async_url
+from app.pool import (
+    TimedAsyncAdaptedQueuePool,
+    TimedQueuePool,
+    pool_options,
+    pool_stats,
+)
+from app.replicas import ReplicaRouter
+from app.settings import Settings
+from tests.conftest import TEST_DATABASE_URL
+
+
+class TestPool:
+    def test_pool_options(self, monkeypatch):
+        monkeypatch.setenv("DB_POOL_SIZE", "20")
+        monkeypatch.setenv("DB_POOL_PRE_PING", "true")
+        settings = Settings.from_env(env_file=None)
+
+        options = pool_options("postgresql://postgres@localhost/movies_db", settings)
+        assert options["poolclass"] is TimedQueuePool
+        assert options["pool_size"] == 20
+        assert options["pool_pre_ping"] is True
+        assert (
+            pool_options("postgresql+asyncpg://postgres@localhost/movies_db")[
+                "poolclass"
+            ]
+            is TimedAsyncAdaptedQueuePool
+        )
+        # In-memory SQLite keeps its single connection pool
+        assert "pool_size" not in pool_options("sqlite://")
+
+    def test_pool_metrics(self, tmp_path):
+        url = f"sqlite:///{tmp_path / 'pool.db'}"
+        options = {**pool_options(url), "pool_size": 1, "max_overflow": 0}
+        engine = create_engine(url, **{**options, "pool_timeout": 0.05})
+
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+            stats = pool_stats("sync", engine)
+            assert stats["checked_out"] == 1
+            with pytest.raises(exc.TimeoutError):
+                engine.connect()
+
+        stats = pool_stats("sync", engine)
+        assert stats["pool_class"] == "TimedQueuePool"
+        assert stats["checked_out"] == 0
+        assert stats["checkouts"] == 1
+        assert stats["timeouts"] == 1
+        assert stats["wait_seconds_max"] < 0.05
+        engine.dispose()
+
+    def test_pool_metrics_route(self, client):
+        response = client.get("/metrics/pool")
+        assert response.status_code == 200
+        assert [stats["engine"] for stats in response.json()["data"]] == [
+            "sync",
+            "async",
+        ]
+
+    def test_rejected_request_does_not_check_out_a_connection(self, app):
+        url = to_async_url(TEST_DATABASE_URL)
+        async_engine = create_async_engine(url, **pool_options(url))
+        sessionmaker = async_sessionmaker(bind=async_engine)
+
+        async def get_test_db():
+            async with sessionmaker() as session:
+                yield session
+
+        app.dependency_overrides[get_db_session] = get_test_db
+        app.dependency_overrides[get_replica_router] = lambda: ReplicaRouter(
+            sessionmaker, []
+        )
+        with TestClient(app) as client:
+            if not isinstance(async_engine.pool, TimedAsyncAdaptedQueuePool):
+                pytest.skip("database does not use a queue pool")
+            response = client.put("/movies/user_rating/1/1/9")
+            assert response.status_code == 400
+            assert pool_stats("async", async_engine)["checkouts"] == 0
+
+            response = client.get("/movies/top_five/1")
+            assert response.status_code == 404
+            assert pool_stats("async", async_engine)["checkouts"] == 1
+            client.portal.call(async_engine.dispose)
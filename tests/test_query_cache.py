@@ -0,0 +1,202 @@
+import asyncio
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from app.methods.cache import MemoryCacheBackend, QueryCache, movie_tag, user_tag
+from app.models.movie import User
+from tests.conftest import create_mock_rating
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestQueryCache:
+    def test_hit_and_miss(self):
+        cache = QueryCache(max_size=10, ttl=60)
+        assert cache.get("key") == (False, None)
+        assert cache.set("key", [1], [movie_tag(1)], cache.token()) is True
+        assert cache.get("key") == (True, [1])
+        assert cache.get_stats() == {
+            "hits": 1,
+            "misses": 1,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
+            "size": 1,
+        }
+
+    def test_evicts_least_recently_used(self):
+        cache = QueryCache(max_size=2, ttl=60)
+        for key in ("a", "b"):
+            cache.set(key, key, [], cache.token())
+        cache.get("a")
+        cache.set("c", "c", [], cache.token())
+
+        assert cache.get("b") == (False, None)
+        assert cache.get("a") == (True, "a")
+        assert cache.get("c") == (True, "c")
+        assert cache.get_stats()["evictions"] == 1
+
+    def test_expires_entries(self):
+        clock = FakeClock()
+        cache = QueryCache(max_size=10, ttl=5, clock=clock)
+        cache.set("key", "value", [], cache.token())
+        clock.now = 4.9
+        assert cache.get("key") == (True, "value")
+        clock.now = 5
+        assert cache.get("key") == (False, None)
+        assert cache.get_stats()["expirations"] == 1
+
+    def test_invalidates_tagged_entries_only(self):
+        cache = QueryCache(max_size=10, ttl=60)
+        cache.set("movie 1", 1, [movie_tag(1)], cache.token())
+        cache.set("movie 2", 2, [movie_tag(2)], cache.token())
+        cache.set("user 1", 3, [user_tag(1), movie_tag(2)], cache.token())
+
+        assert cache.invalidate(movie_tag(2)) == 2
+        assert cache.get("movie 1") == (True, 1)
+        assert cache.get("movie 2") == (False, None)
+        assert cache.get("user 1") == (False, None)
+        assert cache.keys_by_tag == {movie_tag(1): {"movie 1"}}
+
+    def test_refuses_results_read_before_an_invalidation(self):
+        cache = QueryCache(max_size=10, ttl=60)
+        token = cache.token()
+        cache.invalidate(movie_tag(1))
+
+        assert cache.set("movie 1", "stale", [movie_tag(1)], token) is False
+        assert cache.set("movie 2", "fresh", [movie_tag(2)], token) is True
+        assert cache.set("movie 1", "fresh", [movie_tag(1)], cache.token()) is True
+
+
+class TestSingleFlight:
+    def test_concurrent_misses_load_once(self):
+        cache = MemoryCacheBackend(max_size=10, ttl=60, enabled=True)
+        loads = []
+
+        async def load():
+            loads.append(1)
+            await asyncio.sleep(0.05)
+            return ("rows",)
+
+        async def get_concurrently():
+            return await asyncio.gather(
+                *(cache.get_or_load("key", load, lambda rows: []) for _ in range(10))
+            )
+
+        assert asyncio.run(get_concurrently()) == [("rows",)] * 10
+        assert len(loads) == 1
+        assert cache.cache.get("key") == (True, ("rows",))
+
+    def test_failed_load_is_shared_and_not_cached(self):
+        cache = MemoryCacheBackend(max_size=10, ttl=60, enabled=True)
+
+        async def load():
+            await asyncio.sleep(0.01)
+            raise OperationalError("SELECT", {}, Exception("connection lost"))
+
+        async def get_concurrently():
+            return await asyncio.gather(
+                *(cache.get_or_load("key", load, lambda rows: []) for _ in range(3)),
+                return_exceptions=True,
+            )
+
+        results = asyncio.run(get_concurrently())
+        assert all(isinstance(result, OperationalError) for result in results)
+        assert cache.flights == {}
+        assert cache.cache.get("key") == (False, None)
+
+
+class TestCachedRoutes:
+    @pytest.fixture()
+    def cache(self, app):
+        app.state.query_cache.enabled = True
+        return app.state.query_cache
+
+    @pytest.fixture()
+    def ratings(self, db_session, client):
+        users = [User(id=1), User(id=2)]
+        ratings = [
+            create_mock_rating(movie_id, users[movie_id % 2], f"Title {movie_id}")
+            for movie_id in range(4)
+        ]
+        db_session.add_all(ratings)
+        db_session.commit()
+        return ratings
+
+    def get_stats(self, client) -> dict:
+        return client.get("/cache/stats").json()["data"]
+
+    def test_repeated_queries_are_served_from_the_cache(self, cache, client, ratings):
+        for _ in range(3):
+            assert client.get("/movies", params={"genre": "MOCK"}).status_code == 200
+            assert client.get("/movies/top_five/total_user").status_code == 200
+            assert client.get("/movies/top_five/1").status_code == 200
+
+        stats = client.get("/cache/stats").json()
+        assert stats["enabled"] is True
+        assert stats["data"]["misses"] == 3
+        assert stats["data"]["hits"] == 6
+
+    def test_rating_update_evicts_its_movie_user_and_leaderboard(
+        self, cache, client, ratings
+    ):
+        client.get("/movies", params={"limit": 1})
+        client.get("/movies", params={"limit": 1, "after": "MSwy"})
+        client.get("/movies/top_five/total_user")
+        client.get("/movies/top_five/1")
+        client.get("/movies/top_five/2")
+        assert self.get_stats(client)["size"] == 5
+
+        response = client.put("/movies/user_rating/1/0/5")
+        assert response.status_code == 200
+        # The second page and the ratings of user 2 (movies 2 and 3, 1 and 3) stay cached
+        assert self.get_stats(client)["size"] == 2
+        assert self.get_stats(client)["invalidations"] == 3
+
+        response = client.get("/movies/top_five/1")
+        assert (
+            response.json()["data"][0] | {"id": 0, "rating": 5}
+            == response.json()["data"][0]
+        )
+
+    def test_new_ratings_evict_movie_listings(self, cache, client, ratings):
+        client.get("/movies", params={"limit": 1})
+
+        rating = ratings[2].rating % 5 + 1
+        response = client.post(
+            "/movies/user_rating/bulk",
+            json=[{"user_id": 1, "movie_id": 2, "rating": rating}],
+        )
+        assert response.json()["updated"] == 1
+        assert self.get_stats(client)["size"] == 1
+
+        response = client.post(
+            "/movies/user_rating/bulk",
+            json=[{"user_id": 2, "movie_id": 2, "rating": 5}],
+        )
+        assert response.json()["created"] == 1
+        assert self.get_stats(client)["size"] == 0
+
+    def test_disabled_cache_is_bypassed(self, client, ratings):
+        client.get("/movies")
+        client.get("/movies")
+        assert client.get("/cache/stats").json() == {
+            "message": "Query cache statistics",
+            "backend": "memory",
+            "enabled": False,
+            "data": {
+                "hits": 0,
+                "misses": 0,
+                "evictions": 0,
+                "expirations": 0,
+                "invalidations": 0,
+                "size": 0,
+            },
+        }
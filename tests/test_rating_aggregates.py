@@ -0,0 +1,146 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from sqlalchemy import create_engine, update
+from sqlalchemy.orm import sessionmaker
+
+from app.methods.aggregates import (
+    apply_rating_delta,
+    check_rating_aggregates,
+    rebuild_rating_aggregates,
+)
+from app.methods.routes_class import Crud
+from app.models.movie import Movie, MovieRatingAggregate, Rating, User
+from tests.conftest import TEST_DATABASE_URL, engine
+
+# Number of sessions updating ratings at the same time
+THREADS = 8
+
+
+class TestRatingAggregates:
+    @pytest.fixture()
+    def rated_movie(self, app, db_session, create_single_mock_movie):
+        db_session.add(create_single_mock_movie)
+        db_session.commit()
+        return create_single_mock_movie
+
+    def get_aggregate(self, db_session, movie_id):
+        db_session.expire_all()
+        aggregate = db_session.get(MovieRatingAggregate, movie_id)
+        return aggregate.rating_sum, aggregate.rating_count, aggregate.avr_rating
+
+    def test_insert_overwrite_and_delete(self, db_session, rated_movie):
+        movie_id, rating = rated_movie.movie_id, rated_movie.rating
+        user_id = rated_movie.user_id + 10
+
+        db_session.add(User(id=user_id))
+        db_session.add(Rating(user_id=user_id, movie_id=movie_id, rating=2))
+        apply_rating_delta(db_session, movie_id, None, 2)
+        db_session.commit()
+        assert self.get_aggregate(db_session, movie_id) == (
+            rating + 2,
+            2,
+            (rating + 2) / 2,
+        )
+
+        Crud(db_session).update_movie_rating(movie_id, user_id, 5)
+        assert self.get_aggregate(db_session, movie_id) == (
+            rating + 5,
+            2,
+            (rating + 5) / 2,
+        )
+
+        assert Crud(db_session).delete_movie_rating(movie_id, user_id) is True
+        assert self.get_aggregate(db_session, movie_id) == (rating, 1, rating)
+        assert check_rating_aggregates(db_session) == []
+
+    def test_update_returns_the_movie_of_the_rating(
+        self, app, db_session, create_mock_movie_list
+    ):
+        for mock_rating in create_mock_movie_list:
+            mock_rating.rating = 5
+            mock_rating.movie.aggregate.rating_sum = 5
+            mock_rating.movie.aggregate.avr_rating = 5
+        db_session.add_all(create_mock_movie_list)
+        db_session.commit()
+        last = create_mock_movie_list[-1]
+
+        updated = Crud(db_session).update_movie_rating(last.movie_id, last.user_id, 1)
+        assert updated.id == last.movie_id
+        assert updated.title == last.movie.title
+        assert updated.avr_rating == 1
+
+    def test_update_missing_rating(self, db_session, rated_movie):
+        crud = Crud(db_session)
+        assert crud.update_movie_rating(rated_movie.movie_id, 0, 3) is None
+        assert crud.delete_movie_rating(rated_movie.movie_id, 0) is False
+
+    def test_check_and_rebuild(self, db_session, rated_movie):
+        movie_id, rating = rated_movie.movie_id, rated_movie.rating
+        db_session.execute(
+            update(MovieRatingAggregate).values(rating_sum=100, rating_count=7)
+        )
+        db_session.commit()
+        assert check_rating_aggregates(db_session) == [(movie_id, 100, 7, rating, 1)]
+
+        rebuild_rating_aggregates(db_session)
+        db_session.commit()
+        assert check_rating_aggregates(db_session) == []
+        assert self.get_aggregate(db_session, movie_id) == (rating, 1, rating)
+
+
+class TestConcurrentRatingUpdates:
+    @pytest.fixture()
+    def threaded_sessionmaker(self, app):
+        # One connection per thread, unlike the StaticPool engine shared by the other tests
+        connect_args = {"timeout": 30} if engine.dialect.name == "sqlite" else {}
+        threaded_engine = create_engine(
+            TEST_DATABASE_URL, pool_size=THREADS, connect_args=connect_args
+        )
+        yield sessionmaker(bind=threaded_engine)
+        threaded_engine.dispose()
+
+    @pytest.fixture()
+    def rated_movie(self, app, db_session):
+        movie = Movie(id=1, title="Heat", genre="Crime", year="1995", runtime=170)
+        db_session.add(movie)
+        db_session.add_all(User(id=user_id) for user_id in range(THREADS))
+        db_session.add_all(
+            Rating(user_id=user_id, movie_id=movie.id, rating=1)
+            for user_id in range(THREADS)
+        )
+        db_session.add(
+            MovieRatingAggregate(
+                movie_id=movie.id,
+                rating_sum=THREADS,
+                rating_count=THREADS,
+                avr_rating=1,
+            )
+        )
+        db_session.commit()
+        return movie
+
+    def update_concurrently(self, threaded_sessionmaker, updates):
+        def update_rating(movie_id, user_id, rating):
+            with threaded_sessionmaker() as session:
+                return Crud(session).update_movie_rating(movie_id, user_id, rating)
+
+        with ThreadPoolExecutor(THREADS) as executor:
+            return list(executor.map(lambda args: update_rating(*args), updates))
+
+    def test_different_users(self, db_session, threaded_sessionmaker, rated_movie):
+        updates = [(rated_movie.id, user_id, 5) for user_id in range(THREADS)] * 3
+        results = self.update_concurrently(threaded_sessionmaker, updates)
+
+        assert all(result.rating == 5 for result in results)
+        assert check_rating_aggregates(db_session) == []
+        db_session.expire_all()
+        aggregate = db_session.get(MovieRatingAggregate, rated_movie.id)
+        assert (aggregate.rating_sum, aggregate.avr_rating) == (5 * THREADS, 5)
+
+    def test_same_user(self, db_session, threaded_sessionmaker, rated_movie):
+        updates = [(rated_movie.id, 0, rating) for rating in [2, 3, 4, 5] * THREADS]
+        results = self.update_concurrently(threaded_sessionmaker, updates)
+
+        assert all(result.id == rated_movie.id for result in results)
+        assert check_rating_aggregates(db_session) == []
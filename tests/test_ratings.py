@@ -3,6 +3,9 @@ from unittest.mock import patch
 import pytest
 from sqlalchemy.exc import OperationalError, ProgrammingError
 
+from app.models.movie import User
+from tests.conftest import create_mock_rating
+
 
 class TestRatingRoutes:
     def test_get_top_movies_all_users(self, db_session, client, create_mock_movie_list):
@@ -18,6 +21,46 @@ class TestRatingRoutes:
         )
         assert len(response.json()["data"]) == 5
 
+    def test_get_top_movies_all_users_ranks_distinct_movies(
+        self, db_session, client, create_mock_movie_list
+    ):
+        db_session.add_all(create_mock_movie_list)
+        db_session.commit()
+        expected = sorted(
+            create_mock_movie_list, key=lambda rating: (-rating.rating, rating.movie_id)
+        )[:3]
+
+        response = client.get("/movies/top_five/total_user", params={"k": 3})
+        assert response.status_code == 200
+        assert [movie["id"] for movie in response.json()["data"]] == [
+            rating.movie_id for rating in expected
+        ]
+        assert [movie["avr_rating"] for movie in response.json()["data"]] == [
+            rating.rating for rating in expected
+        ]
+
+    def test_get_top_movies_all_users_with_filters(
+        self, db_session, client, create_mock_movie_list
+    ):
+        db_session.add_all(create_mock_movie_list)
+        db_session.commit()
+        year = create_mock_movie_list[2].movie.year
+
+        response = client.get(
+            "/movies/top_five/total_user",
+            params={"genre": "mock movie genre", "year": year},
+        )
+        assert response.status_code == 200
+        assert {movie["year"] for movie in response.json()["data"]} == {int(year)}
+
+        response = client.get("/movies/top_five/total_user", params={"min_votes": 2})
+        assert response.status_code == 404
+
+    @pytest.mark.parametrize("k", [0, 101])
+    def test_get_top_movies_all_users_k_out_of_range(self, client, k):
+        response = client.get("/movies/top_five/total_user", params={"k": k})
+        assert response.status_code == 422
+
     def test_get_top_movies_one_user(self, db_session, client, create_mock_movie_list):
         db_session.add_all(create_mock_movie_list)
         db_session.commit()
@@ -35,6 +78,38 @@ class TestRatingRoutes:
         )
         assert len(response.json()["data"]) == length
 
+    def test_get_user_ratings_pages(self, db_session, client):
+        user = User(id=1)
+        ratings = [
+            create_mock_rating(movie_id=i, user=user, title=f"Mock Movie Title {i}")
+            for i in range(7)
+        ]
+        db_session.add_all(ratings)
+        db_session.commit()
+        expected = sorted(ratings, key=lambda r: (-r.rating, r.movie_id))
+
+        pages, after = [], None
+        while True:
+            params = {"limit": 3} if after is None else {"limit": 3, "after": after}
+            response = client.get("/users/1/ratings", params=params)
+            assert response.status_code == 200
+            pages.append([movie["id"] for movie in response.json()["data"]])
+            after = response.json()["next_cursor"]
+            if after is None:
+                break
+
+        assert [len(page) for page in pages] == [3, 3, 1]
+        assert sum(pages, []) == [rating.movie_id for rating in expected]
+
+    def test_get_user_ratings_with_bad_cursor(self, client):
+        response = client.get("/users/1/ratings", params={"after": "bad"})
+        assert response.status_code == 400
+        assert response.json() == {"detail": "Bad request: Invalid cursor"}
+
+    def test_get_user_ratings_has_no_user(self, client):
+        response = client.get("/users/1/ratings")
+        assert response.status_code == 404
+
     @patch("app.methods.routes_class.Crud.get_top_five_movie_ratings")
     def test_get_top_movies_all_users_with_bad_request(
         self, mock_get_top_five_movie_ratings, client
@@ -92,7 +167,7 @@ class TestRatingRoutes:
         db_session.commit()
 
         user_id = create_mock_movie_list[1].user_id
-        movie_id = create_mock_movie_list[1].id
+        movie_id = create_mock_movie_list[1].movie_id
 
         response = client.put(
             f"/movies/user_rating/{user_id}/{movie_id}/1",
@@ -113,7 +188,7 @@ class TestRatingRoutes:
         db_session.commit()
 
         user_id = create_mock_movie_list[0].user_id
-        movie_id = create_mock_movie_list[0].id
+        movie_id = create_mock_movie_list[0].movie_id
 
         response = client.put(
             f"/movies/user_rating/{movie_id}/{user_id}/{rating}",
@@ -128,7 +203,7 @@ class TestRatingRoutes:
         db_session.add_all(create_mock_movie_list)
         db_session.commit()
 
-        movie_id = create_mock_movie_list[0].id
+        movie_id = create_mock_movie_list[0].movie_id
 
         response = client.put(
             f"/movies/user_rating/{movie_id}/0/4",
@@ -0,0 +1,211 @@
+import asyncio
+import time
+
+import pytest
+
+from app.methods.cache import movie_tag, user_tag
+
+fakeredis = pytest.importorskip("fakeredis")
+from fakeredis.aioredis import FakeRedis as FakeAsyncRedis  # noqa: E402
+
+from app.methods.redis_cache import RedisCacheBackend  # noqa: E402
+
+
+def wait_until(condition, timeout: float = 2) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TestRedisCacheBackend:
+    @pytest.fixture()
+    def server(self):
+        return fakeredis.FakeServer()
+
+    @pytest.fixture()
+    def workers(self, server):
+        """
+        Two workers sharing one Redis server
+        """
+        workers = [
+            RedisCacheBackend(
+                FakeAsyncRedis(server=server),
+                fakeredis.FakeRedis(server=server),
+                local_ttl=60,
+                enabled=True,
+            )
+            for _ in range(2)
+        ]
+        for worker in workers:
+            assert worker.subscribed.wait(2)
+        yield workers
+        for worker in workers:
+            worker.close()
+
+    def test_results_are_shared_between_workers(self, workers):
+        first, second = workers
+        loads = []
+
+        async def load():
+            loads.append(1)
+            return ("rows",)
+
+        async def run():
+            first_rows = await first.get_or_load("key", load, lambda rows: [])
+            second_rows = await second.get_or_load("key", load, lambda rows: [])
+            return first_rows, second_rows, await second.get_stats()
+
+        first_rows, second_rows, stats = asyncio.run(run())
+        assert first_rows == second_rows == ("rows",)
+        assert len(loads) == 1
+        assert stats["hits"] == 1
+        assert stats["size"] == 1
+
+    def test_keys_are_version_stamped(self, workers, server):
+        first, _ = workers
+
+        async def run():
+            token = await first.token()
+            await first.set("key", ("rows",), [movie_tag(1)], token)
+            await first.invalidate(movie_tag(2))
+            return sorted(await first.client.keys("*"))
+
+        keys = [key.decode() for key in asyncio.run(run())]
+        assert keys[-1] == "movie-api:v1:tag:movie:2"
+        assert [key.split(":")[2] for key in keys] == [
+            "entry",
+            "modified",
+            "modified",
+            "sequence",
+            "tag",
+        ]
+
+    def test_invalidation_is_seen_by_every_worker(self, workers):
+        first, second = workers
+
+        async def load():
+            return ("rows",)
+
+        async def store_everywhere():
+            for worker in workers:
+                await worker.get_or_load(
+                    "key", load, lambda rows: [movie_tag(1), user_tag(1)]
+                )
+
+        asyncio.run(store_everywhere())
+        assert first.local.get("key") == (True, ("rows",))
+
+        asyncio.run(second.invalidate(movie_tag(1)))
+        assert asyncio.run(second.get("key")) == (False, None)
+        # The local copy of the first worker is evicted by the invalidation message
+        assert wait_until(lambda: first.local.entries == {})
+        assert asyncio.run(first.get("key")) == (False, None)
+
+    def test_results_read_before_an_invalidation_are_not_stored(self, workers):
+        first, second = workers
+
+        async def run():
+            token = await first.token()
+            await second.invalidate(movie_tag(1))
+            stale = await first.set("stale", ("rows",), [movie_tag(1)], token)
+            fresh = await first.set("fresh", ("rows",), [movie_tag(2)], token)
+            return stale, fresh
+
+        assert asyncio.run(run()) == (False, True)
+
+    def test_hot_key_is_loaded_once_by_all_workers(self, workers):
+        loads = []
+
+        async def load():
+            loads.append(1)
+            await asyncio.sleep(0.1)
+            return ("rows",)
+
+        async def get_concurrently():
+            return await asyncio.gather(
+                *(
+                    worker.get_or_load("key", load, lambda rows: [])
+                    for worker in workers * 5
+                )
+            )
+
+        assert asyncio.run(get_concurrently()) == [("rows",)] * 10
+        assert len(loads) == 1
+
+    def test_unavailable_redis_falls_back_to_the_database(self, server):
+        worker = RedisCacheBackend(FakeAsyncRedis(server=server), enabled=True)
+        server.connected = False
+
+        async def load():
+            return ("rows",)
+
+        async def run():
+            rows = await worker.get_or_load("key", load, lambda rows: [])
+            return rows, await worker.invalidate(movie_tag(1))
+
+        assert asyncio.run(run()) == (("rows",), 0)
+
+    def test_listener_subscribes_once_redis_is_reachable(
+        self, server, monkeypatch, caplog
+    ):
+        monkeypatch.setattr("app.methods.redis_cache.LISTENER_RETRY_INTERVAL", 0.01)
+        server.connected = False
+        worker = RedisCacheBackend(
+            FakeAsyncRedis(server=server),
+            fakeredis.FakeRedis(server=server),
+            local_ttl=60,
+            enabled=True,
+        )
+        try:
+            assert wait_until(lambda: "subscribing again" in caplog.text)
+            assert not worker.subscribed.is_set()
+            assert not worker.local_ready
+
+            server.connected = True
+            assert worker.subscribed.wait(2)
+            other = RedisCacheBackend(FakeAsyncRedis(server=server), enabled=True)
+
+            async def store():
+                return await worker.set(
+                    "key", ("rows",), [movie_tag(1)], await worker.token()
+                )
+
+            assert asyncio.run(store())
+            assert worker.local.get("key") == (True, ("rows",))
+            asyncio.run(other.invalidate(movie_tag(1)))
+            assert wait_until(lambda: worker.local.entries == {})
+        finally:
+            worker.close()
+
+    def test_data_version_is_shared_between_workers(self, workers):
+        first, second = workers
+        assert first.shared
+
+        async def run():
+            before = await first.data_version()
+            assert await second.data_version() == before
+            await second.invalidate(movie_tag(1))
+            return before, await first.data_version()
+
+        before, after = asyncio.run(run())
+        assert after.tag != before.tag
+        assert after.modified_at >= before.modified_at
+
+    def test_data_version_of_tags(self, workers):
+        first, second = workers
+
+        async def run():
+            before = await first.data_version(user_tag(1), user_tag(2))
+            await second.invalidate(movie_tag(1))
+            unchanged = await first.data_version(user_tag(1), user_tag(2))
+            await second.invalidate(user_tag(2))
+            return before, unchanged, await first.data_version(user_tag(1), user_tag(2))
+
+        before, unchanged, after = asyncio.run(run())
+        # Only the invalidations of the given tags change their version
+        assert unchanged == before
+        assert after.tag != before.tag
+        assert after.modified_at >= before.modified_at
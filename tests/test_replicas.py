@@ -0,0 +1,163 @@
+import asyncio
+from time import monotonic, sleep
+
+import pytest
+from fastapi import Response
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from app.database import get_replica_router
+from app.methods.cache import movie_tag
+from app.models.movie import Base, Movie, MovieRatingAggregate, Rating, User
+from app.replicas import READ_PRIMARY_COOKIE, ReplicaRouter
+from tests.conftest import TestingAsyncSessionLocal
+
+
+def wait_until(condition, timeout: float = 2) -> bool:
+    deadline = monotonic() + timeout
+    while not condition():
+        if monotonic() > deadline:
+            return False
+        sleep(0.01)
+    return True
+
+
+def seed(session, title: str) -> None:
+    """
+    Add user 1 with a rating of movie 1, titled after the database it is stored in
+    """
+    session.add(
+        Rating(
+            user=User(id=1),
+            rating=3,
+            movie=Movie(
+                id=1,
+                title=title,
+                genre="Drama",
+                year="2001",
+                runtime="100 min",
+                aggregate=MovieRatingAggregate(
+                    rating_sum=3, rating_count=1, avr_rating=3
+                ),
+            ),
+        )
+    )
+    session.commit()
+
+
+def create_replica(path) -> str:
+    """
+    Create a SQLite stand-in for a replica, with its own copy of the data
+
+    :return: database URL of the replica
+    """
+    url = f"sqlite:///{path}"
+    engine = create_engine(url)
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        seed(session, path.stem)
+    engine.dispose()
+    return url
+
+
+class TestReplicaRouting:
+    @pytest.fixture()
+    def replica_client(self, app, client, db_session, tmp_path):
+        """
+        Client of an app reading from two replicas, whose movie is titled after the replica
+        """
+        seed(db_session, "primary")
+        urls = [create_replica(tmp_path / f"replica-{i}.db") for i in range(2)]
+        router = ReplicaRouter.from_urls(TestingAsyncSessionLocal, urls)
+        app.dependency_overrides[get_replica_router] = lambda: router
+        yield client, router
+        for replica in router.replicas:
+            client.portal.call(replica.engine.dispose)
+
+    @staticmethod
+    def read_title(client: TestClient, path: str = "/movies") -> str:
+        response = client.get(path)
+        assert response.status_code == 200
+        return response.json()["data"][0]["title"]
+
+    def test_reads_alternate_between_replicas(self, replica_client):
+        client, _ = replica_client
+        titles = [self.read_title(client) for _ in range(4)]
+        assert titles == ["replica-0", "replica-1", "replica-0", "replica-1"]
+        assert self.read_title(client, "/movies/top_five/1") == "replica-0"
+        assert self.read_title(client, "/users/1/ratings") == "replica-1"
+        export = client.get("/movies/export")
+        assert "replica-0" in export.text
+
+    def test_unhealthy_replica_is_skipped(self, replica_client, tmp_path):
+        client, router = replica_client
+        broken = ReplicaRouter.from_urls(
+            TestingAsyncSessionLocal, [f"sqlite:///{tmp_path / 'missing' / 'x.db'}"]
+        )
+        router.replicas[1] = broken.replicas[0]
+
+        client.portal.call(router.check_replicas)
+        assert router.replicas[1].healthy is False
+        assert [self.read_title(client) for _ in range(3)] == ["replica-0"] * 3
+
+        # Without a healthy replica, reads fall back to the primary
+        router.replicas[0].healthy = False
+        assert self.read_title(client) == "primary"
+
+    def test_health_checks_run_in_the_background(self, replica_client):
+        client, router = replica_client
+        router.check_interval = 0.01
+        client.portal.call(router.start)
+        try:
+            # Checked without any request
+            assert wait_until(
+                lambda: all(replica.checked_at for replica in router.replicas)
+            )
+        finally:
+            client.portal.call(router.stop)
+        assert all(replica.healthy for replica in router.replicas)
+
+    def test_recent_writers_expire_lazily(self):
+        router = ReplicaRouter(TestingAsyncSessionLocal, [], max_lag=0)
+        router.mark_write([1, 2], Response())
+        router.mark_write([3], Response())
+        assert list(router.recent_writers) == [3]
+        assert [user_id for _, user_id in router.expirations] == [3]
+
+        router.max_lag = 60
+        router.mark_write([1, 1], Response())
+        assert list(router.recent_writers) == [1]
+
+    def test_writer_reads_own_writes_from_primary(self, replica_client):
+        client, router = replica_client
+        response = client.put("/movies/user_rating/1/1/5")
+        assert response.status_code == 200
+        assert READ_PRIMARY_COOKIE in response.cookies
+
+        # The writing client reads from the primary through its cookie
+        assert self.read_title(client, "/users/1/ratings") == "primary"
+        assert self.read_title(client) == "primary"
+
+        # Other clients read the writer's ratings from the primary, and the rest from replicas
+        client.cookies.clear()
+        assert self.read_title(client, "/users/1/ratings") == "primary"
+        assert self.read_title(client).startswith("replica")
+
+        router.recent_writers.clear()
+        assert self.read_title(client, "/users/1/ratings").startswith("replica")
+
+    def test_replica_results_are_not_cached_right_after_a_write(
+        self, app, replica_client
+    ):
+        client, _ = replica_client
+        query_cache = app.state.query_cache
+        query_cache.enabled = True
+        asyncio.run(query_cache.invalidate(movie_tag(1)))
+
+        self.read_title(client)
+        assert client.get("/cache/stats").json()["data"]["size"] == 0
+
+        query_cache.modified_at = 0
+        self.read_title(client)
+        assert client.get("/cache/stats").json()["data"]["size"] == 1
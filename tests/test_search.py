@@ -0,0 +1,151 @@
+import asyncio
+from threading import Thread
+
+import pytest
+from sqlalchemy import event, update
+
+from app.database import Database
+from app.methods.routes_class import AsyncCrud, Crud
+from app.methods.search import NgramIndex, NgramSearch, similarity, trigrams
+from app.models.movie import Movie, Rating, User
+from app.settings import Settings
+from tests.conftest import TEST_DATABASE_URL, create_mock_rating
+
+TITLES = ["Inception", "Interstellar", "The Prestige", "Memento"]
+
+
+class TestSearch:
+    @pytest.fixture()
+    def movie_catalog(self, app, db_session):
+        user = User(id=1)
+        ratings = [
+            create_mock_rating(movie_id=i, user=user, title=title)
+            for i, title in enumerate(TITLES)
+        ]
+        db_session.add_all(ratings)
+        db_session.commit()
+        return ratings
+
+    def test_trigrams_are_padded(self):
+        assert trigrams("cat") == {"  c", " ca", "cat", "at "}
+        assert similarity("inception", "inception") == 1
+        assert similarity("inceptoin", "inception") > 0.3
+
+    def test_ngram_index(self, db_session, movie_catalog):
+        index = NgramIndex()
+        index.refresh(db_session)
+        assert set(index.search({"title": "ST"}, "contains")) == {1, 2}
+        assert set(index.search({"title": "in"}, "prefix")) == {0, 1}
+        assert set(index.search({"title": "memnto"}, "fuzzy")) == {3}
+        assert index.search({"title": "zzz"}, "contains") == {}
+
+    def test_ngram_index_sees_renames(self, db_session, movie_catalog):
+        index = NgramIndex()
+        index.refresh(db_session)
+        # Same length, so the catalog only changes through its version
+        db_session.execute(update(Movie).where(Movie.id == 3).values(title="Momento"))
+        db_session.commit()
+        index.refresh(db_session)
+        assert set(index.search({"title": "momento"}, "contains")) == {3}
+
+    def test_search_pages_follow_each_other_across_chunks(
+        self, client, db_session, movie_catalog, monkeypatch
+    ):
+        user = User(id=2)
+        db_session.add_all(
+            Rating(user=user, movie_id=i, rating=3) for i in range(len(TITLES))
+        )
+        db_session.commit()
+        expected = client.get("/movies", params={"title": "e"}).json()["data"]
+
+        monkeypatch.setattr("app.methods.search.NGRAM_CHUNK_SIZE", 2)
+        pages, after = [], None
+        while True:
+            params = {"title": "e", "limit": 1, **({"after": after} if after else {})}
+            body = client.get("/movies", params=params).json()
+            pages += body["data"]
+            after = body["next_cursor"]
+            if after is None:
+                break
+        assert len(pages) == 2 * len(TITLES)
+        assert pages == expected
+
+    def test_broad_search_inlines_one_chunk_of_ids(
+        self, db_session, movie_catalog, monkeypatch
+    ):
+        monkeypatch.setattr("app.methods.search.NGRAM_CHUNK_SIZE", 2)
+        monkeypatch.setattr(
+            "app.methods.routes_class.get_search_backend", lambda db: NgramSearch()
+        )
+        parameters = []
+
+        def record(connection, cursor, statement, params, context, executemany):
+            parameters.append(len(params))
+
+        engine = db_session.get_bind()
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            movies = Crud(db_session).get_movies_info(title="e")
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+        assert len(movies) == len(TITLES)
+        # Ids and scores of at most two movies, plus the constants of the statement
+        assert max(parameters) <= 3 * 2 + 2
+
+    @pytest.mark.parametrize(
+        "params, expected",
+        [
+            ({"title": "ste"}, {"Interstellar"}),
+            ({"title": "ig"}, {"The Prestige"}),
+            ({"title": "the", "mode": "prefix"}, {"The Prestige"}),
+            ({"title": "intersteller", "mode": "fuzzy"}, {"Interstellar"}),
+            ({"title": "e", "genre": "MOCK"}, set(TITLES)),
+        ],
+    )
+    def test_get_movies_search_modes(self, client, movie_catalog, params, expected):
+        response = client.get("/movies", params=params)
+        assert response.status_code == 200
+        assert {movie["title"] for movie in response.json()["data"]} == expected
+
+    def test_get_movies_ranks_by_relevance(self, client, movie_catalog):
+        response = client.get("/movies", params={"title": "inter", "mode": "fuzzy"})
+        assert response.status_code == 200
+        assert response.json()["data"][0]["title"] == "Interstellar"
+
+    def test_get_movies_year_is_exact(self, client, movie_catalog):
+        year = movie_catalog[0].movie.year
+        response = client.get("/movies", params={"year": year[:3]})
+        assert response.status_code == 404
+
+        response = client.get("/movies", params={"year": year})
+        assert response.status_code == 200
+        assert {movie["year"] for movie in response.json()["data"]} == {int(year)}
+
+    def test_get_movies_invalid_mode(self, client):
+        response = client.get("/movies", params={"title": "x", "mode": "regex"})
+        assert response.status_code == 422
+
+    def test_concurrent_async_searches_do_not_deadlock(self, movie_catalog):
+        async def search():
+            database = Database(Settings(database_url=TEST_DATABASE_URL, schema="skip"))
+            try:
+
+                async def get_movies():
+                    async with database.AsyncSessionLocal() as session:
+                        return await AsyncCrud(session).get_movies_info(title="ste")
+
+                return await asyncio.gather(*(get_movies() for _ in range(4)))
+            finally:
+                await database.dispose()
+
+        results = []
+        # A deadlock blocks the event loop, so the searches run in a thread given a deadline
+        thread = Thread(
+            target=lambda: results.extend(asyncio.run(search())), daemon=True
+        )
+        thread.start()
+        thread.join(30)
+        assert not thread.is_alive()
+        assert [[movie.title for movie in movies] for movies in results] == [
+            ["Interstellar"]
+        ] * 4
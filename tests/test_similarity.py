@@ -0,0 +1,155 @@
+import random
+
+import pytest
+from sqlalchemy import select
+
+from app.methods.aggregates import rebuild_rating_aggregates
+from app.methods.similarity import SimilarityIndex
+from app.models.movie import Movie, Rating, User
+from app.settings import Settings
+
+np = pytest.importorskip("numpy")
+from app.commands import similarity  # noqa: E402
+
+
+class TestSimilarity:
+    @pytest.fixture()
+    def rated_movies(self, app, db_session):
+        rng = random.Random(11)
+        db_session.add_all(
+            Movie(
+                id=movie_id,
+                title=f"Movie {movie_id}",
+                genre="Drama",
+                year="2000",
+                runtime="100 min",
+            )
+            for movie_id in range(1, 41)
+        )
+        db_session.add_all(User(id=user_id) for user_id in range(1, 61))
+        db_session.add_all(
+            Rating(user_id=user_id, movie_id=movie_id, rating=rng.randint(1, 5))
+            for user_id in range(1, 61)
+            for movie_id in rng.sample(range(1, 41), rng.randint(1, 10))
+        )
+        db_session.flush()
+        rebuild_rating_aggregates(db_session)
+        db_session.commit()
+
+    @pytest.fixture()
+    def index_path(self, tmp_path, monkeypatch):
+        # Small blocks, so the similarities are computed over several of them
+        monkeypatch.setattr(similarity, "BLOCK_VALUES", 200)
+        return str(tmp_path / "similarity.idx")
+
+    def expected_neighbors(self, db_session, neighbors):
+        ratings = db_session.execute(
+            select(Rating.user_id, Rating.movie_id, Rating.rating)
+        ).all()
+        vectors = {}
+        for user_id, movie_id, rating in ratings:
+            vectors.setdefault(movie_id, {})[user_id] = rating
+        expected = {}
+        for movie_id, vector in vectors.items():
+            scores = []
+            for other_id, other in vectors.items():
+                dot = sum(
+                    rating * other.get(user_id, 0) for user_id, rating in vector.items()
+                )
+                if other_id != movie_id and dot:
+                    norms = np.linalg.norm(list(vector.values())) * np.linalg.norm(
+                        list(other.values())
+                    )
+                    scores.append((other_id, np.float32(dot / norms)))
+            expected[movie_id] = sorted(scores, key=lambda s: (-s[1], s[0]))[:neighbors]
+        return expected
+
+    def assert_index(self, db_session, index_path, neighbors):
+        index = SimilarityIndex(index_path, reload_interval=0)
+        for movie_id, expected in self.expected_neighbors(
+            db_session, neighbors
+        ).items():
+            found = index.neighbors(movie_id)
+            assert [neighbor for neighbor, _ in found] == [m for m, _ in expected]
+            assert [score for _, score in found] == pytest.approx(
+                [float(score) for _, score in expected], rel=1e-6
+            )
+
+    def test_builds_the_cosine_neighbors(self, db_session, rated_movies, index_path):
+        summary = similarity.build_similarity_index(db_session, index_path, 5)
+        assert summary == {"mode": "full", "movies": 40, "recomputed": 40}
+        self.assert_index(db_session, index_path, 5)
+        assert similarity.build_similarity_index(db_session, index_path, 5) == {
+            "mode": "unchanged",
+            "movies": 40,
+            "recomputed": 0,
+        }
+
+    def test_refreshes_incrementally(self, db_session, rated_movies, index_path):
+        similarity.build_similarity_index(db_session, index_path, 5)
+        rng = random.Random(3)
+        ratings = db_session.execute(select(Rating)).scalars().all()
+        for rating in rng.sample(ratings, 4):
+            rating.rating = 6 - rating.rating
+        db_session.delete(ratings[0])
+        db_session.add(Movie(id=41, title="Movie 41", genre="Drama", year="2000"))
+        db_session.add(Rating(user_id=1, movie_id=41, rating=5))
+        db_session.commit()
+
+        summary = similarity.build_similarity_index(db_session, index_path, 5)
+        assert summary["mode"] == "incremental"
+        assert summary["recomputed"] < summary["movies"] == 41
+        self.assert_index(db_session, index_path, 5)
+
+        incremental = similarity.read_index(index_path)
+        similarity.build_similarity_index(db_session, index_path, 5, full=True)
+        rebuilt = similarity.read_index(index_path)
+        for name, values in rebuilt.items():
+            assert np.array_equal(incremental[name], values)
+
+    def test_routes(self, app, client, db_session, rated_movies, index_path):
+        response = client.get("/movies/1/similar")
+        assert response.status_code == 503
+
+        similarity.build_similarity_index(db_session, index_path, 5)
+        index = SimilarityIndex(index_path, reload_interval=0)
+        app.state.similarity = index
+        response = client.get("/movies/1/similar?k=3")
+        assert response.status_code == 200
+        assert [
+            (movie["id"], movie["score"]) for movie in response.json()["data"]
+        ] == pytest.approx(index.neighbors(1, 3))
+        assert response.json()["data"][0]["title"].startswith("Movie ")
+        assert client.get("/movies/999/similar").status_code == 404
+
+        user_id = db_session.scalar(
+            select(Rating.user_id).where(
+                Rating.rating >= Settings.recommendation_min_rating
+            )
+        )
+        ratings = db_session.execute(
+            select(Rating.movie_id, Rating.rating).where(Rating.user_id == user_id)
+        ).all()
+        scores = {}
+        for movie_id, rating in ratings:
+            if rating >= Settings.recommendation_min_rating:
+                for neighbor_id, score in index.neighbors(movie_id):
+                    scores[neighbor_id] = scores.get(neighbor_id, 0) + score * rating
+        for movie_id, _ in ratings:
+            scores.pop(movie_id, None)
+        best = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:4]
+        assert best
+        response = client.get(f"/users/{user_id}/recommendations?k=4")
+        assert response.status_code == 200
+        assert [
+            (movie["id"], movie["score"]) for movie in response.json()["data"]
+        ] == pytest.approx(best)
+        assert client.get("/users/999/recommendations").status_code == 404
+
+    def test_reloads_a_new_index(self, db_session, rated_movies, index_path):
+        similarity.build_similarity_index(db_session, index_path, 5)
+        index = SimilarityIndex(index_path, reload_interval=0)
+        assert len(index.neighbors(1)) == 5
+        similarity.build_similarity_index(db_session, index_path, 2, full=True)
+        assert len(index.neighbors(1)) == 2
+        assert index.neighbors(1, 1) == index.neighbors(1)[:1]
@@ -0,0 +1,206 @@
+import asyncio
+import os
+
+import pytest
+from sqlalchemy import select
+
+from app.database import Database
+from app.methods.write_behind import RatingWriteBuffer, WriteBufferFull, parse_log
+from app.models.movie import Movie, MovieRatingAggregate, Rating, User
+from app.settings import Settings
+from tests.conftest import TEST_DATABASE_URL
+
+
+class TestRatingWriteBuffer:
+    @pytest.fixture()
+    def rated_movies(self, app, db_session):
+        db_session.add_all(
+            Movie(
+                id=movie_id,
+                title=f"Movie {movie_id}",
+                genre="Drama",
+                year="2000",
+                aggregate=MovieRatingAggregate(
+                    rating_sum=2, rating_count=2, avr_rating=1
+                ),
+            )
+            for movie_id in (1, 2)
+        )
+        db_session.add_all(User(id=user_id) for user_id in (1, 2))
+        db_session.add_all(
+            Rating(user_id=user_id, movie_id=movie_id, rating=1)
+            for user_id in (1, 2)
+            for movie_id in (1, 2)
+        )
+        db_session.commit()
+
+    def ratings(self, db_session):
+        db_session.expire_all()
+        return {
+            (rating.user_id, rating.movie_id): rating.rating
+            for rating in db_session.execute(select(Rating)).scalars()
+        }
+
+    def run_with_database(self, test):
+        async def run():
+            database = Database(Settings(database_url=TEST_DATABASE_URL, schema="skip"))
+            try:
+                await test(database)
+            finally:
+                await database.dispose()
+
+        asyncio.run(run())
+
+    def test_coalesces_writes_into_one_flush(self, db_session, rated_movies, tmp_path):
+        async def test(database):
+            buffer = RatingWriteBuffer(str(tmp_path))
+            buffer.database = database
+            assert buffer.recover() == 0
+            await buffer.write(1, 1, 2)
+            await buffer.write(2, 2, 4)
+            await buffer.write(1, 1, 3)
+            await buffer.write(1, 9, 5)
+            assert buffer.pending == {(2, 2): (4, 2), (1, 1): (3, 3), (1, 9): (5, 4)}
+            assert len(parse_log(buffer.log.path)) == 4
+
+            assert await buffer.flush() == 3
+            assert buffer.pending == {} and buffer.checkpoint == 4
+            assert parse_log(buffer.log.path) == []
+            buffer.log.close()
+
+        self.run_with_database(test)
+        assert self.ratings(db_session) == {(1, 1): 3, (1, 2): 1, (2, 1): 1, (2, 2): 4}
+        aggregate = db_session.get(MovieRatingAggregate, 2)
+        assert (aggregate.rating_sum, aggregate.rating_count) == (5, 2)
+
+    def test_replays_the_log_after_a_crash(self, db_session, rated_movies, tmp_path):
+        async def test(database):
+            crashed = RatingWriteBuffer(str(tmp_path))
+            crashed.recover()
+            await crashed.write(1, 2, 5)
+            await crashed.write(2, 1, 4)
+            # The worker dies while writing a line, before anything was flushed
+            crashed.log.append("w 3 2 2")
+            os.write(crashed.log.fd, b"w 4 1 1")
+            crashed.log.close()
+
+            buffer = RatingWriteBuffer(str(tmp_path))
+            buffer.database = database
+            assert buffer.recover() == 2
+            assert buffer.log.path == crashed.log.path
+            assert buffer.pending == {(1, 2): (5, 1), (2, 1): (4, 2)}
+            assert await buffer.flush() == 2
+            buffer.log.close()
+
+        self.run_with_database(test)
+        assert self.ratings(db_session) == {(1, 1): 1, (1, 2): 5, (2, 1): 4, (2, 2): 1}
+
+    def test_takes_over_the_logs_of_stopped_workers(self, tmp_path):
+        async def test():
+            first, second = RatingWriteBuffer(str(tmp_path)), RatingWriteBuffer(
+                str(tmp_path)
+            )
+            first.recover()
+            second.recover()
+            assert first.log.path != second.log.path
+            await first.write(1, 1, 2)
+            await second.write(1, 1, 5)
+            await second.write(2, 2, 3)
+            first.log.close()
+            second.log.close()
+
+            buffer = RatingWriteBuffer(str(tmp_path))
+            assert buffer.recover() == 3
+            assert buffer.log.path == first.log.path
+            assert not os.path.exists(second.log.path)
+            assert buffer.pending == {(1, 1): (5, 2), (2, 2): (3, 3)}
+            assert parse_log(buffer.log.path) == [
+                (1, 1, 1, 2),
+                (2, 1, 1, 5),
+                (3, 2, 2, 3),
+            ]
+            buffer.log.close()
+
+        asyncio.run(test())
+
+    def test_refuses_writes_when_full(self, tmp_path):
+        async def test():
+            buffer = RatingWriteBuffer(
+                str(tmp_path), max_pending=1, enqueue_timeout=0.01
+            )
+            buffer.recover()
+            await buffer.write(1, 1, 2)
+            # Writes of a pending rating are coalesced, and need no room
+            await buffer.write(1, 1, 3)
+            with pytest.raises(WriteBufferFull):
+                await buffer.write(2, 2, 3)
+            assert buffer.pending == {(1, 1): (3, 2)}
+            buffer.log.close()
+
+        asyncio.run(test())
+
+    def test_flushes_in_the_background(self, db_session, rated_movies, tmp_path):
+        async def test(database):
+            buffer = RatingWriteBuffer(
+                str(tmp_path), flush_interval=0.01, log_max_bytes=1
+            )
+            buffer.start(database)
+            try:
+                await buffer.write(1, 1, 4)
+                for _ in range(200):
+                    if buffer.log.size == 0:
+                        break
+                    await asyncio.sleep(0.01)
+                assert not buffer.pending
+                # The log grew past its maximum size, and was rewritten empty
+                assert buffer.log.size == 0
+                await buffer.write(2, 2, 5)
+            finally:
+                await buffer.stop()
+
+        self.run_with_database(test)
+        assert self.ratings(db_session) == {(1, 1): 4, (1, 2): 1, (2, 1): 1, (2, 2): 5}
+
+    def test_route_accepts_buffered_updates(
+        self, app, client, db_session, rated_movies, tmp_path
+    ):
+        buffer = RatingWriteBuffer(str(tmp_path))
+        buffer.recover()
+        app.state.write_buffer = buffer
+        response = client.put("/movies/user_rating/1/2/4")
+        assert response.status_code == 202
+        assert response.json()["data"] == {"user_id": 1, "movie_id": 2, "rating": 4}
+        assert client.put("/movies/user_rating/1/9/4").status_code == 404
+        assert client.put("/movies/user_rating/1/2/6").status_code == 400
+        assert self.ratings(db_session)[1, 2] == 1
+        assert "write_behind_pending 1\n" in client.get("/metrics").text
+
+        async def flush(database):
+            buffer.database = database
+            assert await buffer.flush() == 1
+
+        self.run_with_database(flush)
+        buffer.log.close()
+        assert self.ratings(db_session)[1, 2] == 4
+
+    def test_bulk_writes_are_not_overwritten_by_a_replay(
+        self, app, client, db_session, rated_movies, tmp_path
+    ):
+        buffer = RatingWriteBuffer(str(tmp_path))
+        buffer.recover()
+        buffer.database = Database(
+            Settings(database_url=TEST_DATABASE_URL, schema="skip")
+        )
+        app.state.write_buffer = buffer
+        assert client.put("/movies/user_rating/1/2/4").status_code == 202
+        response = client.post(
+            "/movies/user_rating/bulk",
+            json=[{"user_id": 1, "movie_id": 2, "rating": 2}],
+        )
+        assert response.status_code == 200
+        assert response.json()["updated"] == 1
+        client.portal.call(buffer.database.dispose)
+        # The worker dies before its next flush, the next one has nothing to replay
+        buffer.log.close()
+        assert RatingWriteBuffer(str(tmp_path)).recover() == 0
+        assert self.ratings(db_session)[1, 2] == 2